@@ -0,0 +1,148 @@
+'''
+@author: Reem Alatrash
+@version: 1.0
+=======================
+
+This script benchmarks the CCOHA pipeline on a synthetic COHA-style corpus (see synthetic_coha.py).
+It runs the following stages, each one as a separate process, and reports their time, throughput
+(tokens/sec and documents/sec) and peak memory:
+1. clean-copy-coha.py (cleaning the tagged files)
+2. compress_del_folders.py (compressing the clean tagged files, skipped if the clean files are written to zip archives)
+3. generate_text_files.py (generating the text files, skipped if they are written while cleaning)
+4. compress_del_folders.py (compressing the text files, skipped if they are written to zip archives)
+
+*Note: the peak memory of a stage is the maximum resident set size of its largest process (Linux reports it in KB).
+
+Example:
+---------
+
+python benchmark_coha.py "/tmp/synthetic_coha/" --docs=200 --clean-args="--batch-tag --processes=4"
+
+'''
+
+'''
+******* ********* *********
+*******  imports  *********
+******* ********* *********
+'''
+import sys
+import os
+import shutil
+import subprocess
+import time
+import json
+import zipfile
+from docopt import docopt
+import synthetic_coha
+
+'''
+******* ********* *********
+******* variables *********
+******* ********* *********
+'''
+usage = """Benchmark the CCOHA pipeline on a synthetic corpus.
+
+Usage:
+    benchmark_coha.py <work_dir> [options]
+
+Arguments:
+    <work_dir> = directory of the synthetic corpus (it is generated if it doesn't contain one)
+
+Options:
+    --python=<path>  python interpreter that runs the scripts (default: this interpreter)
+    --clean-args=<args>  extra arguments of clean-copy-coha.py [default: ]
+    --compress-args=<args>  extra arguments of compress_del_folders.py [default: ]
+    --text-args=<args>  extra arguments of generate_text_files.py [default: ]
+    --json=<file>  write the report to a json file
+    --decades=<list>  comma separated decades [default: 1810s,1900s,2000s]
+    --docs=<n>  number of text files per decade [default: 50]
+    --tokens=<n>  average number of tokens per text file [default: 2000]
+    --malformed-rate=<r>  rate of malformed tokens [default: 0.02]
+    --html-rate=<r>  rate of tokens with html entities [default: 0.005]
+    --null-rate=<r>  rate of lines with a null pos tag [default: 0.01]
+    --nul-rate=<r>  rate of lines with NUL characters [default: 0.002]
+    --q-rate=<r>  rate of q! lines [default: 0.002]
+    --seed=<n>  seed of the random generator [default: 0]
+
+"""
+# the scripts are run from their directory since they import modules using relative paths
+code_path = os.path.dirname(os.path.abspath(__file__))
+
+'''
+******* ********* *********
+******* functions *********
+******* ********* *********
+'''
+
+def run_stage(name, command):
+    '''Runs a stage of the pipeline and returns its wall time (seconds) and peak memory (resident set size)'''
+    start = time.time()
+    process = subprocess.Popen(command, cwd=code_path)
+    # wait4 returns the resource usage of the stage's process (and its worker processes)
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    if status != 0:
+        raise RuntimeError("stage {0} failed: {1}".format(name, " ".join(command)))
+    return elapsed, usage.ru_maxrss
+
+def count_corpus(tagged_path):
+    '''returns the number of text files and tokens (lines after the header) of the zip files in the given directory'''
+    docs = 0
+    tokens = 0
+    for zip_file_name in os.listdir(tagged_path):
+        if ".zip" not in zip_file_name:
+            continue
+        with zipfile.ZipFile(os.path.join(tagged_path, zip_file_name), 'r') as current_zip:
+            for text_file_name in current_zip.namelist():
+                docs += 1
+                tokens += current_zip.read(text_file_name).count(b"\n") - 1
+    return docs, tokens
+
+def main():
+    args = docopt(usage)
+    work_dir = os.path.join(os.path.abspath(args['<work_dir>']), '')
+    python = args['--python'] or sys.executable
+    clean_args = args['--clean-args'].split()
+    tagged_path = os.path.join(work_dir, "tagged")
+
+    # generate the synthetic corpus (unless it was generated by a previous run)
+    if not os.path.isdir(tagged_path):
+        synthetic_coha.generate_corpus(work_dir, args['--decades'].split(","), int(args['--docs']), int(args['--tokens']),
+                                       synthetic_coha.get_rates(args), int(args['--seed']))
+    docs, tokens = count_corpus(tagged_path)
+    # remove the output of previous runs
+    for path in ["clean/tagged", "clean/text"]:
+        shutil.rmtree(os.path.join(work_dir, path), ignore_errors=True)
+        os.makedirs(os.path.join(work_dir, path))
+
+    # build the stages of the pipeline
+    stages = [("clean", [python, "clean-copy-coha.py", work_dir, "T", "<sub>", "<nul>"] + clean_args)]
+    if "--zip-output" not in clean_args:
+        stages.append(("compress tagged", [python, "compress_del_folders.py", os.path.join(work_dir, "clean/tagged/"), "T", ""]
+                       + args['--compress-args'].split()))
+    if "--text-output" not in clean_args:
+        stages.append(("generate text", [python, "generate_text_files.py", work_dir] + args['--text-args'].split()))
+    if "--text-output" not in clean_args or "--zip-output" not in clean_args:
+        stages.append(("compress text", [python, "compress_del_folders.py", os.path.join(work_dir, "clean/text/"), "T", ""]
+                       + args['--compress-args'].split()))
+
+    # run the stages and report the results
+    report = {"documents": docs, "tokens": tokens, "stages": []}
+    print("corpus: {0} documents, {1} tokens".format(docs, tokens))
+    print("{0:<16}{1:>10}{2:>14}{3:>12}{4:>14}".format("stage", "seconds", "tokens/sec", "docs/sec", "peak RSS (MB)"))
+    total = 0.0
+    for name, command in stages:
+        elapsed, max_rss = run_stage(name, command)
+        total += elapsed
+        stage = {"stage": name, "seconds": elapsed, "tokens_per_sec": tokens / elapsed, "docs_per_sec": docs / elapsed,
+                 "peak_rss_mb": max_rss / 1024.0}
+        report["stages"].append(stage)
+        print("{stage:<16}{seconds:>10.2f}{tokens_per_sec:>14.0f}{docs_per_sec:>12.1f}{peak_rss_mb:>14.1f}".format(**stage))
+    report["seconds"] = total
+    print("{0:<16}{1:>10.2f}{2:>14.0f}{3:>12.1f}".format("total", total, tokens / total, docs / total))
+    if args['--json']:
+        with open(args['--json'], 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+
+if __name__ == "__main__":
+   main()
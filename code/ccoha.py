@@ -0,0 +1,1231 @@
+'''
+@author: Reem Alatrash
+@version: 1.0
+=======================
+
+This module cleans the tagged files of the COHA corpus (it's used by clean-copy-coha.py).
+It can be imported to clean COHA files in-process, e.g. from another script, service or notebook:
+a CohaCleaner is built once with the cleaning options and reused for all files.
+This is done in the following manner:
+1. Read original tagged files and clean malformed tokens.
+2. POS tag and lemmatize the cleaned tokens.
+3. Return the results (the header and the clean tokens of each file), with an <eos> token after each sentence.
+
+Example:
+---------
+
+from ccoha import CohaCleaner
+cleaner = CohaCleaner(rm_null=True, mal_pos=u"<sub>", nul_sub=u"<nul>").load_resources()
+for text_file_name, header, tokens in cleaner.clean_zip("/mount/resources/corpora/COHA/tagged/wlp_1930s_ney.zip"):
+    for form, lemma, pos in tokens:
+        ...
+
+'''
+
+'''
+******* ********* *********
+*******  imports  *********
+******* ********* *********
+'''
+import sys
+import os
+import zipfile
+import HTMLParser
+import logging
+import time
+import re # regex library
+import collections
+import itertools
+import array
+import cPickle as pickle
+import nltk
+
+'''
+******* ********* *********
+******* variables *********
+******* ********* *********
+'''
+malformed_chars = ['.', "'", '--',' ',':', ';', '*', '?','!']
+valid_apostrophs = ["n't","'s","'m","'d","'ve","'ing", "'ll", "etc."]
+
+# build regular expression to be used to detect malformed tokens
+# exclude 1st two chars (. and ') since they are handled in the 2nd pass over the data
+malformed_regex_pass1 = re.compile("({0})".format('|'.join(re.escape(item) for item in malformed_chars[2:])))
+# 2nd pass consider all chars
+malformed_regex_pass2 = re.compile("({0})".format('|'.join(re.escape(item) for item in malformed_chars)))
+html_hex_regex = re.compile("(&\w+;|&#[0-9]+;)")
+saute_forms = set(["sauteed","sauted","saut","saute","sauteing","sautes","sauting"])
+# used by is_malformed: tokens with at least one (lowercase) letter and valid apostrophe uses
+alphabet_regex = re.compile("[a-z]")
+valid_apostrophs_regex = re.compile('|'.join(re.escape(item) for item in valid_apostrophs))
+# characters of the tokens that may need a fix in the 1st pass: html and control chars (& and <),
+# NUL characters and malformed chars except . and ' (q! contains !).
+# Tokens without any of them only need their saute lemma to be unified
+nul_char = u"\x00"
+# end-of-sentence token
+eos_token = (u"<eos>", u"<eos>", u"<eos>")
+first_pass_regex = re.compile(u"[&<\x00 :;*?!-]")
+
+# nltk libraries that are needed for tokenization, tagging and lemmatization
+# they must be available locally (they are not downloaded), see check_nltk_resources()
+nltk_resources = ['corpora/wordnet', 'taggers/averaged_perceptron_tagger', 'tokenizers/punkt/english.pickle']
+# the punkt sentence tokenizer and the pos tagger are loaded once per process when they're first needed
+sentence_tokenizer = None
+pos_tagger = None
+# add special abbreviations to prevent tokenization errors
+extra_abbreviations = ['dr', 'vs', 'mr', 'mrs', 'prof', 'inc', 'i.e', 'e.g', 'p.k', 'c.c.f', 'm.c', 'etc',
+                       'o.k', 'fr', 'acct', 'co', 'd.o.a', 'approx', 'ave', 'bros', 'sq', 'st', 'd.j']
+
+# add control chars for tokens where pos tag = "null"
+'''
+# ASCII device control characters that cause splitting errors:
+horizontal tab, line feed, and carriage return
+Read more here: https://www.w3schools.com/charsets/ref_html_ascii.asp
+We added the chars non-breaking space and < to ignore white spaces and html tags like <> and <P>
+'''
+control_chars = ['&nbsp;', '&#10;', '&#13;', '&#09;', '<']
+
+'''
+******* ********* *********
+******* functions *********
+******* ********* *********
+'''
+
+def contais_control_chars(token):
+	'''returns true if token form contains unicode control characters'''
+	token = token.lower()
+	for char in control_chars:
+		if char in token:
+			#skip this token
+			return True
+	return False
+	
+def get_wordnet_pos(treebank_tag):
+    ''' returns WORDNET compliant POS tag '''
+    # WordNet POS tags are: NOUN = 'n', ADJ = 's', VERB = 'v', ADV = 'r', ADJ_SAT = 'a'
+    # Descriptions (c) https://web.stanford.edu/~jurafsky/slp3/10.pdf
+    if treebank_tag.startswith('J') or treebank_tag == "PDT" or treebank_tag == "RP":
+        return nltk.corpus.wordnet.ADJ
+    elif treebank_tag.startswith('V'):
+        return nltk.corpus.wordnet.VERB
+    elif treebank_tag.startswith('N'):
+        return nltk.corpus.wordnet.NOUN
+    elif treebank_tag.startswith('R') or treebank_tag == "IN" or treebank_tag == "EX":
+        return nltk.corpus.wordnet.ADV  
+    else:
+        # As default pos in lemmatization is Noun
+        return nltk.corpus.wordnet.NOUN
+
+def get_claws7_pos(treebank_tag):
+    '''maps nltk a treebank pos tag to CLAWS7'''
+    # Create a map between Treebank (used by nltk pos tagger) and CLAWS7 tagsets
+    # CLAWS7 tag description (c) http://ucrel.lancs.ac.uk/claws7tags.html
+    nltk_to_claws7 = {
+            'CC':'CC', # coordin. conjunction (and, but, or)  
+            'CD':'MC', # cardinal number (one, two)             
+            'DT':'DD', # determiner (a, the)                    
+            'EX':'EX', # existential 'there' (there)           
+            'FW':'FW', # foreign word (mea culpa)             
+            'IN':'II', # preposition/sub-conj (of, in, by)   
+            'JJ':'JJ', # adjective (yellow)                  
+            'JJR':'JJR', # adj., comparative (bigger)          
+            'JJS':'JJT', # adj., superlative (wildest)           
+            'LS':'MC', # list item marker (1, 2, One)          
+            'MD':'VM', # modal (can, should)                    
+            'NN':'NN1', # noun, sing. or mass (llama)          
+            'NNS':'NN2', # noun, plural (llamas)                  
+            'NNP':'NP1', # proper noun, sing. (IBM)              
+            'NNPS':'NP2', # proper noun, plural (Carolinas)
+            'PDT':'DB', # predeterminer (all, both)            
+            'POS':'GE', # possessive ending ('s ) 
+            'PRP':'PRP', # personal pronoun (I, you, he) 
+            # the general tag PRP does NOT exist in CLAWS7 which has a different tag for each case        
+            'PRP$':'APPGE', # possessive pronoun (your, one's)    
+            'RB':'RR', # adverb (quickly, never)            
+            'RBR':'RRR', # adverb, comparative (faster)        
+            'RBS':'RRT', # adverb, superlative (fastest)     
+            'RP':'RP', # particle (up, off)
+            'SYM':'Y', # symbol (+,%, &)
+            # 'Y' is a general COHA tag for punctuation and other symbols. It does NOT exist in CLAWS7
+            'TO':'TO', # "to" (to)
+            'UH':'UH', # interjection (ah, oops)
+            'VB':'VV0', # verb base form (eat)
+            'VBD':'VVD', # verb past tense (ate)
+            'VBG':'VVG', # verb gerund (eating)
+            'VBN':'VVN', # verb past participle (eaten)
+            'VBP':'VV0', # verb non-3sg pres (eat)
+            'VBZ':'VVZ', # verb 3sg pres (eats)
+            'WDT':'DDQ', # wh-determiner (which, that)
+            'WP':'PNQ', # wh-pronoun (what, who)
+            # the general tag PNQ does NOT exist in CLAWS7 which has a different tag for each case 
+            'WP$':'PNQ', # possessive (wh- whose)
+            'WRB':'RRQ', # wh-adverb (how, where)
+            '$':'Y', #  dollar sign ($)
+            '#':'Y', # pound sign (#)
+            '"':'Y', # left quote (' or ")
+            '"':'Y', # right quote (' or ")
+            '(':'Y', # left parenthesis ([, (, {, <)
+            ')':'Y', # right parenthesis (], ), }, >)
+            ',':'Y', # comma (,)
+            '.':'Y', # sentence-final punc (. ! ?)
+            ':':'Y', # mid-sentence punc (: ; ... -)
+            "''":'Y' # apostrophe punc
+        }
+    claws_tag = "" 
+    # if the pos tag can be mapped, return claws tag,
+    # else return the nltk pos tag unchanged
+    if treebank_tag.upper() in nltk_to_claws7:
+        claws_tag = nltk_to_claws7[treebank_tag.upper()]
+    else:
+        claws_tag = treebank_tag
+    
+    return claws_tag.lower()
+
+def is_malformed(token, first_pass=True):
+    '''checks if given string token contains chars corresponding to malformed tokens'''
+    # check if token contains at least 1 alphabet
+    # skip valid apostrophe uses
+    matches = None
+    if alphabet_regex.search(token) and not valid_apostrophs_regex.search(token):
+        # first pass over data ignores . since we are looking at each token
+        # 2nd pass considers only sentence boundaries so look for .
+        if first_pass:
+            malformed_regex = malformed_regex_pass1
+        else:    
+            malformed_regex = malformed_regex_pass2
+        # use regex search to return a list of all malformed chars in token
+        matches = malformed_regex.findall(token)  
+    return matches  
+
+class LemmaCache(object):
+    '''Bounded LRU cache of WordNet lemmas keyed by (form, WordNet POS tag).
+    Each cleaner has one cache and one lemmatizer that are reused for all files'''
+
+    def __init__(self, max_size, record_new_entries=False):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lemmatizer = None
+        self._cache = collections.OrderedDict()
+        # lemmas computed since the last call to pop_new_entries() (only recorded if they are saved, see CohaCleaner)
+        self.record_new_entries = record_new_entries
+        self._new_entries = {}
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _add(self, key, lemma):
+        '''adds a lemma to the cache and drops the least recently used one if the cache is full (nothing is cached if max_size is 0)'''
+        if self.max_size <= 0:
+            return
+        if len(self._cache) >= self.max_size:
+            self._cache.popitem(last=False)
+        self._cache[key] = lemma
+
+    def load_lemmatizer(self):
+        '''returns the WordNet lemmatizer (loaded the first time it's needed)'''
+        if self._lemmatizer is None:
+            self._lemmatizer = nltk.stem.WordNetLemmatizer()
+        return self._lemmatizer
+
+    def lemmatize(self, form, wordnet_pos):
+        '''returns the lemma of the given form, looking it up in WordNet only if it isn't cached'''
+        key = (form, wordnet_pos)
+        lemma = self._cache.pop(key, None)
+        if lemma is None:
+            self.misses += 1
+            lemma = self.load_lemmatizer().lemmatize(form, pos=wordnet_pos)
+            if self.record_new_entries and len(self._new_entries) < self.max_size:
+                self._new_entries[key] = lemma
+        else:
+            self.hits += 1
+        # (re)insert as most recently used
+        self._add(key, lemma)
+        return lemma
+
+    def update(self, entries):
+        '''adds the given (key, lemma) entries to the cache'''
+        for key, lemma in entries:
+            self._cache.pop(key, None)
+            self._add(key, lemma)
+
+    def pop_new_entries(self):
+        '''returns the hit and miss counts and the entries computed since the last call (empty unless they are recorded) and resets them'''
+        new_entries = list(self._new_entries.items())
+        stats = (self.hits, self.misses, new_entries)
+        self.hits = 0
+        self.misses = 0
+        self._new_entries = {}
+        return stats
+
+    def load(self, file_path):
+        '''warm-starts the cache with the entries saved in the given file'''
+        with open(file_path, 'rb') as cache_file:
+            self.update(pickle.load(cache_file))
+
+    def save(self, file_path):
+        '''saves the cached entries to the given file'''
+        with open(file_path, 'wb') as cache_file:
+            pickle.dump(list(self._cache.items()), cache_file, pickle.HIGHEST_PROTOCOL)
+
+class StageStats(object):
+    '''Time spent (seconds) and number of calls of each stage of the cleaning, along with
+    counters (documents, lines, tokens, sentences). They are handed to the main process after each text file'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        '''clears the stats'''
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.counters = collections.defaultdict(int)
+
+    def total(self):
+        '''returns the time spent in all stages so far'''
+        return sum(self.seconds.values())
+
+    def add(self, stage, start, calls=1):
+        '''adds the time since start to the given stage. Returns the current time (i.e. the start of the next stage)'''
+        now = time.time()
+        self.seconds[stage] += now - start
+        self.calls[stage] += calls
+        return now
+
+    def add_exclusive(self, stage, start, total_start, calls=1):
+        '''adds the time since start to the given stage, excluding the time of the stages that were added since then.
+        total_start is the total time of all stages at start'''
+        self.seconds[stage] += time.time() - start - (self.total() - total_start)
+        self.calls[stage] += calls
+
+    def count(self, counter, n=1):
+        '''increments a counter'''
+        self.counters[counter] += n
+
+    def pop(self):
+        '''returns the stats since the last call as a dictionary and resets them'''
+        stats = {"stages": dict((stage, {"seconds": self.seconds[stage], "calls": self.calls[stage]}) for stage in self.seconds),
+                 "counters": dict(self.counters)}
+        self.reset()
+        return stats
+
+class CorpusIndex(object):
+    '''Lemma and form frequencies (per decade and genre) and postings (the documents that contain each lemma) of the cleaned files.
+    The tokens of a document are counted as they are cleaned and only added to the index when the document is done (see end_document),
+    so that a file that fails isn't counted. Each worker process builds its own index, the indexes are merged at the end (see load)'''
+
+    def __init__(self):
+        # (decade, text file name) of the indexed documents, the number of a document is its position
+        self.documents = []
+        # (decade, genre) -> lemma (form) encoded in utf-8 -> frequency
+        self.lemma_frequencies = collections.defaultdict(collections.Counter)
+        self.form_frequencies = collections.defaultdict(collections.Counter)
+        # lemma -> numbers of the documents that contain it
+        self.postings = {}
+        self.start_document(None, None)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def start_document(self, decade, text_file_name):
+        '''starts counting the tokens of a document (the counts of a document that wasn't ended are dropped)'''
+        self.document = (decade, text_file_name)
+        self.document_lemmas = collections.Counter()
+        self.document_forms = collections.Counter()
+
+    def add_tokens(self, tokens):
+        '''counts the forms and lemmas of the given tokens (TokenStore) of the current document.
+        They are counted as they are written (encoded in utf-8, lemmas lowercased, see format_tokens)'''
+        utf8, utf8_lower = tokens.vocabulary.encoded()
+        for counts, column, strings in ((self.document_forms, 0, utf8), (self.document_lemmas, 1, utf8_lower)):
+            for string_id, count in collections.Counter(itertools.islice(tokens.ids, column, None, 3)).items():
+                counts[strings[string_id]] += count
+
+    def end_document(self):
+        '''adds the counts of the current document to the index'''
+        decade, text_file_name = self.document
+        # extract genre from file name (e.g. fic_1817_8554.txt)
+        genre = text_file_name.split("_")[0]
+        for counts in (self.document_forms, self.document_lemmas):
+            counts.pop(eos_token[0].encode('utf8'), None)
+        number = len(self.documents)
+        self.documents.append(self.document)
+        self.lemma_frequencies[(decade, genre)].update(self.document_lemmas)
+        self.form_frequencies[(decade, genre)].update(self.document_forms)
+        for lemma in self.document_lemmas:
+            self.postings.setdefault(lemma, array.array('i')).append(number)
+        self.start_document(None, None)
+
+    def update(self, other):
+        '''adds the documents, frequencies and postings of another index'''
+        offset = len(self.documents)
+        self.documents.extend(other.documents)
+        for frequencies, other_frequencies in ((self.lemma_frequencies, other.lemma_frequencies),
+                                               (self.form_frequencies, other.form_frequencies)):
+            for key, counts in other_frequencies.items():
+                frequencies[key].update(counts)
+        for lemma, numbers in other.postings.items():
+            self.postings.setdefault(lemma, array.array('i')).extend(number + offset for number in numbers)
+
+    def load(self, file_path):
+        '''adds the index saved in the given file (e.g. the index of a worker process)'''
+        with open(file_path, 'rb') as index_file:
+            self.update(pickle.load(index_file))
+
+    def save(self, file_path):
+        '''saves the index (without the current document) to the given file'''
+        self.start_document(None, None)
+        with open(file_path, 'wb') as index_file:
+            pickle.dump(self, index_file, pickle.HIGHEST_PROTOCOL)
+
+    def write_tables(self, index_path):
+        '''Writes the index under the given directory:
+        - documents.tsv: number, decade and text file name of the documents (numbered in the order of their decades and names)
+        - lemma_frequencies.tsv and form_frequencies.tsv: decade, genre, lemma (form) and frequency
+        - lemma_postings.i32: the numbers of the documents of each lemma (ascending), as little-endian 32-bit integers
+        - lemma_postings.tsv: lemma, offset of its documents in lemma_postings.i32 and number of documents'''
+        order = sorted(range(len(self.documents)), key=self.documents.__getitem__)
+        # number of each document in the tables
+        numbers = array.array('i', [0]) * len(order)
+        for number, position in enumerate(order):
+            numbers[position] = number
+        with open(os.path.join(index_path, "documents.tsv"), 'w') as documents_file:
+            for number, position in enumerate(order):
+                documents_file.write("{0}\t{1}\t{2}\n".format(number, *self.documents[position]))
+        for file_name, frequencies in (("lemma_frequencies.tsv", self.lemma_frequencies), ("form_frequencies.tsv", self.form_frequencies)):
+            with open(os.path.join(index_path, file_name), 'w') as frequencies_file:
+                for decade, genre in sorted(frequencies):
+                    # most frequent first, ties in the order of the strings (the tables don't depend on the order of the documents)
+                    for string, count in sorted(frequencies[(decade, genre)].items(), key=lambda item: (-item[1], item[0])):
+                        frequencies_file.write("{0}\t{1}\t{2}\t{3}\n".format(decade, genre, string, count))
+        offset = 0
+        with open(os.path.join(index_path, "lemma_postings.i32"), 'wb') as postings_file, \
+             open(os.path.join(index_path, "lemma_postings.tsv"), 'w') as lemmas_file:
+            for lemma in sorted(self.postings):
+                documents = array.array('i', sorted(numbers[position] for position in self.postings[lemma]))
+                if sys.byteorder == "big":
+                    documents.byteswap()
+                documents.tofile(postings_file)
+                lemmas_file.write("{0}\t{1}\t{2}\n".format(lemma, offset, len(documents)))
+                offset += len(documents)
+
+class Vocabulary(object):
+    '''Strings (forms, lemmas and pos tags) seen by a cleaner, identified by integer ids.
+    The tokens of a file are stored as ids (see TokenStore) instead of lists of tuples of strings'''
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self.strings)
+
+    def clear(self):
+        '''removes all strings'''
+        self.ids = {}
+        self.strings = []
+        # utf-8 encoding of the strings and of their lowercased version (computed when they are written)
+        self.utf8 = []
+        self.utf8_lower = []
+
+    def id(self, string):
+        '''returns the id of a string, adding it to the vocabulary if it's new'''
+        string_id = self.ids.get(string)
+        if string_id is None:
+            string_id = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return string_id
+
+    def encoded(self):
+        '''returns the utf-8 encoding of the strings and of their lowercased version (indexed by id).
+        The strings are lowercased once encoded, i.e. only their ascii letters are lowercased'''
+        for string in self.strings[len(self.utf8):]:
+            encoded = string.encode('utf8')
+            self.utf8.append(encoded)
+            self.utf8_lower.append(encoded.lower())
+        return self.utf8, self.utf8_lower
+
+class TokenStore(object):
+    '''Tokens (form, lemma, pos) of a file stored as vocabulary ids in one array of 3 ids per token'''
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.ids = array.array('i')
+
+    def __len__(self):
+        return len(self.ids) // 3
+
+    def __getitem__(self, idx):
+        '''returns the (form, lemma, pos) of a token'''
+        strings = self.vocabulary.strings
+        return (strings[self.ids[3 * idx]], strings[self.ids[3 * idx + 1]], strings[self.ids[3 * idx + 2]])
+
+    def __iter__(self):
+        '''yields the (form, lemma, pos) of each token'''
+        strings = self.vocabulary.strings
+        ids = iter(self.ids)
+        for form_id, lemma_id, pos_id in itertools.izip(ids, ids, ids):
+            yield strings[form_id], strings[lemma_id], strings[pos_id]
+
+    def append(self, form, lemma, pos):
+        '''adds a token'''
+        self.ids.extend((self.vocabulary.id(form), self.vocabulary.id(lemma), self.vocabulary.id(pos)))
+
+    def extend_ids(self, ids):
+        '''adds tokens given their ids (3 per token)'''
+        self.ids.extend(ids)
+
+    def pop(self):
+        '''removes the last token'''
+        del self.ids[-3:]
+
+    def remove_first(self, n):
+        '''removes the first n tokens'''
+        del self.ids[:3 * n]
+
+    def clear(self):
+        '''removes all tokens'''
+        del self.ids[:]
+
+    def forms(self, start=0):
+        '''returns the forms of the tokens (from the given token index)'''
+        strings = self.vocabulary.strings
+        return list(strings[form_id] for form_id in self.ids[3 * start::3])
+
+def check_nltk_resources():
+    '''returns the nltk resources that aren't available locally, without trying to download them'''
+    missing = []
+    for resource in nltk_resources:
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            missing.append(resource)
+    return missing
+
+def get_sentence_tokenizer():
+    '''returns the punkt sentence tokenizer of this process (loaded the first time it's needed)'''
+    global sentence_tokenizer
+    if sentence_tokenizer is None:
+        # initialize the punkt sentence tokenizer 
+        sentence_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
+        # update the default abbreviations set _params.abbrev_types by adding the extra abbreviations to it
+        sentence_tokenizer._params.abbrev_types.update(extra_abbreviations)
+    return sentence_tokenizer
+
+def get_pos_tagger():
+    '''returns the pos tagger of this process (loaded the first time it's needed)'''
+    global pos_tagger
+    if pos_tagger is None:
+        # same tagger as nltk.pos_tag, which loads it again on every call
+        pos_tagger = nltk.tag.PerceptronTagger()
+    return pos_tagger
+
+def tag_sentence(full_sentence):
+    '''tags an entire sentence'''    
+    # convert our string sentence into a list
+    sentence = full_sentence.split()
+    # POS tag tokens
+    tagged = get_pos_tagger().tag(sentence)
+    return tagged
+
+
+class PartialSentence(object):
+    '''Token forms of the sentence being rebuilt in the 2nd pass.
+    Keeps track of the length of the lowercased and stripped joined sentence so that
+    sentence boundaries are detected by comparing character offsets instead of
+    joining all the tokens of the sentence again for every new token'''
+
+    def __init__(self, tokens=()):
+        # raw token forms of the partial sentence
+        self.tokens = []
+        # lowercased token forms
+        self._lowered = []
+        # state after each token: (joined length, leading white spaces, trailing white spaces, has non-white space,
+        # number of " ." in the joined sentence)
+        self._states = []
+        for tok in tokens:
+            self.append(tok)
+
+    def __len__(self):
+        '''returns the length of the lowercased and stripped joined sentence'''
+        if not self._states:
+            return 0
+        total, leading, trailing, has_text, spaced_dots = self._states[-1]
+        if not has_text:
+            return 0
+        return total - leading - trailing
+
+    def append(self, token):
+        '''adds a token form to the end of the partial sentence'''
+        lowered = token.lower()
+        total, leading, trailing, has_text, spaced_dots = self._states[-1] if self._states else (0, 0, 0, False, 0)
+        # account for the space joining the new token
+        sep = 1 if self._states else 0
+        total += sep
+        # " ." inside the token or made by the joining space
+        spaced_dots += lowered.count(u" .") + (1 if sep and lowered.startswith(u".") else 0)
+        if lowered.strip():
+            if not has_text:
+                leading = total + len(lowered) - len(lowered.lstrip())
+                has_text = True
+            trailing = len(lowered) - len(lowered.rstrip())
+        else:
+            # white space token, all of it is trailing (together with the joining space)
+            trailing += sep + len(lowered)
+        self._states.append((total + len(lowered), leading, trailing, has_text, spaced_dots))
+        self.tokens.append(token)
+        self._lowered.append(lowered)
+
+    def pop(self):
+        '''removes the last token form of the partial sentence'''
+        del self._states[-1]
+        del self._lowered[-1]
+        return self.tokens.pop()
+
+    def text(self):
+        '''returns the lowercased and stripped joined sentence'''
+        return " ".join(self._lowered).strip()
+
+    def matches(self, full_sentence):
+        '''checks if the partial sentence is the given (lowercased and stripped) full sentence'''
+        return len(self) == len(full_sentence) and self.text() == full_sentence
+
+    def matches_joined_dots(self, full_sentence):
+        '''checks if the partial sentence is the given (lowercased and stripped) full sentence once " ." is replaced by ".".
+        The sentences are only compared if their lengths can match: each " ." (at most the ones of the joined sentence) shortens it by 1'''
+        length = len(self)
+        spaced_dots = self._states[-1][4] if self._states else 0
+        if not length - spaced_dots <= len(full_sentence) <= length:
+            return False
+        return self.text().replace(u" .", u".") == full_sentence
+
+def complete_sentence(tokens, current_sentence, full_sentence, final_results):
+    '''completes the current sentence (PartialSentence, extended in place) based on the full sentence using the given tokens.
+    Returns the current sentence: the extended one if it wasn't completed, otherwise a new one with the extra tokens'''
+    logger = logging.getLogger()
+    #~ logger.info("inside complete sent | tokens list: \n{}".format(tokens))
+    completed = False
+    target_sent = full_sentence.lower().strip()
+
+    try:
+        for tok in tokens:          
+            # add token to current sentence
+            current_sentence.append(tok[0])
+            # add (token, lemma, pos) to final results by reference (i.e. no need to return final results)
+            final_results.append(tok[0], tok[1], tok[2])
+            if not completed and current_sentence.matches_joined_dots(target_sent):
+                # add end-of-sentence <eos> to final results by reference
+                final_results.append(*eos_token)
+                completed = True
+                current_sentence = PartialSentence()
+        #~ logger.info("sentence completed") 
+        # return remaining tokens from the splitting tokens if they are not part of this sentence.
+        #~ logger.info("leftover tokens:\n{}".format(current_sentence))
+        return current_sentence
+    except:
+        logger.error("ERROR| inside complete Sentence with full sent: {}".format(full_sentence))
+        raise       
+
+def format_tokens(body):
+    '''Formats the tokens of the cleanup results (TokenStore) as lines of a clean file (encoded in utf-8)'''
+    # each string of the vocabulary is encoded once
+    # lemma and pos are lowercased once encoded, i.e. only their ascii letters are lowercased
+    utf8, utf8_lower = body.vocabulary.encoded()
+    ids = iter(body.ids)
+    return "".join("{0}\t{1}\t{2}\n".format(utf8[form_id], utf8_lower[lemma_id], utf8_lower[pos_id])
+                   for form_id, lemma_id, pos_id in itertools.izip(ids, ids, ids))
+
+def format_results(header, body):
+    '''Formats the cleanup results (TokenStore) as the content of a clean file (encoded in utf-8)'''
+    return header.encode('utf8') + format_tokens(body)
+
+def format_text_header(header):
+    '''Formats the 1st line of the text version of the cleanup results encoded in utf-8'''
+    # 1st column of the header followed by an empty line
+    return "{0}\n\n".format(header.split("\t")[0].encode('utf8'))
+
+def text_forms(body):
+    '''returns the forms (encoded in utf-8) of the cleanup results (TokenStore) that are part of their text version'''
+    utf8 = body.vocabulary.encoded()[0]
+    forms = (utf8[form_id] for form_id in body.ids[0::3])
+    # skip tokens that contain < since they are either html tags or end-of-sentence markers
+    # skip "q!" tokens 
+    return list(form for form in forms if form != "q!" and "<" not in form)
+
+def format_text(header, body):
+    '''Formats the text version of the cleanup results (the same as generate_text_files.py does) encoded in utf-8'''
+    return format_text_header(header) + " ".join(text_forms(body))
+
+class SentenceAligner(object):
+    '''2nd pass over the tokens of a text file: aligns the tokens with the sentences found by the sentence tokenizer,
+    tags and lemmatizes the tokens that need it, splits malformed tokens around sentence boundaries and adds
+    the end-of-sentence tokens to the results (TokenStore).
+    The sentences can be added all at once or in batches (streaming mode), the sentence being rebuilt is kept between batches'''
+
+    def __init__(self, cleaner, results):
+        self.cleaner = cleaner
+        self.results = results
+        # full sentences, the ones before the current sentence index are complete
+        self.sentences = []
+        # tagged full sentences (batch mode only) keyed by their index, sentences missing here are tagged when needed
+        self.pretagged = {}
+        # index of the current full sentence
+        self.sent_idx = 0
+        # variable to which we append our tokens to recreate the sentence 
+        # based on boundaries set using the NLTK sentence tokenizer
+        self.current_sentence = PartialSentence()
+        # variable for the tagged full sentence, to be used for tokens cleaned in the 1st pass
+        # the full sentence is tagged at most once and reused for all its tokens
+        self.tagged_sentence = []
+        # index of toekn within the current full sentence
+        self.token_idx = -1
+
+    def add_sentences(self, sentences, pretagged):
+        '''adds full sentences after the remaining ones, along with their tagged versions keyed by their index in the given list'''
+        # forget the complete sentences
+        completed = self.sent_idx
+        del self.sentences[:completed]
+        self.pretagged = dict((idx - completed, tagged) for idx, tagged in self.pretagged.items() if idx >= completed)
+        self.pretagged.update((len(self.sentences) + idx, tagged) for idx, tagged in pretagged.items())
+        self.sentences.extend(sentences)
+        self.sent_idx = 0
+
+    def align(self, document):
+        '''aligns the tokens of the document (TokenStore) with the sentences until all of them are complete.
+        Returns the number of tokens that were aligned'''
+        logger = logging.getLogger()
+        clock = time.time
+        cleaner = self.cleaner
+        nul_sub = cleaner.nul_sub
+        stage_stats = cleaner.stage_stats
+        # the stages of the tokens are only timed if profile_stages is set, otherwise their time is part of align
+        profile_stages = cleaner.profile_stages
+        lemmatize = cleaner.lemmatize
+        clean_malformed = cleaner.clean_malformed
+        results = self.results
+        token_ids = document.ids
+        vocabulary = document.vocabulary
+        vocabulary_id = vocabulary.id
+        strings = vocabulary.strings
+        sentences_list = self.sentences
+        pretagged = self.pretagged
+        current_sentence = self.current_sentence
+        tagged_sentence = self.tagged_sentence
+        sent_idx = self.sent_idx
+        token_idx = self.token_idx
+        # index of the full sentence for which the comparison target was computed
+        target_idx = -1
+        aligned = len(document)
+        # start processing tokens
+        try:
+            #do sth
+            for idx in range(0,len(document)):
+                
+                # If the sentence index has exceeded the length of sentences, exit loop
+                if sent_idx == len(sentences_list):
+                    aligned = idx
+                    break
+                token_idx += 1    
+                form_id = token_ids[3 * idx]
+                lemma_id = token_ids[3 * idx + 1]
+                pos_id = token_ids[3 * idx + 2]
+                token_form = strings[form_id]
+                full_sentence = sentences_list[sent_idx]
+                if target_idx != sent_idx:
+                    # lowercased and stripped full sentence to compare the current partial sentence to
+                    target_sentence = full_sentence.lower().strip()
+                    target_idx = sent_idx
+                # add to current partial sentence
+                current_sentence.append(token_form)
+                
+                token_lemma = strings[lemma_id]
+                token_pos = strings[pos_id]
+                
+                # replace NUL characters (white spaces) in lemma column
+                if nul_char in token_lemma:
+                    token_lemma = token_lemma.replace(nul_char, nul_sub)
+                    lemma_id = vocabulary_id(token_lemma)
+
+                # add token info to final results     
+                results.extend_ids((form_id, lemma_id, pos_id))
+                
+                # compare current partial sentence to full sentence to detect end of sentence
+                # (the sentences are compared only if their lengths match)
+                is_eos = current_sentence.matches(target_sentence) # end of sentence marker 
+                
+                # check if current token was cleaned in 1st pass but not tagged and lemmatized
+                # skip tokens were the form is @ (special replacement token added by COHA creators for legal reasons)
+                # skip tokens that contain "." since those will be handled by the sentence boundary code block
+                prev_cleaned = (strings[token_ids[3 * idx + 1]] == "<temp>" or token_lemma == nul_sub or token_pos == nul_sub)
+                needs_tag_lemma = (prev_cleaned and token_form != "@" and not is_eos)
+                if needs_tag_lemma:
+                    # tag and lemmatize the current token based on its pos and position in sentence
+                    # (tag the full sentence only if it hasn't been tagged yet)
+                    if not tagged_sentence:
+                        if profile_stages:
+                            start = clock()
+                        tagged_sentence = pretagged[sent_idx] if sent_idx in pretagged else tag_sentence(full_sentence)
+                        if profile_stages:
+                            stage_stats.add("tag_sentence", start, 0 if sent_idx in pretagged else 1)
+                    # lemmatize token
+                    if token_idx < len(tagged_sentence):
+                        if profile_stages:
+                            start = clock()
+                        new_token_info = lemmatize(token_form, tagged_sentence, token_idx)
+                        if profile_stages:
+                            stage_stats.add("lemmatize", start)
+                    else:
+                        if prev_cleaned:
+                            new_token_info = (token_form, token_form, token_pos)    
+                    # replace the token info in the final results
+                    results.pop()
+                    results.append(*new_token_info)
+                    # ~ logger.info("{} was tagged and lemmatized successfully.".format(token_form))    
+                          
+                # check if end of sentence    
+                if is_eos:
+                    # end of sentence reached, reset current partial sentence
+                    current_sentence = PartialSentence()
+                    # reset the tagged full sentence
+                    tagged_sentence = []
+                    # add eos token to the final results
+                    results.append(*eos_token)
+                    token_idx = -1
+                    sent_idx += 1                                    
+                else:
+                    # check if current sentence has passed the boundaries of the full sentence
+                    if len(current_sentence) > len(full_sentence):
+                        # check if malformed token and fix it
+                        if profile_stages:
+                            start = clock()
+                        is_malformed_matches = is_malformed(token_form, False)
+                        if profile_stages:
+                            stage_stats.add("is_malformed", start)
+                        if is_malformed_matches and token_form.lower()!= "q!":
+                            # malformed token found
+                            # 1. remove malformed token from the current sentence and final results then split it
+                            current_sentence.pop()
+                            results.pop()
+                            if not tagged_sentence:
+                                if profile_stages:
+                                    start = clock()
+                                tagged_sentence = pretagged[sent_idx] if sent_idx in pretagged else tag_sentence(full_sentence)
+                                if profile_stages:
+                                    stage_stats.add("tag_sentence", start, 0 if sent_idx in pretagged else 1)
+                            if profile_stages:
+                                start = clock()
+                            split_tokens = clean_malformed(token_form, False, full_sentence, tagged_sentence)
+                            if profile_stages:
+                                stage_stats.add("clean_malformed", start)
+                            #~ logger.info("split_tokens \n {}".format(split_tokens))
+                            # 2. add the split tokens until sentence is complete and reset the current sentence
+                            current_sentence = complete_sentence(split_tokens, current_sentence, full_sentence, results)
+                            # 3. we completed the sentence so reset the tagged sentence
+                            # 3.2 reset the tagged full sentence and token index
+                            tagged_sentence = []
+                            token_idx = -1
+                            # 3.3 get next full sentence by moving the iterator
+                            sent_idx += 1
+        except:
+            logger.error("ERROR| Current Sentence: {}".format(current_sentence.tokens))
+            raise
+        self.current_sentence = current_sentence
+        self.tagged_sentence = tagged_sentence
+        self.sent_idx = sent_idx
+        self.token_idx = token_idx
+        return aligned
+
+class CohaCleaner(object):
+    '''Cleans the tagged files of COHA with the given options.
+    The cleaner keeps the caches (lemmas, cleaned lines and the vocabulary of the tokens) and the stage stats
+    of the files it cleans, so one cleaner should be built per process and reused for all files'''
+
+    def __init__(self, rm_null=True, mal_pos=u"<sub>", nul_sub=u"<nul>", batch_tag=False,
+                 lemma_cache_size=100000, line_cache_size=100000, max_vocabulary_size=1000000, record_new_lemmas=False,
+                 profile_stages=False):
+        # remove null tokens (tokens with the pos "null" and a form with control chars, e.g. <P>)
+        self.rm_null = rm_null
+        # pos of malformed tokens that are not valid words (unicode)
+        self.mal_pos = mal_pos
+        # lemma/pos replacement text for columns that are nul (unicode)
+        self.nul_sub = nul_sub
+        # POS tag all sentences of a file that need tagging (with tag_sents) before aligning its tokens
+        self.batch_tag = batch_tag
+        # lemma cache of this cleaner (worker processes inherit it warm-started)
+        # the lemmas it computes are recorded only if they are handed over to be saved (see LemmaCache.pop_new_entries)
+        self.lemma_cache = LemmaCache(lemma_cache_size, record_new_lemmas)
+        # time spent in each stage of the cleaning
+        self.stage_stats = StageStats()
+        # also time the stages of each line and token (decode, classify, is_malformed, clean_malformed, lemmatize and the tagging
+        # of single sentences). Otherwise only the stages of each file are timed and the time of these stages is part of read and align
+        self.profile_stages = profile_stages
+        # vocabulary of the tokens of the files, it's replaced (along with the line cache) between files
+        # once it has more than max_vocabulary_size strings
+        self.vocabulary = Vocabulary()
+        self.max_vocabulary_size = max_vocabulary_size
+        # 1st pass results (vocabulary ids of the tokens) of the cleaned lines, keyed by the raw line
+        # (the cleaning parameters are the same for all lines). It holds the first line_cache_size distinct lines: once it's
+        # full, new lines aren't added and no line is evicted (the frequent lines of COHA come up in the first files), which
+        # keeps lookups as cheap as a dict lookup. It's only emptied when the vocabulary is replaced
+        self.line_cache = {}
+        self.line_cache_size = line_cache_size
+        # HTMLparser to help decode html symbols
+        self.h_parser = HTMLParser.HTMLParser()
+
+    def load_resources(self):
+        '''loads the nltk sentence tokenizer, pos tagger and lemmatizer so that the first file isn't slower than the others.
+        Raises a LookupError if any of the nltk resources isn't available locally'''
+        missing_resources = check_nltk_resources()
+        if missing_resources:
+            raise LookupError("nltk resources not found: {0}".format(", ".join(missing_resources)))
+        get_sentence_tokenizer()
+        get_pos_tagger()
+        # wordnet is loaded by its first lookup
+        self.lemma_cache.load_lemmatizer().lemmatize(u"loaded")
+        return self
+
+    def tag_sentences(self, sentences_list, document):
+        '''tags all sentences that contain tokens (of the given TokenStore) which need tagging, before the tokens are aligned.
+        Returns a dictionary of tagged sentences with the sentence index as key'''
+        # get the forms of tokens that will be tagged in the 2nd pass:
+        # tokens cleaned in the 1st pass, tokens with nul lemma/pos and malformed tokens with "." and "'"
+        tag_forms = set()
+        for tok, lem, tok_pos in document:
+            lem = lem.replace(nul_char, self.nul_sub)
+            if lem == "<temp>" or lem == self.nul_sub or tok_pos == self.nul_sub or is_malformed(tok, False):
+                tag_forms.add(tok)
+        # get the sentences that contain at least one of these tokens
+        sent_indices = list(idx for idx, sent in enumerate(sentences_list) if tag_forms.intersection(sent.split()))
+        # POS tag only these sentences with the tagger of this process (loaded once, unlike nltk.pos_tag_sents)
+        # tag_sents is a single call but the perceptron tagger still tags the sentences one by one
+        tagged_sents = get_pos_tagger().tag_sents(list(sentences_list[idx].split() for idx in sent_indices))
+        return dict(zip(sent_indices, tagged_sents))
+
+    def lemmatize(self, token, tagged_sentence, token_idx):
+        '''lemmatizes a token given its pos tag and position in a sentence'''
+        logger = logging.getLogger()
+        result = []
+    
+        try:
+            #do
+    
+            # given the position of the token (it's index), get the token and its corresponding pos tag
+            # index is needed in case of multiple occurrences of the same token form in the sentence with different pos tags
+            tagged_token = tagged_sentence[token_idx]
+            wordnet_pos=get_wordnet_pos(tagged_token[1])
+            if tagged_token[0] == "-" or tagged_token[0] == "--":
+                lemma = tagged_token[0]
+                claws_pos = "z"
+            elif not tagged_token[0].isalpha():
+                 lemma = tagged_token[0]
+            else:
+               # use nltk post tags to lemmatize
+               lemma = self.lemma_cache.lemmatize(tagged_token[0], wordnet_pos)       
+            # ~ logger.info("inside lemmatize | current token and pos: {},{}".format(token,tagged_token[1]))
+            if tagged_token[1] == "":
+                tagged_token[1] = "nn"
+            # convert pos tag to CLAWS7 set and format as pos_<sub>
+            claws_pos = get_claws7_pos(tagged_token[1])
+            pos = u"{}_{}".format(claws_pos, self.mal_pos)
+            # return updated token info
+            return (tagged_token[0], lemma, pos)   
+        except:
+            logger.error(u"ERROR | Lemmatizing token: {} | idx: {} | Sent Length: {}".format(token,token_idx, len(tagged_sentence)))
+            raise
+   
+    def clean_malformed(self, token, first_pass=True,full_sentence="", tagged_sentence=None):
+        '''splits based on boundaries, tags pos and lemmatizes. 
+        In the 2nd pass, an already tagged full sentence can be given to avoid tagging it again'''
+        logger = logging.getLogger()
+        #~ logger.info("inside clean malformed | current token: {}".format(token))
+        result = []
+    
+        try:
+            #do    
+            if first_pass:
+                # split token based on malformed characters except .
+                temp_split = re.split(malformed_regex_pass1, token)
+                split_tokens = list(z for z in temp_split if z !='' and z != ' ')
+                # add tokens to the results with a <temp> lemma and POS 
+                # so that they're proprely tagged and lemmatized in the 2nd pass
+                temp = u"<temp>"
+                for tok in split_tokens:
+                    result.append((tok, temp, temp))  
+            else:
+                # 2nd pass
+                # split token based on all malformed characters including .
+                temp_split = re.split(malformed_regex_pass2, token)
+                split_tokens = list(z for z in temp_split if z !='' and z != ' ')       
+                # POS tag tokens (unless the full sentence was already tagged)
+                tagged = tagged_sentence
+                if tagged is None:
+                    tagged = tag_sentence(full_sentence)
+                #~ logger.info("split token into{}".format(split_tokens))
+           
+                # get the split and tagged tokens as a list
+                tagged_split_tokens = list(tok for tok in tagged if tok[0] in split_tokens)
+            
+                # lemmatize then add to results
+                for tok in tagged_split_tokens:
+                    # use nltk post tags to lemmatize
+                    if tok[1] == "":
+                        tok[1] = "nn"
+                    nltk_pos=get_wordnet_pos(tok[1])
+                    lemma = self.lemma_cache.lemmatize(tok[0], nltk_pos)
+                    # convert pos tag to CLAWS7 set and format as pos_<sub>
+                    claws_pos = get_claws7_pos(tok[1])
+                    if tok[0] == "-" or tok[0] == "--":
+                        claws_pos = "z"       
+                    pos = u"{}_{}".format(claws_pos, self.mal_pos)
+                    # add token information to results  
+                    result.append((tok[0], lemma, pos))
+                    # ~ logger.info("token cleaned successfully") 
+            # done processing, return results
+            return result
+        except:
+            logger.error("ERROR| Current Full Sentence: {}".format(full_sentence))
+            raise
+
+    def clean_line(self, line):
+        '''cleans a line of a tagged file (1st pass). Returns the (form, lemma, pos) of its tokens:
+        none if the line is skipped, several if it's a malformed token that was split'''
+        profile_stages = self.profile_stages
+        if profile_stages:
+            start = time.time()
+        # some tokens in COHA have no pos tag (a white space)
+        # we must replace these empty spaces using rstrip()
+        # using replace doesn't work, do not use it.                            
+        current_token_info = line.decode('cp1252').rstrip().split("\t")
+        if len(current_token_info) < 3:
+            current_token_info.append(self.nul_sub)    
+        if profile_stages:
+            start = self.stage_stats.add("decode", start)
+        
+        form = current_token_info[0]
+        lowered = form.lower()
+        # check if null token with form <> or <P>
+        if self.rm_null and (current_token_info[2].lower() == "null"):
+            if contais_control_chars(lowered):
+                #skip this token
+                if profile_stages:
+                    self.stage_stats.add("classify", start)
+                return ()
+        # plain tokens (most of COHA) don't need any of the fixes below except unifying the lemma of saute
+        if form.isalpha() or not first_pass_regex.search(form):
+            if lowered in saute_forms:
+                current_token_info[1] = "saute"
+            if profile_stages:
+                self.stage_stats.add("classify", start)
+            return (tuple(current_token_info),)
+        # skip lines where all fields are q!
+        if lowered == "q!":
+            if profile_stages:
+                self.stage_stats.add("classify", start)
+            return ()
+        if nul_char in form:
+            current_token_info[0] = self.nul_sub
+            lowered = self.nul_sub.lower()
+    
+    
+        if lowered in saute_forms:
+            # unify lemma
+            current_token_info[1] = "saute"
+        # decode html in token  (if html is detected)
+        contains_html = "&" in lowered and html_hex_regex.search(lowered)
+        if contains_html:
+            # ~ logger.info("{} contains html".format(current_token_info[0]))
+            current_token_info[0] = self.h_parser.unescape(current_token_info[0])
+            lowered = current_token_info[0].lower()
+
+        split_tokens = []    
+        if profile_stages:
+            start = self.stage_stats.add("classify", start)
+        # check if malformed token and fix it
+        is_malformed_matches = is_malformed(lowered)
+        if profile_stages:
+            start = self.stage_stats.add("is_malformed", start)
+        if is_malformed_matches and lowered != "q!":
+            split_tokens = self.clean_malformed(current_token_info[0])
+            if profile_stages:
+                self.stage_stats.add("clean_malformed", start)
+    
+        if len(split_tokens) > 1:
+            return tuple(split_tokens)
+        # no cleaning needed
+        return (tuple(current_token_info),)
+
+    def read_lines(self, lines, results, text_file_name=""):
+        '''1st pass over the given lines (without the header) of a text file: cleans each line and adds its tokens
+        to the results (TokenStore). Returns the number of lines read'''
+        logger = logging.getLogger()
+        vocabulary_id = results.vocabulary.id
+        clean_line = self.clean_line
+        line_cache = self.line_cache
+        # the time spent reading the zip file (and looking up cleaned lines) is the time of the 1st pass that isn't spent in its stages
+        first_pass_start = time.time()
+        first_pass_total = self.stage_stats.total()
+        line_count = 0
+        line_cache_misses = 0
+        '''
+        # *** first pass over tokens to read and clean them ***
+        # *** handles: "null" pos tag, sautee lemma, escaped html, malformed tokens without "." and "'"
+        '''
+        for line in lines:
+            line_count += 1
+            # lines that were already cleaned (by this cleaner) are looked up instead of cleaned again
+            cleaned = line_cache.get(line)
+            if cleaned is None:
+                line_cache_misses += 1
+                try:
+                    cleaned_tokens = clean_line(line)
+                    for token_info in cleaned_tokens:
+                        if len(token_info) < 3:
+                            raise ValueError("missing lemma or pos column")
+                    # vocabulary ids of the (form, lemma, pos) of the tokens (extra columns are ignored)
+                    cleaned = tuple(vocabulary_id(value) for token_info in cleaned_tokens for value in token_info[:3])
+                except:
+                    logger.error("ERROR during 1st pass over line {} in file {}".format(line, text_file_name))   
+                    raise             
+                if len(line_cache) < self.line_cache_size:
+                    line_cache[line] = cleaned
+            results.extend_ids(cleaned)
+        self.stage_stats.add_exclusive("read", first_pass_start, first_pass_total)
+        self.stage_stats.count("lines", line_count)
+        self.stage_stats.count("line_cache_hits", line_count - line_cache_misses)
+        self.stage_stats.count("line_cache_misses", line_cache_misses)
+        return line_count
+
+
+    def read_header(self, lines):
+        '''reads the 1st line of a text file (its header) from the given iterator over its lines and returns it decoded'''
+        start = time.time()
+        first_line = u""
+        header = next(lines, "")
+        if header:
+            first_line = header.decode('cp1252').replace(nul_char, self.nul_sub)
+            self.stage_stats.count("lines")
+        self.stage_stats.add("decode", start)
+        return first_line
+
+    def new_document(self):
+        '''returns an empty TokenStore for the tokens of a new text file'''
+        self.stage_stats.count("documents")
+        # the vocabulary is replaced between files once it's too large
+        # (the ids in the line cache refer to it, the tokens of previous files keep referring to the old one)
+        if len(self.vocabulary) > self.max_vocabulary_size:
+            self.vocabulary = Vocabulary()
+            self.line_cache = {}
+        return TokenStore(self.vocabulary)
+
+    def clean_document(self, lines, text_file_name=""):
+        '''cleans a text file given its lines (e.g. an opened zip member): its header followed by form \\t lemma \\t pos lines
+        encoded in cp1252. Returns the header and the cleaned tokens (TokenStore of (form, lemma, pos) with <eos> tokens).
+        The lemmas and pos tags are lowercased when the tokens are formatted (see format_results)'''
+        # time each stage of the processing (the time of the stages that aren't timed separately is part of the enclosing stage)
+        clock = time.time
+        stage_stats = self.stage_stats
+        #read text file into memory and clean it
+        lines = iter(lines)
+        results = self.new_document()
+        first_line = self.read_header(lines)
+        self.read_lines(lines, results, text_file_name)
+       
+        '''
+        # *** 2nd pass over tokens to clean them and define sentence boundaries ***
+        # *** handles: empty lemmas and pos tags, adding sentence boundaries, malformed tokens with "." and "'" around sentence boundaries.
+        '''
+        # if results are empty (file is empty), return only first line
+        if not results:
+            return first_line, results
+        
+        # tokens of the 1st pass (ids of their form, lemma and pos)
+        document = results
+        # reset resutls in order to add sentence boundaries where needed
+        results = TokenStore(document.vocabulary)
+        stage_stats.count("tokens", len(document))
+        start = clock()
+        # rebuild the sentences from the tokens list
+        text = u" ".join(document.forms())
+        # use a sentence tokenizer to get a list of all the sentences in the file
+        sentences_list = get_sentence_tokenizer().tokenize(text.strip())
+        stage_stats.add("sentence_tokenize", start)
+        stage_stats.count("sentences", len(sentences_list))
+        # the time spent aligning the tokens with the sentences is the time of the 2nd pass that isn't spent in its stages
+        second_pass_start = clock()
+        second_pass_total = stage_stats.total()
+        # tagged full sentences (batch mode only), sentences missing here are tagged when needed
+        pretagged = {}
+        if self.batch_tag:
+            start = clock()
+            pretagged = self.tag_sentences(sentences_list, document)
+            stage_stats.add("tag_sentence", start, len(pretagged))
+        # ~ logger.info(len(sentences_list))      
+        aligner = SentenceAligner(self, results)
+        aligner.add_sentences(sentences_list, pretagged)
+        aligner.align(document)
+        stage_stats.add_exclusive("align", second_pass_start, second_pass_total)
+        return first_line, results
+
+    def stream_document(self, lines, window_size=10000, text_file_name=""):
+        '''cleans a text file given its lines (like clean_document) in windows of lines (streaming mode).
+        The sentences of each window are found by the sentence tokenizer, except the last one which may be incomplete:
+        its text and tokens are kept and cleaned again along with the next window. 
+        Returns the header and an iterator over the cleaned tokens of each window (the same TokenStore, emptied before each window)'''
+        lines = iter(lines)
+        results = self.new_document()
+        first_line = self.read_header(lines)
+        return first_line, self._stream_windows(lines, window_size, results, text_file_name)
+
+    def _stream_windows(self, lines, window_size, results, text_file_name):
+        '''yields the cleaned tokens of each window of lines (see stream_document)'''
+        clock = time.time
+        stage_stats = self.stage_stats
+        # tokens of the 1st pass that weren't aligned with a complete sentence yet
+        document = TokenStore(results.vocabulary)
+        aligner = SentenceAligner(self, results)
+        # text of the last (incomplete) sentence
+        text = u""
+        is_last = False
+        while not is_last:
+            # read at least as many lines as there are pending tokens, so that a long incomplete sentence
+            # isn't sentence tokenized again for every window
+            window_start = len(document)
+            window_lines = max(window_size, window_start)
+            is_last = self.read_lines(itertools.islice(lines, window_lines), document, text_file_name) < window_lines
+            stage_stats.count("tokens", len(document) - window_start)
+            start = clock()
+            # add the new tokens to the text of the incomplete sentence
+            # (the text of the file is stripped, so is the text of the first sentence)
+            if len(document) > window_start:
+                new_text = u" ".join(document.forms(window_start))
+                text = u"{0} {1}".format(text, new_text) if text else new_text.lstrip()
+            spans = list(get_sentence_tokenizer().span_tokenize(text))
+            # the last sentence is complete only at the end of the file
+            last_start = len(text)
+            if spans and not is_last:
+                last_start = spans.pop()[0]
+            sentences_list = list(text[sent_start:sent_end] for sent_start, sent_end in spans)
+            text = text[last_start:]
+            stage_stats.add("sentence_tokenize", start)
+            stage_stats.count("sentences", len(sentences_list))
+            second_pass_start = clock()
+            second_pass_total = stage_stats.total()
+            pretagged = {}
+            if self.batch_tag:
+                start = clock()
+                pretagged = self.tag_sentences(sentences_list, document)
+                stage_stats.add("tag_sentence", start, len(pretagged))
+            aligner.add_sentences(sentences_list, pretagged)
+            # remove the aligned tokens and hand the results of the complete sentences over
+            document.remove_first(aligner.align(document))
+            stage_stats.add_exclusive("align", second_pass_start, second_pass_total)
+            yield results
+            results.clear()
+
+    def clean_zip(self, zip_path, text_file_names=None):
+        '''cleans the text files of a zip file of COHA (all of them or the given ones).
+        Yields the name, header and cleaned tokens (TokenStore) of each text file'''
+        with zipfile.ZipFile(zip_path, 'r') as current_zip:
+            for text_file_name in (text_file_names or current_zip.namelist()):
+                with current_zip.open(text_file_name, 'r') as lines:
+                    header, tokens = self.clean_document(lines, text_file_name)
+                yield text_file_name, header, tokens
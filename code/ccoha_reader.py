@@ -0,0 +1,236 @@
+'''
+@author: Reem Alatrash
+@version: 1.0
+=======================
+
+This module reads the clean tagged files of CCOHA (the output of clean-copy-coha.py) without unzipping them.
+The clean tagged directory can contain decade archives (cleaned_[decade].zip), shards of decades
+(cleaned_[decade]-[n].zip, see compress_del_folders.py --shard-size) or decade folders.
+
+A reader builds an index of the documents once, using the decade of their archive (or folder) and their file name
+(genre_year_id.txt, e.g. fic_1936_10080.txt). A document id found twice (e.g. in a decade folder and in the archive
+of the same decade, or in a shard left by an earlier sharding) is an error. It then yields the documents, sentences (split on <eos> tokens)
+or tokens that match the given decades, genres, years and document ids. The documents that don't match are never opened
+and each document is read lazily, line by line.
+
+Example:
+---------
+
+from ccoha_reader import CcohaReader
+with CcohaReader("/mount/resources/corpora/COHA/clean/tagged/") as reader:
+    for document, sentence in reader.sentences(genres=["fic", "mag"], years=range(1930, 1940)):
+        forms = [form for form, lemma, pos in sentence]
+
+'''
+
+'''
+******* ********* *********
+*******  imports  *********
+******* ********* *********
+'''
+import os
+import zipfile
+import collections
+import json
+
+'''
+******* ********* *********
+******* variables *********
+******* ********* *********
+'''
+# end-of-sentence token
+eos = u"<eos>"
+# metadata of a document and its location: the path of its decade archive or None if it's in a decade folder
+DocumentInfo = collections.namedtuple("DocumentInfo", ["decade", "genre", "year", "doc_id", "file_name", "location"])
+# a document read into memory: its metadata, its header and its (form, lemma, pos) tokens
+Document = collections.namedtuple("Document", ["info", "header", "tokens"])
+# arrays of a decade of a columnar export (see export_columnar.py) and the file names of its documents
+ColumnarDecade = collections.namedtuple("ColumnarDecade", ["forms", "lemmas", "pos", "sentences", "documents",
+                                                           "document_sentences", "genres", "years", "file_names"])
+
+'''
+******* ********* *********
+******* functions *********
+******* ********* *********
+'''
+
+def parse_file_name(text_file_name):
+    '''returns the genre, year and document id of a text file given its name (e.g. fic_1936_10080.txt).
+    The genre and year are None if the name doesn't have the form genre_year_id.txt'''
+    # extract genre and year from file name (e.g. fic_1817_8554.txt)
+    file_details = os.path.splitext(os.path.basename(text_file_name))[0].split("_")
+    if len(file_details) != 3:
+        return None, None, "_".join(file_details)
+    genre, year, doc_id = file_details
+    return genre, int(year) if year.isdigit() else None, doc_id
+
+def split_line(line):
+    '''returns the (form, lemma, pos) of a line of a clean tagged file'''
+    return tuple(line.decode('utf8').rstrip(u"\r\n").split(u"\t"))
+
+class CcohaReader(object):
+    '''Reads the documents of a clean tagged directory of CCOHA, filtered by decade, genre, year and document id.
+    The filters are containers (e.g. lists, sets or ranges of years), None matches all documents'''
+
+    def __init__(self, clean_path):
+        self.clean_path = clean_path
+        # documents in the order of their decades and of their archives
+        self.index = []
+        # positions in the index of the documents of each decade, genre and year
+        self.by_decade = collections.defaultdict(list)
+        self.by_genre = collections.defaultdict(list)
+        self.by_year = collections.defaultdict(list)
+        # position in the index of each document id
+        self.by_id = {}
+        # archives opened by this reader
+        self._open_zips = {}
+        self._build_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _build_index(self):
+        '''Lists the documents of the decade archives and folders (the documents themselves aren't read).
+        Raises a ValueError if a document id is found twice'''
+        for name in sorted(os.listdir(self.clean_path)):
+            path = os.path.join(self.clean_path, name)
+            if os.path.isdir(path):
+                decade = name
+                location = None
+                text_file_names = sorted(os.listdir(path))
+            elif name.startswith("cleaned_") and name.endswith(".zip"):
+                # decade archive (cleaned_[decade].zip) or shard (cleaned_[decade]-[n].zip)
+                decade = name[len("cleaned_"):-len(".zip")].split("-")[0]
+                location = path
+                with zipfile.ZipFile(path, 'r') as decade_zip:
+                    text_file_names = decade_zip.namelist()
+            else:
+                continue
+            for text_file_name in text_file_names:
+                genre, year, doc_id = parse_file_name(text_file_name)
+                if doc_id in self.by_id:
+                    first = self.index[self.by_id[doc_id]]
+                    raise ValueError("document {0} is both in {1} and in {2}".format(
+                        doc_id, first.location or os.path.join(self.clean_path, first.decade), path))
+                position = len(self.index)
+                self.index.append(DocumentInfo(decade, genre, year, doc_id, text_file_name, location))
+                self.by_decade[decade].append(position)
+                self.by_genre[genre].append(position)
+                self.by_year[year].append(position)
+                self.by_id[doc_id] = position
+
+    def close(self):
+        '''closes the archives opened by this reader'''
+        for decade_zip in self._open_zips.values():
+            decade_zip.close()
+        self._open_zips = {}
+
+    def select(self, decades=None, genres=None, years=None, doc_ids=None):
+        '''returns the metadata (DocumentInfo) of the documents that match the filters, in the order of the index'''
+        # positions of the documents that match all the filters
+        candidates = None
+        if doc_ids is not None:
+            candidates = set(self.by_id[doc_id] for doc_id in doc_ids if doc_id in self.by_id)
+        for values, positions in ((decades, self.by_decade), (genres, self.by_genre), (years, self.by_year)):
+            if values is None:
+                continue
+            matches = set()
+            for value, value_positions in positions.items():
+                if value in values:
+                    matches.update(value_positions)
+            candidates = matches if candidates is None else candidates & matches
+        positions = range(len(self.index)) if candidates is None else sorted(candidates)
+        return list(self.index[position] for position in positions)
+
+    def document_info(self, doc_id):
+        '''returns the metadata of the document with the given id'''
+        return self.index[self.by_id[doc_id]]
+
+    def open(self, info):
+        '''opens a document for reading its lines (as bytes). Decade archives are opened once and kept open'''
+        if info.location is None:
+            return open(os.path.join(self.clean_path, info.decade, info.file_name), 'rb')
+        if info.location not in self._open_zips:
+            self._open_zips[info.location] = zipfile.ZipFile(info.location, 'r')
+        return self._open_zips[info.location].open(info.file_name, 'r')
+
+    def read_header(self, info):
+        '''returns the header (1st line) of a document'''
+        with self.open(info) as lines:
+            return lines.readline().decode('utf8').rstrip(u"\r\n")
+
+    def read_tokens(self, info):
+        '''yields the (form, lemma, pos) tokens of a document, including the <eos> tokens'''
+        with self.open(info) as lines:
+            # skip the header
+            lines.readline()
+            for line in lines:
+                yield split_line(line)
+
+    def documents(self, decades=None, genres=None, years=None, doc_ids=None):
+        '''yields the documents (Document) that match the filters, each document is read into memory'''
+        for info in self.select(decades, genres, years, doc_ids):
+            with self.open(info) as lines:
+                header = lines.readline().decode('utf8').rstrip(u"\r\n")
+                tokens = list(split_line(line) for line in lines)
+            yield Document(info, header, tokens)
+
+    def sentences(self, decades=None, genres=None, years=None, doc_ids=None):
+        '''yields the (document info, sentence) of the documents that match the filters.
+        A sentence is a list of (form, lemma, pos) tokens without its <eos> token'''
+        for info in self.select(decades, genres, years, doc_ids):
+            sentence = []
+            for token in self.read_tokens(info):
+                if token[0] == eos:
+                    yield info, sentence
+                    sentence = []
+                else:
+                    sentence.append(token)
+            # tokens after the last <eos> token
+            if sentence:
+                yield info, sentence
+
+    def tokens(self, decades=None, genres=None, years=None, doc_ids=None):
+        '''yields the (document info, (form, lemma, pos)) of the tokens of the documents that match the filters,
+        including the <eos> tokens'''
+        for info in self.select(decades, genres, years, doc_ids):
+            for token in self.read_tokens(info):
+                yield info, token
+
+class ColumnarCorpus(object):
+    '''Reads a columnar export of CCOHA (see export_columnar.py). The vocabularies are read once and the arrays
+    of a decade are memory-mapped with numpy (requires numpy), i.e. they are only read when they are used'''
+
+    def __init__(self, columnar_path):
+        self.columnar_path = columnar_path
+        with open(os.path.join(columnar_path, "metadata.json")) as metadata_file:
+            self.metadata = json.load(metadata_file)
+        self.decades = sorted(self.metadata["decades"])
+        # strings of the forms, lemmas, pos tags and genres, indexed by id
+        self.vocabularies = dict((name, self._read_strings("{}.txt".format(name)))
+                                 for name in self.metadata["columns"] + ["genres"])
+
+    def _read_strings(self, *path):
+        '''returns the strings of a file of the export, one per line'''
+        with open(os.path.join(self.columnar_path, *path), 'rb') as strings_file:
+            return list(line.decode('utf8').rstrip(u"\n") for line in strings_file)
+
+    def decade(self, decade):
+        '''returns the arrays of a decade (ColumnarDecade of read-only numpy arrays)'''
+        import numpy
+        arrays = []
+        for name in ColumnarDecade._fields[:-1]:
+            path = os.path.join(self.columnar_path, decade, "{}.i32".format(name))
+            # numpy can't map an empty file
+            if os.path.getsize(path) == 0:
+                arrays.append(numpy.zeros(0, dtype=self.metadata["dtype"]))
+            else:
+                arrays.append(numpy.memmap(path, dtype=self.metadata["dtype"], mode='r'))
+        arrays.append(self._read_strings(decade, "documents.txt"))
+        return ColumnarDecade(*arrays)
@@ -0,0 +1,403 @@
+'''
+@author: Reem Alatrash
+@version: 1.0
+=======================
+
+This script checks that two ways of cleaning COHA produce byte-identical clean tagged files.
+It is used to make sure that faster cleaning options (or a modified clean-copy-coha.py) don't change the results.
+
+It can be used in three ways:
+1. run: cleans a sample of COHA (or all of it) twice, once with the reference script and arguments and once with the
+candidate script and arguments, then compares the outputs.
+2. compare: compares two existing outputs of clean-copy-coha.py.
+3. resume: like run, but the candidate run is killed once it has cleaned --kill-after text files and is then rerun
+with --resume, i.e. it checks that an interrupted run can be resumed (e.g. with --candidate-args="--zip-output").
+The check also fails unless the resumed run skips the text files that were done when it was killed.
+
+The outputs can be decade folders (clean/tagged/[decade]/) or decade archives (clean/tagged/cleaned_[decade].zip)
+(a document found twice in an output, e.g. in a decade folder and in its archive, is reported as duplicate)
+and are compared document by document and line by line without loading whole documents or decades into memory.
+For each differing document, the first divergent line is categorized (header, form, lemma, pos, mal_pos suffix,
+eos placement, columns, missing or extra lines) and the first divergence of all documents is reported along with
+its sentence context.
+The script exits with status 1 if the outputs differ or have duplicate documents (or if the candidate wasn't resumed).
+
+Example:
+---------
+
+python check_equivalence.py run "/mount/resources/corpora/COHA/" "T" "<sub>" "<nul>" --sample=20 --candidate-args="--batch-tag"
+python check_equivalence.py compare "/tmp/reference/clean/tagged/" "/tmp/candidate/clean/tagged/"
+python check_equivalence.py resume "/mount/resources/corpora/COHA/" "T" "<sub>" "<nul>" --sample=20 --candidate-args="--zip-output --checkpoint=1"
+
+'''
+
+'''
+******* ********* *********
+*******  imports  *********
+******* ********* *********
+'''
+import sys
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+import json
+import random
+import zipfile
+import collections
+from docopt import docopt
+try:
+    from itertools import izip_longest as zip_longest
+except ImportError:
+    from itertools import zip_longest
+
+'''
+******* ********* *********
+******* variables *********
+******* ********* *********
+'''
+usage = """Check that two ways of cleaning COHA produce identical clean tagged files.
+
+Usage:
+    check_equivalence.py run <coha_dir> <rm_Null> <mal_pos> <nul_sub> [options]
+    check_equivalence.py compare <reference_dir> <candidate_dir> [options]
+    check_equivalence.py resume <coha_dir> <rm_Null> <mal_pos> <nul_sub> [options]
+
+Arguments:
+    <coha_dir> = path to zipped COHA directory
+    <rm_Null> = Remove null tokens? Takes boolean values: T for True or  F for False.
+    <mal_pos> = pos for malformed tokens that are not valid words
+    <nul_sub> = lemma/pos replacement text for columns that are nul (unicode: \\x00)
+    <reference_dir> = clean tagged directory (decade folders or cleaned_<decade>.zip archives) of the reference
+    <candidate_dir> = clean tagged directory of the candidate
+
+Options:
+    --reference-script=<file>  cleaning script of the reference [default: clean-copy-coha.py]
+    --candidate-script=<file>  cleaning script of the candidate [default: clean-copy-coha.py]
+    --reference-args=<args>  extra arguments of the reference script [default: ]
+    --candidate-args=<args>  extra arguments of the candidate script [default: ]
+    --python=<path>  python interpreter that runs the scripts (default: this interpreter)
+    --sample=<n>  number of text files sampled from each zip file, 0 for all of them [default: 0]
+    --seed=<n>  seed of the random sample [default: 0]
+    --work-dir=<dir>  directory of the reference and candidate runs (default: a temporary directory that is removed)
+    --context=<n>  number of lines shown before and after the first divergence [default: 5]
+    --max-documents=<n>  number of differing documents listed in the report [default: 20]
+    --kill-after=<n>  resume: number of text files the candidate cleans before it is killed [default: 10]
+    --json=<file>  write the report to a json file
+
+"""
+# the cleaning scripts are run from this directory since they import modules using relative paths
+code_path = os.path.dirname(os.path.abspath(__file__))
+tagged_dir = "tagged"
+modified_tag_path = os.path.join("clean", "tagged")
+eos = b"<eos>"
+
+'''
+******* ********* *********
+******* functions *********
+******* ********* *********
+'''
+
+def sample_corpus(coha_path, run_path, sample, seed):
+    '''Creates the tagged directory of a run. All zip files are linked unless a sample of their text files is requested'''
+    source_path = os.path.join(coha_path, tagged_dir)
+    target_path = os.path.join(run_path, tagged_dir)
+    for path in [os.path.join(run_path, "clean", "tagged"), os.path.join(run_path, "clean", "text")]:
+        os.makedirs(path)
+    if not sample:
+        os.symlink(os.path.abspath(source_path), target_path)
+        return
+    os.makedirs(target_path)
+    # the same sample of text files is used for the reference and the candidate
+    rng = random.Random(seed)
+    for zip_file_name in sorted(x for x in os.listdir(source_path) if ".zip" in x):
+        with zipfile.ZipFile(os.path.join(source_path, zip_file_name), 'r') as source_zip:
+            infos = source_zip.infolist()
+            sampled = rng.sample(infos, min(sample, len(infos)))
+            with zipfile.ZipFile(os.path.join(target_path, zip_file_name), 'w') as target_zip:
+                # copy one text file at a time (with its original compression)
+                for info in sampled:
+                    target_zip.writestr(info, source_zip.read(info.filename))
+
+def cleaning_command(python, script, run_path, args, extra_args):
+    '''returns the command that runs a cleaning script on the corpus of a run'''
+    script = os.path.abspath(os.path.join(code_path, script))
+    return [python, script, os.path.join(run_path, ''), args['<rm_Null>'], args['<mal_pos>'], args['<nul_sub>']] + extra_args.split()
+
+def run_cleaning(python, script, run_path, args, extra_args):
+    '''Runs a cleaning script on the corpus of a run and returns its wall time (seconds)'''
+    command = cleaning_command(python, script, run_path, args, extra_args)
+    start = time.time()
+    status = subprocess.call(command, cwd=code_path)
+    # the script exits with status 1 if text files failed, these are counted and reported
+    if status != 0 and not (status == 1 and count_failed(run_path)):
+        raise RuntimeError("cleaning failed: {0}".format(" ".join(command)))
+    return time.time() - start
+
+def count_manifest_entries(run_path, status=None):
+    '''returns the number of entries (with the given status) of the manifest of a run that is in progress (the manifest is
+    written to clean_manifest.jsonl.tmp with --zip-output)'''
+    for manifest_name in ["clean_manifest.jsonl.tmp", "clean_manifest.jsonl"]:
+        manifest_path = os.path.join(run_path, "clean", manifest_name)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, 'r') as manifest_file:
+                return sum(1 for line in manifest_file if line.endswith("\n") and (status is None or json.loads(line)["status"] == status))
+    return 0
+
+def count_up_to_date(run_path):
+    '''returns the number of text files that a resumed run found up to date: the files of its manifest that it didn't clean
+    according to its stats'''
+    with open(os.path.join(run_path, "clean", "clean_stats.json"), 'r') as stats_file:
+        cleaned = json.load(stats_file)["text_files"]
+    return count_manifest_entries(run_path) - cleaned
+
+def run_interrupted(python, script, run_path, args, extra_args, kill_after):
+    '''Runs a cleaning script on the corpus of a run and kills it (along with its worker processes) once the manifest
+    lists kill_after text files, like a node that crashes. Returns the number of text files that the manifest lists as done when it was killed'''
+    command = cleaning_command(python, script, run_path, args, extra_args)
+    # the script and its workers get their own process group so that they can be killed together
+    process = subprocess.Popen(command, cwd=code_path, preexec_fn=os.setsid)
+    while process.poll() is None and count_manifest_entries(run_path) < kill_after:
+        time.sleep(0.05)
+    if process.poll() is not None:
+        raise RuntimeError("cleaning ended before it was killed, use a smaller --kill-after: {0}".format(" ".join(command)))
+    os.killpg(process.pid, signal.SIGKILL)
+    process.wait()
+    return count_manifest_entries(run_path, "done")
+
+def count_failed(run_path):
+    '''returns the number of text files that failed to clean according to the manifest of a run (0 if there's no manifest)'''
+    failed = 0
+    manifest_path = os.path.join(run_path, "clean", "clean_manifest.jsonl")
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as manifest_file:
+            for line in manifest_file:
+                if line.strip() and json.loads(line)["status"] == "failed":
+                    failed += 1
+    return failed
+
+def list_documents(clean_path):
+    '''returns the (decade, text file name) of the documents in a clean tagged directory along with their location
+    (the path of their decade archive or None if they are in a decade folder), and the documents found more than once
+    (e.g. in a decade folder and in its archive, or in a stale shard)'''
+    documents = {}
+    duplicates = set()
+    for name in sorted(os.listdir(clean_path)):
+        path = os.path.join(clean_path, name)
+        if os.path.isdir(path):
+            decade = name
+            text_file_names = os.listdir(path)
+            location = None
+        elif name.startswith("cleaned_") and name.endswith(".zip"):
+            # decade archive (cleaned_[decade].zip) or shard (cleaned_[decade]-[n].zip)
+            decade = name[len("cleaned_"):-len(".zip")].split("-")[0]
+            with zipfile.ZipFile(path, 'r') as decade_zip:
+                text_file_names = decade_zip.namelist()
+            location = path
+        else:
+            continue
+        for text_file_name in text_file_names:
+            if (decade, text_file_name) in documents:
+                duplicates.add((decade, text_file_name))
+            documents[(decade, text_file_name)] = location
+    return documents, duplicates
+
+def open_document(clean_path, document, location, open_zips):
+    '''opens a document for reading its lines (as bytes). Decade archives are opened once and kept open'''
+    decade, text_file_name = document
+    if location is None:
+        return open(os.path.join(clean_path, decade, text_file_name), 'rb')
+    if location not in open_zips:
+        open_zips[location] = zipfile.ZipFile(location, 'r')
+    return open_zips[location].open(text_file_name, 'r')
+
+def split_line(line):
+    '''returns the columns of a line of a clean tagged file'''
+    return line.rstrip(b"\r\n").split(b"\t")
+
+def is_eos(line):
+    '''checks if a line is an end-of-sentence marker'''
+    return line is not None and split_line(line)[0] == eos
+
+def mismatch_category(line_number, reference_line, candidate_line):
+    '''categorizes the difference between two lines of the same document'''
+    if line_number == 0:
+        return "header"
+    if reference_line is None:
+        return "extra lines"
+    if candidate_line is None:
+        return "missing lines"
+    if is_eos(reference_line) != is_eos(candidate_line):
+        return "eos placement"
+    reference = split_line(reference_line)
+    candidate = split_line(candidate_line)
+    if len(reference) != 3 or len(candidate) != 3:
+        return "columns"
+    if reference[0] != candidate[0]:
+        return "form"
+    if reference[1] != candidate[1]:
+        return "lemma"
+    # pos tags that only differ by the _<mal_pos> suffix of tokens cleaned using nltk
+    if reference[2].startswith(candidate[2] + b"_") or candidate[2].startswith(reference[2] + b"_"):
+        return "mal_pos suffix"
+    return "pos"
+
+def compare_documents(reference, candidate, context_size):
+    '''Compares two documents line by line. Returns None if they are identical, otherwise the first divergence
+    (category, line number, reference line, candidate line), its context and the number of differing lines'''
+    # lines of the current sentence before the divergence
+    context = collections.deque(maxlen=context_size)
+    divergence = None
+    following = ([], [])
+    differing_lines = 0
+    for line_number, (reference_line, candidate_line) in enumerate(zip_longest(reference, candidate)):
+        if divergence is None:
+            if reference_line == candidate_line:
+                if is_eos(reference_line):
+                    context.clear()
+                else:
+                    context.append(reference_line)
+                continue
+            divergence = (mismatch_category(line_number, reference_line, candidate_line), line_number,
+                          reference_line, candidate_line)
+        elif len(following[0]) < context_size:
+            following[0].append(reference_line)
+            following[1].append(candidate_line)
+        # the lines after the divergence are usually shifted, they are only counted
+        if reference_line != candidate_line:
+            differing_lines += 1
+    if divergence is None:
+        return None
+    return divergence, list(context), following, differing_lines
+
+def compare_outputs(reference_path, candidate_path, context_size):
+    '''Compares all documents of two clean tagged directories. Returns the report'''
+    reference_documents, reference_duplicates = list_documents(reference_path)
+    candidate_documents, candidate_duplicates = list_documents(candidate_path)
+    report = {"documents": 0, "identical": 0, "differing": [], "missing": [], "extra": [],
+              "duplicate": list("{0}: {1}".format(run, "/".join(document))
+                                for run, duplicates in [("reference", reference_duplicates),
+                                                        ("candidate", candidate_duplicates)]
+                                for document in sorted(duplicates)),
+              "categories": collections.Counter(), "differing_lines": 0, "first_divergence": None}
+    open_zips = {}
+    for document in sorted(set(reference_documents) | set(candidate_documents)):
+        name = "/".join(document)
+        if document not in candidate_documents:
+            report["missing"].append(name)
+            continue
+        if document not in reference_documents:
+            report["extra"].append(name)
+            continue
+        report["documents"] += 1
+        reference = open_document(reference_path, document, reference_documents[document], open_zips)
+        candidate = open_document(candidate_path, document, candidate_documents[document], open_zips)
+        try:
+            result = compare_documents(reference, candidate, context_size)
+        finally:
+            reference.close()
+            candidate.close()
+        if result is None:
+            report["identical"] += 1
+            continue
+        (category, line_number, reference_line, candidate_line), context, following, differing_lines = result
+        report["differing"].append(name)
+        report["categories"][category] += 1
+        report["differing_lines"] += differing_lines
+        if report["first_divergence"] is None:
+            report["first_divergence"] = {"document": name, "line": line_number, "category": category,
+                                          "reference": show(reference_line), "candidate": show(candidate_line),
+                                          "context": list(show(line) for line in context),
+                                          "reference_following": list(show(line) for line in following[0]),
+                                          "candidate_following": list(show(line) for line in following[1])}
+    for open_zip in open_zips.values():
+        open_zip.close()
+    report["categories"] = dict(report["categories"])
+    return report
+
+def show(line):
+    '''returns a printable version of a line (None if the document has no such line)'''
+    if line is None:
+        return None
+    return line.rstrip(b"\r\n").decode('utf8', 'replace')
+
+def print_report(report, max_documents):
+    '''prints a summary of the comparison'''
+    print("documents compared: {0} | identical: {1} | differing: {2} | differing lines: {3}".format(
+        report["documents"], report["identical"], len(report["differing"]), report["differing_lines"]))
+    print("missing from candidate: {0} | extra in candidate: {1} | duplicate: {2}".format(
+        len(report["missing"]), len(report["extra"]), len(report["duplicate"])))
+    if report["categories"]:
+        print("first divergence per document:")
+        for category, count in sorted(report["categories"].items(), key=lambda item: -item[1]):
+            print("    {0:<16}{1:>8}".format(category, count))
+    for label in ["differing", "missing", "extra", "duplicate"]:
+        for name in report[label][:max_documents]:
+            print("{0}: {1}".format(label, name))
+        if len(report[label]) > max_documents:
+            print("{0}: ... ({1} more)".format(label, len(report[label]) - max_documents))
+    divergence = report["first_divergence"]
+    if divergence:
+        print("first divergence: {document} line {line} ({category})".format(**divergence))
+        for line in divergence["context"]:
+            print("              {0}".format(line))
+        print("  reference > {0}".format(divergence["reference"]))
+        print("  candidate > {0}".format(divergence["candidate"]))
+        for label in ["reference", "candidate"]:
+            print("  {0} continues with:".format(label))
+            for line in divergence[label + "_following"]:
+                print("              {0}".format(line))
+
+def main():
+    args = docopt(usage)
+    context_size = int(args['--context'])
+    if args['compare']:
+        report = compare_outputs(args['<reference_dir>'], args['<candidate_dir>'], context_size)
+    else:
+        python = args['--python'] or sys.executable
+        work_dir = args['--work-dir'] or tempfile.mkdtemp(prefix="ccoha_equivalence_")
+        try:
+            run_times = {}
+            failed = {}
+            for run in ["reference", "candidate"]:
+                run_path = os.path.join(work_dir, run)
+                script = args['--{0}-script'.format(run)]
+                extra_args = args['--{0}-args'.format(run)]
+                sample_corpus(args['<coha_dir>'], run_path, int(args['--sample']), int(args['--seed']))
+                if run == "candidate" and args['resume']:
+                    # interrupt the candidate, then resume it
+                    killed_after = run_interrupted(python, script, run_path, args, extra_args, int(args['--kill-after']))
+                    print("candidate killed after {0} text files, resuming it".format(killed_after))
+                    extra_args += " --resume"
+                run_times[run] = run_cleaning(python, script, run_path, args, extra_args)
+                failed[run] = count_failed(run_path)
+                print("{0} cleaned in {1:.2f}s ({2} text files failed)".format(run, run_times[run], failed[run]))
+                if run == "candidate" and args['resume']:
+                    # the resumed run must skip the files that were done when it was killed
+                    up_to_date = count_up_to_date(run_path)
+                    print("candidate resumed with {0} text files up to date".format(up_to_date))
+            report = compare_outputs(os.path.join(work_dir, "reference", modified_tag_path),
+                                     os.path.join(work_dir, "candidate", modified_tag_path), context_size)
+            report["seconds"] = run_times
+            report["failed"] = failed
+            if args['resume']:
+                report["resume"] = {"killed_after": killed_after, "up_to_date": up_to_date}
+        finally:
+            if not args['--work-dir']:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    print_report(report, int(args['--max-documents']))
+    if args['--json']:
+        with open(args['--json'], 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+    identical = not (report["differing"] or report["missing"] or report["extra"] or report["duplicate"])
+    print("IDENTICAL" if identical else "DIFFERENT")
+    resumed = "resume" not in report or 0 < report["resume"]["killed_after"] <= report["resume"]["up_to_date"]
+    if not resumed:
+        print("NOT RESUMED: {0} text files were done when the candidate was killed, {1} were up to date when it was resumed".format(
+              report["resume"]["killed_after"], report["resume"]["up_to_date"]))
+    sys.exit(0 if identical and resumed else 1)
+
+if __name__ == "__main__":
+   main()
@@ -9,7 +9,11 @@ This is done in the following manner:
 2. POS tag and lemmatize the cleaned tokens.
 3. Write the results (a clean copy of the file) into a txt file under a folder with the corresponding decade.
 
+The cleaning itself is done by a CohaCleaner (see ccoha.py), this script distributes the text files
+over worker processes and writes the results.
+
 *Note: the code also logs processing information and errors to the file "clean_log.txt"
+and exits with status 1 if any text file failed (or, with --merge-shards, if any text file of a shard failed).
 
 Example:
 ---------
@@ -31,16 +35,14 @@ import zipfile
 import os
 from docopt import docopt
 import multiprocessing
-import HTMLParser
 import logging
 import time
-import re # regex library
-import nltk
-# download nltk libraries that are needed for tokenization, tagging and lemmatization
-nltk.download('wordnet')
-nltk.download('averaged_perceptron_tagger')
-nltk.download('punkt')
+import json
+import tempfile
 import codecs
+import cProfile
+import re
+from multiprocessing.util import Finalize
 from multiprocessing_logging import install_mp_handler
 
 '''
@@ -51,39 +53,17 @@ from multiprocessing_logging import install_mp_handler
 COHA_path = "/mount/resources/corpora/COHA/"
 tagged_dir = "tagged/"
 modified_tag_path = "clean/tagged/"
-malformed_chars = ['.', "'", '--',' ',':', ';', '*', '?','!']
-valid_apostrophs = ["n't","'s","'m","'d","'ve","'ing", "'ll", "etc."]
-
-# build regular expression to be used to detect malformed tokens
-# exclude 1st two chars (. and ') since they are handled in the 2nd pass over the data
-malformed_regex_pass1 = re.compile("({0})".format('|'.join(re.escape(item) for item in malformed_chars[2:])))
-# 2nd pass consider all chars
-malformed_regex_pass2 = re.compile("({0})".format('|'.join(re.escape(item) for item in malformed_chars)))
-html_hex_regex = re.compile("(&\w+;|&#[0-9]+;)")
-saute_forms = ["sauteed","sauted","saut","saute","sauteing","sautes","sauting"]
-
-# initialize the punkt sentence tokenizer 
-sentence_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
-# add special abbreviations to prevent tokenization errors
-extra_abbreviations = ['dr', 'vs', 'mr', 'mrs', 'prof', 'inc', 'i.e', 'e.g', 'p.k', 'c.c.f', 'm.c', 'etc',
-                       'o.k', 'fr', 'acct', 'co', 'd.o.a', 'approx', 'ave', 'bros', 'sq', 'st', 'd.j']
-# update the default abbreviations set _params.abbrev_types by adding the above abbreviations to it
-sentence_tokenizer._params.abbrev_types.update(extra_abbreviations)
-
-# add control chars for tokens where pos tag = "null"
-'''
-# ASCII device control characters that cause splitting errors:
-horizontal tab, line feed, and carriage return
-Read more here: https://www.w3schools.com/charsets/ref_html_ascii.asp
-We added the chars non-breaking space and < to ignore white spaces and html tags like <> and <P>
-'''
-control_chars = ['&nbsp;', '&#10;', '&#13;', '&#09;', '<']
+text_path = "clean/text/"
+manifest_file_name = "clean/clean_manifest.jsonl"
+stats_file_name = "clean/clean_stats.json"
+index_dir_name = "clean/index/"
+shard_dir_name = "clean/shards/"
     
 # Get the arguments as global variables
 args = docopt("""Extract contexts from COHA.
 
 Usage:
-    clean-copy-coha.py <coha_dir> <rm_Null> <mal_pos> <nul_sub>                 
+    clean-copy-coha.py <coha_dir> <rm_Null> <mal_pos> <nul_sub> [options]
     
 Arguments:       
     <coha_dir> = path to zipped COHA directory
@@ -91,16 +71,92 @@ Arguments:
     <mal_pos> = pos for malformed tokens that are not valid words
     <nul_sub> = lemma/pos replacement text for columns that are nul (unicode: \x00)
 
+Options:
+    --batch-tag  POS tag all sentences of a file that need tagging (with tag_sents) before aligning its tokens
+    --lemma-cache=<file>  file used to warm-start the lemma cache and to save it at the end of the run
+    --lemma-cache-size=<n>  maximum number of (form, pos) lemmas cached per process (0: no cache) [default: 100000]
+    --line-cache-size=<n>  cache the 1st pass results of the first <n> distinct lines of each process (lines are never evicted) [default: 100000]
+    --processes=<n>  number of worker processes (default: number of CPUs)
+    --chunk-size=<n>  number of text files sent to a worker process at once [default: 8]
+    --manifest=<file>  manifest of processed text files (default: <coha_dir>/clean/clean_manifest.jsonl)
+    --resume  skip text files that were cleaned by a previous run with the same input and parameters
+    --zip-output  write clean files directly into one zip archive per decade (cleaned_<decade>.zip) instead of decade folders
+    --checkpoint=<s>  with --zip-output, save the clean files every <s> seconds, so that a killed run can be resumed from them [default: 60]
+    --text-output  also write the text version of the clean files under clean/text/ (like generate_text_files.py)
+    --stream  clean each file in windows of lines and write its sentences as they are completed (bounded memory for large files)
+    --window-size=<n>  number of lines read at a time in streaming mode [default: 10000]
+    --dry-run  list the text files that would be cleaned and exit
+    --stats=<file>  json summary of the time spent in each stage of the cleaning (default: <coha_dir>/clean/clean_stats.json)
+    --profile-stages  also time the stages of each line and token in the stats (slower), not only the stages of each file
+    --profile=<dir>  profile each worker process using cProfile and save its profile under the given directory
+    --index  count the lemma and form frequencies (per decade and genre) and index the documents of each lemma while cleaning
+    --index-dir=<dir>  directory of the index (default: <coha_dir>/clean/index/)
+    --shard=<i/n>  clean only the i-th (0 to n-1) of n parts of the text files, e.g. on one of n nodes sharing the COHA directory
+    --merge-shards=<n>  assemble the outputs of the n shards of a sharded run (archives, manifests, stats, lemma caches, index) and exit
+    --log-level=<level>  level of the log: DEBUG, INFO, WARNING or ERROR [default: INFO]
+    --log-every=<n>  log the processing of every n-th text file of each worker process (0: none) [default: 1]
+
 """)
 
 COHA_path = args['<coha_dir>']
 rmNull = True if str(args['<rm_Null>']).lower() == 't' else False 
-mal_pos = args['<mal_pos>']
-nul_sub = args['<nul_sub>']
+# the tokens are unicode from the moment they are read until they are written (encoded in utf-8)
+mal_pos = args['<mal_pos>'].decode('utf8')
+nul_sub = args['<nul_sub>'].decode('utf8')
+batch_tag = args['--batch-tag']
+lemma_cache_path = args['--lemma-cache']
+lemma_cache_size = int(args['--lemma-cache-size'])
+line_cache_size = int(args['--line-cache-size'])
+number_of_processes = int(args['--processes'] or multiprocessing.cpu_count())
+chunk_size = int(args['--chunk-size'])
 # append an / to the end of given paths if it's missing
 os.path.join(COHA_path, '')
 # create zip file path
 zip_file_path = "{0}{1}".format(COHA_path,tagged_dir)
+manifest_path = args['--manifest'] or "{0}{1}".format(COHA_path, manifest_file_name)
+resume = args['--resume']
+zip_output = args['--zip-output']
+checkpoint_seconds = float(args['--checkpoint'])
+text_output = args['--text-output']
+stream = args['--stream']
+window_size = max(int(args['--window-size']), 1)
+dry_run = args['--dry-run']
+stats_path = args['--stats'] or "{0}{1}".format(COHA_path, stats_file_name)
+profile_stages = args['--profile-stages']
+profile_path = args['--profile']
+build_index = args['--index']
+index_path = args['--index-dir'] or "{0}{1}".format(COHA_path, index_dir_name)
+shard = args['--shard']
+shard_index, number_of_shards = (int(part) for part in shard.split("/")) if shard else (0, 1)
+merge_shards = int(args['--merge-shards']) if args['--merge-shards'] else None
+log_level = args['--log-level'].upper()
+if log_level not in ["DEBUG", "INFO", "WARNING", "ERROR"]:
+    sys.exit("ERROR | invalid --log-level: {} (choose from: DEBUG, INFO, WARNING, ERROR)".format(args['--log-level']))
+log_every = int(args['--log-every'])
+# files of the worker processes' indexes (clean_index_[process id][.shard[i]].pickle)
+worker_index_regex = re.compile(r"clean_index_\d+{0}\.pickle$".format(re.escape(".shard{0}".format(shard_index) if shard else "")))
+# decade archives of the shards (clean/shards/[tagged|text]/cleaned_[decade].shard[i].zip)
+shard_archive_regex = re.compile(r"cleaned_(.+)\.shard(\d+)\.zip$")
+# prefix of the temporary files of the documents written in parts with --zip-output --stream (partial[.shard[i]]_*.tmp)
+partial_prefix = "partial{0}_".format(".shard{0}".format(shard_index) if shard else "")
+
+# import the cleaning module and nltk once the arguments are parsed (--help shouldn't wait for them)
+import nltk
+from ccoha import CohaCleaner, CorpusIndex, check_nltk_resources, format_results, format_tokens, format_text, format_text_header, text_forms
+
+# cleaner of this process (worker processes inherit it along with its warm-started lemma cache)
+# the workers hand the lemmas they compute over to the main process only if the lemma cache is saved
+cleaner = CohaCleaner(rm_null=rmNull, mal_pos=mal_pos, nul_sub=nul_sub, batch_tag=batch_tag,
+                      lemma_cache_size=lemma_cache_size, line_cache_size=line_cache_size,
+                      record_new_lemmas=lemma_cache_path is not None, profile_stages=profile_stages)
+# cProfile profiler of this process (--profile only)
+profiler = None
+# index of the files cleaned by this process (--index only)
+corpus_index = None
+# zip files opened by this process
+open_zips = {}
+# number of text files processed by this process (--log-every)
+processed_files = 0
 
 '''
 ******* ********* *********
@@ -108,495 +164,706 @@ zip_file_path = "{0}{1}".format(COHA_path,tagged_dir)
 ******* ********* *********
 '''
 
-def contais_control_chars(token):
-	'''returns true if token form contains unicode control characters'''
-	contains_chars = False
-	for char in control_chars:
-		if char.lower() in token.lower():
-			#skip this token
-			contains_chars =  True
-	return contains_chars
-	
-def get_wordnet_pos(treebank_tag):
-    ''' returns WORDNET compliant POS tag '''
-    # WordNet POS tags are: NOUN = 'n', ADJ = 's', VERB = 'v', ADV = 'r', ADJ_SAT = 'a'
-    # Descriptions (c) https://web.stanford.edu/~jurafsky/slp3/10.pdf
-    if treebank_tag.startswith('J') or treebank_tag == "PDT" or treebank_tag == "RP":
-        return nltk.corpus.wordnet.ADJ
-    elif treebank_tag.startswith('V'):
-        return nltk.corpus.wordnet.VERB
-    elif treebank_tag.startswith('N'):
-        return nltk.corpus.wordnet.NOUN
-    elif treebank_tag.startswith('R') or treebank_tag == "IN" or treebank_tag == "EX":
-        return nltk.corpus.wordnet.ADV  
-    else:
-        # As default pos in lemmatization is Noun
-        return nltk.corpus.wordnet.NOUN
-
-def get_claws7_pos(treebank_tag):
-    '''maps nltk a treebank pos tag to CLAWS7'''
-    # Create a map between Treebank (used by nltk pos tagger) and CLAWS7 tagsets
-    # CLAWS7 tag description (c) http://ucrel.lancs.ac.uk/claws7tags.html
-    nltk_to_claws7 = {
-            'CC':'CC', # coordin. conjunction (and, but, or)  
-            'CD':'MC', # cardinal number (one, two)             
-            'DT':'DD', # determiner (a, the)                    
-            'EX':'EX', # existential 'there' (there)           
-            'FW':'FW', # foreign word (mea culpa)             
-            'IN':'II', # preposition/sub-conj (of, in, by)   
-            'JJ':'JJ', # adjective (yellow)                  
-            'JJR':'JJR', # adj., comparative (bigger)          
-            'JJS':'JJT', # adj., superlative (wildest)           
-            'LS':'MC', # list item marker (1, 2, One)          
-            'MD':'VM', # modal (can, should)                    
-            'NN':'NN1', # noun, sing. or mass (llama)          
-            'NNS':'NN2', # noun, plural (llamas)                  
-            'NNP':'NP1', # proper noun, sing. (IBM)              
-            'NNPS':'NP2', # proper noun, plural (Carolinas)
-            'PDT':'DB', # predeterminer (all, both)            
-            'POS':'GE', # possessive ending ('s ) 
-            'PRP':'PRP', # personal pronoun (I, you, he) 
-            # the general tag PRP does NOT exist in CLAWS7 which has a different tag for each case        
-            'PRP$':'APPGE', # possessive pronoun (your, one's)    
-            'RB':'RR', # adverb (quickly, never)            
-            'RBR':'RRR', # adverb, comparative (faster)        
-            'RBS':'RRT', # adverb, superlative (fastest)     
-            'RP':'RP', # particle (up, off)
-            'SYM':'Y', # symbol (+,%, &)
-            # 'Y' is a general COHA tag for punctuation and other symbols. It does NOT exist in CLAWS7
-            'TO':'TO', # "to" (to)
-            'UH':'UH', # interjection (ah, oops)
-            'VB':'VV0', # verb base form (eat)
-            'VBD':'VVD', # verb past tense (ate)
-            'VBG':'VVG', # verb gerund (eating)
-            'VBN':'VVN', # verb past participle (eaten)
-            'VBP':'VV0', # verb non-3sg pres (eat)
-            'VBZ':'VVZ', # verb 3sg pres (eats)
-            'WDT':'DDQ', # wh-determiner (which, that)
-            'WP':'PNQ', # wh-pronoun (what, who)
-            # the general tag PNQ does NOT exist in CLAWS7 which has a different tag for each case 
-            'WP$':'PNQ', # possessive (wh- whose)
-            'WRB':'RRQ', # wh-adverb (how, where)
-            '$':'Y', #  dollar sign ($)
-            '#':'Y', # pound sign (#)
-            '"':'Y', # left quote (' or ")
-            '"':'Y', # right quote (' or ")
-            '(':'Y', # left parenthesis ([, (, {, <)
-            ')':'Y', # right parenthesis (], ), }, >)
-            ',':'Y', # comma (,)
-            '.':'Y', # sentence-final punc (. ! ?)
-            ':':'Y', # mid-sentence punc (: ; ... -)
-            "''":'Y' # apostrophe punc
-        }
-    claws_tag = "" 
-    # if the pos tag can be mapped, return claws tag,
-    # else return the nltk pos tag unchanged
-    if treebank_tag.upper() in nltk_to_claws7:
-        claws_tag = nltk_to_claws7[treebank_tag.upper()]
-    else:
-        claws_tag = treebank_tag
-    
-    return claws_tag.lower()
-
-def is_malformed(token, first_pass=True):
-    '''checks if given string token contains chars corresponding to malformed tokens'''
-    # check if token contains at least 1 alphabet
-    alphabet_regex = re.compile("(?=.*[a-z])")
-    contains_alphabet = re.search(alphabet_regex,token)
-    matches = None
-    if contains_alphabet:
-        # first pass over data ignores . since we are looking at each token
-        # 2nd pass considers only sentence boundaries so look for .
-        if first_pass:
-            malformed_regex = malformed_regex_pass1
-        else:    
-            malformed_regex = malformed_regex_pass2
-        # use regex search to return a list of all malformed chars in token
-        matches = re.findall(malformed_regex,token)  
-        # skip valid apostrophe uses
-        for pattern in valid_apostrophs:
-            if pattern in token:
-                matches = None         
-    return matches  
-
-def tag_sentence(full_sentence):
-    '''tags an entire sentence'''    
-    # convert our string sentence into a list
-    sentence = full_sentence.split()
-    # POS tag tokens
-    tagged = nltk.pos_tag(sentence)
-    return tagged
-
-def lemmatize(token, tagged_sentence, token_idx):
-    '''lemmatizes a token given its pos tag and position in a sentence'''
+def get_profiler():
+    '''returns the profiler of this process, which saves its profile when the process exits'''
+    global profiler
+    if profiler is None:
+        profiler = cProfile.Profile()
+        Finalize(None, save_profile, exitpriority=10)
+    return profiler
+
+def save_profile():
+    '''saves the profile of this process under the profile directory'''
+    profiler.dump_stats(os.path.join(profile_path, "clean_profile_{0}.prof".format(os.getpid())))
+
+def get_corpus_index():
+    '''returns the index of this process, which is saved under the index directory when the process exits'''
+    global corpus_index
+    if corpus_index is None:
+        corpus_index = CorpusIndex()
+        Finalize(None, save_corpus_index, exitpriority=10)
+    return corpus_index
+
+def save_corpus_index():
+    '''saves the index of this process under the index directory (the main process merges the indexes of the workers)'''
+    corpus_index.save(node_path(os.path.join(index_path, "clean_index_{0}.pickle".format(os.getpid()))))
+
+def write_to_file(header, body, decade, text_file_name):
+    '''Writes the cleanup results to file'''
     logger = logging.getLogger()
-    result = []
-    # initialize word net lemmatizer
-    wordnet_lemmatizer = nltk.stem.WordNetLemmatizer() 
-    
     try:
-        #do
-    
-        # given the position of the token (it's index), get the token and its corresponding pos tag
-        # index is needed in case of multiple occurrences of the same token form in the sentence with different pos tags
-        tagged_token = tagged_sentence[token_idx]
-        wordnet_pos=get_wordnet_pos(tagged_token[1])
-        if tagged_token[0] == "-" or tagged_token[0] == "--":
-            lemma = tagged_token[0]
-            claws_pos = "z"
-        elif not tagged_token[0].isalpha():
-             lemma = tagged_token[0]
-        else:
-           # use nltk post tags to lemmatize
-           lemma = wordnet_lemmatizer.lemmatize(tagged_token[0], pos=wordnet_pos)       
-        # ~ logger.info("inside lemmatize | current token and pos: {},{}".format(token,tagged_token[1]))
-        if tagged_token[1] == "":
-            tagged_token[1] = "nn"
-        # convert pos tag to CLAWS7 set and format as pos_<sub>
-        claws_pos = get_claws7_pos(tagged_token[1])
-        pos = "{}_{}".format(claws_pos, mal_pos)
-        # return updated token info
-        return (tagged_token[0].encode('utf8'), lemma.encode('utf8'), pos.encode('utf8'))   
+        # write final results (cleaned text) to a new text file
+        # under clean/tagged/[decade]/
+        out_file_name = "{0}{1}{2}/{3}".format(COHA_path, modified_tag_path,decade,text_file_name) 
+        with codecs.open(out_file_name, 'w+') as out_file:
+            out_file.write(format_results(header, body))
     except:
-        logger.info("ERROR | Lemmatizing token: {} | idx: {} | Sent Length: {}".format(token,token_idx, len(tagged_sentence)))
-        raise
-   
-def clean_malformed(token, first_pass=True,full_sentence=""):
-    '''splits based on boundaries, tags pos and lemmatizes'''
+        logger.error("ERROR | failed to write results to file: {}".format(text_file_name)) 
+        raise 
+    return True              
+
+def write_text_file(header, body, decade, text_file_name):
+    '''Writes the text version of the cleanup results to file'''
     logger = logging.getLogger()
-    #~ logger.info("inside clean malformed | current token: {}".format(token))
-    result = []
-    wordnet_lemmatizer = nltk.stem.WordNetLemmatizer() 
-    
     try:
-        #do    
-        if first_pass:
-            # split token based on malformed characters except .
-            temp_split = re.split(malformed_regex_pass1, token)
-            split_tokens = list(z for z in temp_split if z !='' and z != ' ')
-            # add tokens to the results with a <temp> lemma and POS 
-            # so that they're proprely tagged and lemmatized in the 2nd pass
-            temp = "<temp>"
-            for tok in split_tokens:
-                result.append((tok.encode('utf8'), temp.encode('utf8'), temp.encode('utf8')))  
-        else:
-            # 2nd pass
-            # split token based on all malformed characters including .
-            temp_split = re.split(malformed_regex_pass2, token)
-            split_tokens = list(z for z in temp_split if z !='' and z != ' ')       
-            # POS tag tokens
-            tagged = tag_sentence(full_sentence)
-            #~ logger.info("split token into{}".format(split_tokens))
-           
-            # get the split and tagged tokens as a list
-            tagged_split_tokens = list(tok for tok in tagged if tok[0] in split_tokens)
-            
-            # lemmatize then add to results
-            for tok in tagged_split_tokens:
-                # use nltk post tags to lemmatize
-                if tok[1] == "":
-                    tok[1] = "nn"
-                nltk_pos=get_wordnet_pos(tok[1])
-                lemma = wordnet_lemmatizer.lemmatize(tok[0], pos=nltk_pos)
-                # convert pos tag to CLAWS7 set and format as pos_<sub>
-                claws_pos = get_claws7_pos(tok[1])
-                if tok[0] == "-" or tok[0] == "--":
-                    claws_pos = "z"       
-                pos = "{}_{}".format(claws_pos, mal_pos)
-                # add token information to results  
-                result.append((tok[0].encode('utf8'), lemma.encode('utf8'), pos.encode('utf8')))
-                # ~ logger.info("token cleaned successfully") 
-        # done processing, return results
-        return result
+        # write result (free text) to a new text file
+        # under clean/text/[decade]/
+        out_file_name = "{0}{1}{2}/{3}".format(COHA_path, text_path,decade,text_file_name) 
+        with codecs.open(out_file_name, 'w+') as out_file:
+            out_file.write(format_text(header, body))
     except:
-        logger.info("ERROR| Current Full Sentence: {}".format(full_sentence))
-        raise
+        logger.error("ERROR | failed to write text results to file: {}".format(text_file_name)) 
+        raise 
+    return True              
 
-def complete_sentence(tokens, current_sentence, full_sentence, final_results):
-    '''completes the current sentence based on the full sentence using the given tokens. Returns completed sentence and current sentence with extra tokens'''
-    logger = logging.getLogger()
-    #~ logger.info("inside complete sent | tokens list: \n{}".format(tokens))
-    completed = False
+def output_results(header, body, decade, text_file_name):
+    '''Writes the cleanup results (and their text version) to file or, if results are written to zip archives, formats them for the main process.
+    Returns the lemma cache statistics and the formatted (tagged, text) results (None if they were written to file)'''
+    start = time.time()
+    documents = None
+    if zip_output:
+        # the main process writes the results into the decade zip archives
+        documents = (format_results(header, body), format_text(header, body) if text_output else None)
+    else:
+        write_to_file(header, body, decade, text_file_name)
+        if text_output:
+            write_text_file(header, body, decade, text_file_name)
+    cleaner.stage_stats.add("write", start)
+    # hand the lemma cache statistics and new entries of this file to the main process
+    return cleaner.lemma_cache.pop_new_entries(), documents
 
-    try:
-        for tok in tokens:          
-            # add token to current sentence
-            current_sentence.append(tok[0])
-            partial_sent = " ".join(current_sentence).lower().strip().replace(" .",".")
-            # add (token, lemma, pos) to final results by reference (i.e. no need to return final results)
-            final_results.append((tok[0], tok[1], tok[2]))
-            if not completed and partial_sent == full_sentence.lower().strip():
-                # add end-of-sentence <eos> to final results by reference
-                final_results.append(("<eos>".encode('utf8'),"<eos>".encode('utf8'),"<eos>".encode('utf8')))
-                completed = True
-                current_sentence = []
-        #~ logger.info("sentence completed") 
-        # return remaining tokens from the splitting tokens if they are not part of this sentence.
-        #~ logger.info("leftover tokens:\n{}".format(current_sentence))
-        return current_sentence
-    except:
-        logger.info("ERROR| inside complete Sentence with full sent: {}".format(full_sentence))
-        raise       
+class DocumentWriter(object):
+    '''Writes the cleanup results of a text file (and their text version) in parts as their sentences are completed (streaming mode).
+    If results are written to zip archives, they are written to temporary files which the main process adds to the archives'''
 
-def write_to_file(header, body, decade, text_file_name):
-	'''Writes the cleanup results to file'''
-	 try:
-		 # write final results (cleaned text) to a new text file
-         # under clean/tagged/[decade]/
-         out_file_name = "{0}{1}{2}/{3}".format(COHA_path, modified_tag_path,decade,text_file_name) 
-         with codecs.open(out_file_name, 'w+') as out_file:
-			 out_file.write(header)
-			 # skip results if they are emopty (i.e. file is empty)
-			 if not body:
-				 return True  
-			 for line in results:
-				 txt = "{0}\t{1}\t{2}\n".format(line[0], line[1].lower(),line[2].lower())
-				 out_file.write(txt)
-    except:
-		logger.info("ERROR | failed to write results to file: {}".format(text_file_name)) 
-        raise 
-   return True              
+    def __init__(self, header, decade, text_file_name):
+        self.paths = []
+        self.files = []
+        for out_path in ([modified_tag_path, text_path] if text_output else [modified_tag_path]):
+            if zip_output:
+                fd, out_file_name = tempfile.mkstemp(suffix=".tmp", prefix=partial_prefix, dir="{0}{1}".format(COHA_path, out_path))
+                out_file = os.fdopen(fd, 'w')
+            else:
+                out_file_name = "{0}{1}{2}/{3}".format(COHA_path, out_path, decade, text_file_name)
+                out_file = open(out_file_name, 'w')
+            self.paths.append(out_file_name)
+            self.files.append(out_file)
+        self.files[0].write(header.encode('utf8'))
+        if text_output:
+            self.files[1].write(format_text_header(header))
+        # whether a form was written to the text version (the forms of each part are joined to the previous ones by a space)
+        self.has_text = False
+
+    def write(self, body):
+        '''writes the given cleanup results (TokenStore)'''
+        start = time.time()
+        self.files[0].write(format_tokens(body))
+        if text_output:
+            forms = text_forms(body)
+            if forms:
+                if self.has_text:
+                    self.files[1].write(" ")
+                self.files[1].write(" ".join(forms))
+                self.has_text = True
+        cleaner.stage_stats.add("write", start)
+
+    def close(self):
+        '''closes the files. Returns the names of the temporary files (None if results aren't written to zip archives)'''
+        for out_file in self.files:
+            out_file.close()
+        return tuple(self.paths) if zip_output else None
+
+    def discard(self):
+        '''closes the files and removes the temporary files (if results are written to zip archives)'''
+        for out_file in self.files:
+            out_file.close()
+        if zip_output:
+            for out_file_name in self.paths:
+                os.remove(out_file_name)
     
-def process_text(zip_file_name):
-    ''' Processes all text files within a zip file'''
-    #read this archive/zip file
-    current_path = "{0}{1}".format(zip_file_path,zip_file_name) 
-    nul_bytes= ['\x00','\00','\0']
-    nul_regex = re.compile("({0})".format('|'.join(nul_bytes)))
+def open_zip(zip_file_name):
+    '''returns the opened zip file with the given name. Zip files are opened once per process and kept open'''
+    if zip_file_name not in open_zips:
+        current_path = "{0}{1}".format(zip_file_path,zip_file_name)
+        open_zips[zip_file_name] = zipfile.ZipFile(current_path, 'r')
+    return open_zips[zip_file_name]
+
+def process_text(task):
+    ''' Processes a text file within a zip file. The task is a tuple of (zip file name, text file name)'''
+    global processed_files
+    zip_file_name, text_file_name = task
     
     logger = logging.getLogger()
-    # ~ logger.info("getting decade and creating folder")
     # 2nd column in zip archive is the decade it covers
     decade = zip_file_name.split("_")[1]
-    # make a directory with decade in order to save txt files there
-    dir_path = "{0}{1}{2}".format(COHA_path, modified_tag_path,decade)
-    if not os.path.isdir(dir_path):
-        os.mkdir(dir_path)
-    # create an HTMLparser to help decode html symbols
-    h_parser = HTMLParser.HTMLParser()
-
-    with zipfile.ZipFile(current_path, 'r') as current_zip:
-        #get list of files inside this archive
-        text_files_list = current_zip.namelist()    
-        for text_file_name in text_files_list:
-            logger.info("processing {}".format(text_file_name))         
-            # extract genre and year from file name (e.g. fic_1817_8554.txt)
-            # genre = file_details[0]
-            # year = file_details[1]
-            file_details = text_file_name.split("_")
-            #read text file into memory and clean it
-            results = []
-            first_line = ""
-            is_first = True     
-            with current_zip.open(text_file_name, 'r') as lines:                
-                '''
-                # *** first pass over tokens to read and clean them ***
-                # *** handles: "null" pos tag, sautee lemma, escaped html, malformed tokens without "." and "'"
-                '''
-                for line in lines:
-                    # first line special handling
-                    if is_first:
-                        first_line = line.decode('cp1252').encode('utf8')
-                        for nul in nul_bytes:
-                            first_line = first_line.replace(nul, nul_sub)
-                        is_first = False
-                    else:
-                        
-                        try:
-                            # some tokens in COHA have no pos tag (a white space)
-                            # we must replace these empty spaces using rstrip()
-                            # using replace doesn't work, do not use it.                            
-                            current_token_info = line.decode('cp1252').rstrip().split("\t")
-                            if len(current_token_info) < 3:
-                                current_token_info.append(nul_sub)    
-                                
-                            # check if null token with form <> or <P>
-                            if rmNull and (current_token_info[2].lower() == "null"):
-								if contais_control_chars(current_token_info[0].lower()):
-									#skip this token
-									continue
-                            # skip lines where all fields are q!
-                            if current_token_info[0].lower() == "q!":
-								continue
-                            encoded_tok = current_token_info[0].encode('utf8')
-                            is_form_nul = re.search(nul_regex, encoded_tok)
-                            if is_form_nul:
-                                current_token_info[0] = nul_sub
-                            
-                            
-                            if current_token_info[0].lower() in saute_forms:
-                                # unify lemma
-                                current_token_info[1] = "saute"
-                            # decode html in token  (if html is detected)
-                            contains_html = re.search(html_hex_regex, current_token_info[0].lower())
-                            if contains_html:
-                                # ~ logger.info("{} contains html".format(current_token_info[0]))
-                                current_token_info[0] = h_parser.unescape(current_token_info[0])
-                
-                            split_tokens = []    
-                            # check if malformed token and fix it
-                            is_malformed_matches = is_malformed(current_token_info[0].lower())
-                            if is_malformed_matches and current_token_info[0].lower()!= "q!":
-                                split_tokens = clean_malformed(current_token_info[0])
-                            
-                            if len(split_tokens) > 1:
-                                results.extend(split_tokens)
-                            else:
-                                # no cleaning needed
-                                results.append(current_token_info)             
-                        except:
-                            logger.info("ERROR during 1st pass over line {} in file {}".format(line, text_file_name))   
-                            raise             
-           
-            '''
-            # *** 2nd pass over tokens to clean them and define sentence boundaries ***
-            # *** handles: empty lemmas and pos tags, adding sentence boundaries, malformed tokens with "." and "'" around sentence boundaries.
-            '''
-            # if results are empty (file is empty), write only first line and exit
-            if not results:
-				write_to_file(first_line, results, decade, text_file_name)				
-            
-            tokens = []
-            lemmas = []
-            pos = []        
-            # save each column of our results into a list
-            tokens, lemmas, pos = zip(*results) 
-            # ~ logger.info("successfully unpacked results into 3 lists: tokens, lemmas, pos")
-            # reset resutls in order to add sentence boundaries where needed
-            results = []                        
-            # rebuild the sentences from the tokens list
-            text = " ".join(tokens)
-            # use a sentence tokenizer to get a list of all the sentences in the file
-            sentences_list = sentence_tokenizer.tokenize(text.strip())
-            # ~ logger.info(len(sentences_list))      
-            # variable to which we append our tokens to recreate the sentence 
-            # based on boundaries set using the NLTK sentence tokenizer
-            current_sentence = []
-            # variable for the tagged full sentence, to be used for tokens cleaned in the 1st pass
-            tagged_sentence = []
-            # index of the current current full sentence
-            sent_idx = 0
-            # index of toekn within the current full sentence
-            token_idx = -1
-            # start processing tokens
-            try:
-                #do sth
-                for idx in range(0,len(tokens)):
-                    
-                    # If the sentence index has exceeded the length of sentences, exit loop
-                    if sent_idx == len(sentences_list):
-                        break
-                    token_idx += 1    
-                    token_form = tokens[idx]
-                    full_sentence = sentences_list[sent_idx]
-                    # add to current partial sentence
-                    current_sentence.append(token_form)
-                    
-                    # encode token info using utf-8
-                    encoded_tok = token_form.encode('utf8')
-                    enc_lem = lemmas[idx].encode('utf8')
-                    enc_pos = pos[idx].encode('utf8')
-                    
-                    # replace NUL characters (white spaces) in lemma column
-                    is_lemma_nul = re.search(nul_regex, enc_lem)
-                    if is_lemma_nul:
-                        for nul in nul_bytes:
-                            enc_lem = enc_lem.replace(nul,nul_sub)
-
-                    # add token info to final results     
-                    results.append((encoded_tok,enc_lem,enc_pos))
-                    
-                    # compare current partial sentence to full sentence to detect end of sentence
-                    partial_sentence = " ".join(current_sentence).lower().strip() 
-                    is_eos = False # end of sentence marker 
-                    # check if end of sentence
-                    if partial_sentence ==  full_sentence.lower().strip():
-						is_eos = True
-                    
-                    # check if current token was cleaned in 1st pass but not tagged and lemmatized
-                    # skip tokens were the form is @ (special replacement token added by COHA creators for legal reasons)
-                    # skip tokens that contain "." since those will be handled by the sentence boundary code block
-                    prev_cleaned = (lemmas[idx] == "<temp>" or enc_lem == nul_sub or enc_pos == nul_sub)
-                    needs_tag_lemma = (prev_cleaned and token_form != "@" and not is_eos)
-                    if needs_tag_lemma:
-                        # tag and lemmatize the current token based on its pos and position in sentence
-                        tagged_sentence = tag_sentence(full_sentence)
-                        # lemmatize token
-                        if token_idx < len(tagged_sentence):
-                            new_token_info = lemmatize(encoded_tok, tagged_sentence, token_idx)
-                        else:
-                            if prev_cleaned:
-                                new_token_info = (encoded_tok, encoded_tok, enc_pos)    
-                        # replace the token info in the final results
-                        del results[-1]
-                        results.append(new_token_info)
-                        # ~ logger.info("{} was tagged and lemmatized successfully.".format(tokens[idx]))    
-                              
-                    # check if end of sentence    
-                    if is_eos:
-                        # end of sentence reached, reset current partial sentence
-                        current_sentence = []
-                        # reset the tagged full sentence
-                        tagged_sentence = []
-                        # add eos token to the final results
-                        results.append(("<eos>".encode('utf8'),"<eos>".encode('utf8'),"<eos>".encode('utf8')))
-                        token_idx = -1
-                        sent_idx += 1                                    
-                    else:
-                        # check if current sentence has passed the boundaries of the full sentence
-                        if len(partial_sentence) > len(full_sentence):
-                            # check if malformed token and fix it
-                            is_malformed_matches = is_malformed(token_form, False)
-                            if is_malformed_matches and token_form.lower()!= "q!":
-                                # malformed token found
-                                # 1. remove malformed token from the current sentence and final results then split it
-                                del current_sentence[-1]
-                                del results[-1]
-                                split_tokens = clean_malformed(token_form, False, full_sentence)
-                                #~ logger.info("split_tokens \n {}".format(split_tokens))
-                                # 2. add the split tokens until sentence is complete and reset the current sentence
-                                current_sentence = complete_sentence(split_tokens, current_sentence, full_sentence, results)
-                                # 3. we completed the sentence so reset the tagged sentence
-                                # 3.2 reset the tagged full sentence and token index
-                                tagged_sentence = []
-                                token_idx = -1
-                                # 3.3 get next full sentence by moving the iterator
-                                sent_idx += 1
-            except:
-                logger.info("ERROR| Current Sentence: {}".format(current_sentence))
-                raise                         
-                                                                                            
-            write_to_file(first_line, results, decade, text_file_name)   
-                        
-    return True
+    #read this archive/zip file
+    current_zip = open_zip(zip_file_name)
+
+    # log the processing of every --log-every-th text file
+    processed_files += 1
+    if log_every and processed_files % log_every == 0:
+        logger.info("processing {}".format(text_file_name))         
+    # extract genre and year from file name (e.g. fic_1817_8554.txt)
+    # genre = file_details[0]
+    # year = file_details[1]
+    file_details = text_file_name.split("_")
+    with current_zip.open(text_file_name, 'r') as lines:                
+        if stream:
+            return stream_text(lines, decade, text_file_name)
+        #read text file into memory and clean it
+        first_line, results = cleaner.clean_document(lines, text_file_name)
+    if build_index:
+        get_corpus_index().start_document(decade, text_file_name)
+        corpus_index.add_tokens(results)
+    output = output_results(first_line, results, decade, text_file_name)
+    if build_index:
+        corpus_index.end_document()
+    return output
+
+def stream_text(lines, decade, text_file_name):
+    '''Cleans the lines of a text file in windows (streaming mode) and writes the results of each window as soon as its sentences are complete.
+    Returns the lemma cache statistics and the names of the temporary files (None if results aren't written to zip archives)'''
+    first_line, windows = cleaner.stream_document(lines, window_size, text_file_name)
+    writer = DocumentWriter(first_line, decade, text_file_name)
+    if build_index:
+        get_corpus_index().start_document(decade, text_file_name)
+    try:
+        for results in windows:
+            if build_index:
+                corpus_index.add_tokens(results)
+            writer.write(results)
+    except:
+        writer.discard()
+        raise
+    if build_index:
+        corpus_index.end_document()
+    # hand the lemma cache statistics and new entries of this file to the main process
+    return cleaner.lemma_cache.pop_new_entries(), writer.close()
                         
+def clean_text(task):
+    '''Processes a text file and catches any error so that the remaining files are still processed.
+    Returns the task, whether it succeeded, the lemma cache statistics, the formatted results or, in streaming mode,
+    the names of their temporary files (zip output only)
+    and the stage stats of the worker process (process id, stats)'''
+    logger = logging.getLogger()
+    if profile_path:
+        get_profiler().enable()
+    try:
+        lemma_stats, documents = process_text(task)
+        return task, True, lemma_stats, documents, (os.getpid(), cleaner.stage_stats.pop())
+    except Exception:
+        logger.exception("ERROR | failed to clean text file {} in {}".format(task[1], task[0]))
+        return task, False, cleaner.lemma_cache.pop_new_entries(), None, (os.getpid(), cleaner.stage_stats.pop())
+    finally:
+        if profile_path:
+            profiler.disable()
+
+def merge_stats(totals, stats):
+    '''adds stage stats (as returned by StageStats.pop) to the given totals'''
+    for stage, values in stats["stages"].items():
+        stage_totals = totals["stages"].setdefault(stage, {"seconds": 0.0, "calls": 0})
+        stage_totals["seconds"] += values["seconds"]
+        stage_totals["calls"] += values["calls"]
+    for counter, count in stats["counters"].items():
+        totals["counters"][counter] = totals["counters"].get(counter, 0) + count
+
+def load_manifest(file_path):
+    '''Reads the manifest entries of a previous run, keyed by (zip file name, text file name).
+    Each line of the manifest is a json entry, later entries replace earlier ones'''
+    manifest = {}
+    if os.path.isfile(file_path):
+        with open(file_path, 'r') as manifest_file:
+            for line in manifest_file:
+                if line.strip():
+                    entry = json.loads(line)
+                    manifest[(entry["zip"], entry["file"])] = entry
+    return manifest
+
+def manifest_entry(zip_file_name, zip_info, status):
+    '''creates the manifest entry of a text file (zip member) given the status of its processing'''
+    return {"zip": zip_file_name, "file": zip_info.filename, "crc": zip_info.CRC, "size": zip_info.file_size,
+            "params": {"rm_Null": rmNull, "mal_pos": mal_pos, "nul_sub": nul_sub}, "status": status}
+
+def write_manifest_entry(manifest_file, entry):
+    '''appends an entry to the manifest and flushes it so that it survives interrupted runs'''
+    manifest_file.write(json.dumps(entry, sort_keys=True) + "\n")
+    manifest_file.flush()
+
+def archive_path(out_path, decade):
+    '''returns the path of the zip archive of a decade's clean (tagged or text) files (zip output)'''
+    return "{0}{1}cleaned_{2}.zip".format(COHA_path, out_path, decade)
+
+def shard_path(file_path, index):
+    '''returns the path of a file of the given shard (e.g. clean/clean_manifest.shard2.jsonl)'''
+    root, extension = os.path.splitext(file_path)
+    return "{0}.shard{1}{2}".format(root, index, extension)
+
+def node_path(file_path):
+    '''returns the path of a file written by this run: the file of its shard (--shard) or the file itself'''
+    return shard_path(file_path, shard_index) if shard else file_path
+
+def shard_archive_dir(out_path):
+    '''returns the directory of the decade archives of the shards (e.g. clean/shards/tagged/). They are kept apart from
+    the decade archives, so that the scripts that read the decade archives don't read them too'''
+    return "{0}{1}".format(COHA_path, out_path.replace("clean/", shard_dir_name, 1))
+
+def shard_archive_path(out_path, decade, index):
+    '''returns the path of the zip archive of a decade's clean files of the given shard (e.g. clean/shards/tagged/cleaned_1810s.shard2.zip)'''
+    return shard_path("{0}cleaned_{1}.zip".format(shard_archive_dir(out_path), decade), index)
+
+def node_archive_path(out_path, decade):
+    '''returns the path of the zip archive of a decade written by this run: the archive of its shard (--shard) or the decade archive'''
+    return shard_archive_path(out_path, decade, shard_index) if shard else archive_path(out_path, decade)
+
+def part_prefix(out_path, decade):
+    '''returns the start of the paths of the part archives of a decade written by this run (see part_path)'''
+    return "{0}.part".format(os.path.splitext(node_archive_path(out_path, decade))[0])
+
+def part_path(out_path, decade, number):
+    '''returns the path of a part archive of a decade (zip output). The clean files are written to part archives which are closed
+    at each checkpoint, so that a killed run can be resumed from them, and assembled into the decade archive at the end of the run.
+    Their names don't contain .zip, so that the scripts that read the decade archives don't read them (e.g. cleaned_1810s.part0003.tmp)'''
+    return "{0}{1:04d}.tmp".format(part_prefix(out_path, decade), number)
+
+def list_parts(out_path, decade):
+    '''returns the (number, path) of the part archives of a decade, in the order in which they were written'''
+    dir_path, name_prefix = os.path.split(part_prefix(out_path, decade))
+    parts = []
+    for file_name in os.listdir(dir_path):
+        number = file_name[len(name_prefix):-len(".tmp")]
+        if file_name.startswith(name_prefix) and file_name.endswith(".tmp") and number.isdigit():
+            parts.append((int(number), os.path.join(dir_path, file_name)))
+    return sorted(parts)
+
+def index_written_files(out_path, decade, warn=True):
+    '''Lists the clean files of a decade that were written to its decade archive and to its part archives.
+    Returns the path of the archive of each file (the last one written that contains it). The archives that can't be read
+    (e.g. the part archives that were open when a run was killed) are skipped, their files are cleaned again'''
+    logger = logging.getLogger()
+    written = {}
+    for path in [node_archive_path(out_path, decade)] + list(path for number, path in list_parts(out_path, decade)):
+        if not os.path.isfile(path):
+            continue
+        try:
+            with zipfile.ZipFile(path, 'r') as archive:
+                for name in archive.namelist():
+                    written[name] = path
+        except zipfile.BadZipfile:
+            if warn:
+                logger.warning("WARNING | {} is not a valid zip archive, its files will be cleaned again".format(path))
+    return written
+
+def assemble_archive(out_path, decade, text_file_names, written):
+    '''Copies the given clean files of a decade from the archives they were written to (see index_written_files) into its decade
+    archive. The archive is written under a temporary name and replaces the previous one once it is complete'''
+    sources = {}
+    for text_file_name in text_file_names:
+        sources.setdefault(written[text_file_name], []).append(text_file_name)
+    final_path = node_archive_path(out_path, decade)
+    temporary_path = os.path.splitext(final_path)[0] + ".tmp"
+    with zipfile.ZipFile(temporary_path, 'w') as archive:
+        for source_path, names in sorted(sources.items()):
+            with zipfile.ZipFile(source_path, 'r') as source:
+                for name in names:
+                    archive.writestr(source.getinfo(name), source.read(name))
+    os.rename(temporary_path, final_path)
+
+def save_parts(parts, part_entries, manifest_file):
+    '''closes the part archives (zip output) and writes the manifest entries of their files (checkpoint)'''
+    for archive in parts.values():
+        archive.close()
+    for entry in part_entries:
+        write_manifest_entry(manifest_file, entry)
+    parts.clear()
+    del part_entries[:]
+
+def select_shard(zip_file_names):
+    '''Splits the text files of the zip files into --shard parts of about the same size. Every node computes the same parts
+    (whatever the order in which it lists the files). Returns the (zip file name, text file name) of the files of this node's part'''
+    files = []
+    for zip_file_name in zip_file_names:
+        with zipfile.ZipFile("{0}{1}".format(zip_file_path,zip_file_name), 'r') as current_zip:
+            files.extend((info.file_size, zip_file_name, info.filename) for info in current_zip.infolist())
+    # largest files first, each to the part with the fewest bytes so far
+    files.sort(key=lambda item: (-item[0], item[1], item[2]))
+    sizes = [0] * number_of_shards
+    selected = set()
+    for file_size, zip_file_name, text_file_name in files:
+        part = sizes.index(min(sizes))
+        sizes[part] += file_size
+        if part == shard_index:
+            selected.add((zip_file_name, text_file_name))
+    return selected
+
+def merge_shard_outputs():
+    '''Assembles the outputs of the --merge-shards shards of a sharded run: the decade archives (zip output), the manifests,
+    the stats, the lemma caches and the indexes. All the shards must be done (i.e. their stats must have been saved).
+    The outputs of the shards are kept, so that a shard can be rerun with --resume and the outputs merged again.
+    Returns the number of text files that failed in the shards'''
+    logger = logging.getLogger()
+    shards = range(merge_shards)
+    missing = list(str(index) for index in shards if not os.path.isfile(shard_path(stats_path, index)))
+    if missing:
+        message = "ERROR | shards not done (their stats weren't saved): {}".format(", ".join(missing))
+        logger.error(message)
+        sys.exit(message)
+    
+    # assemble the decade archives of the shards (the files are copied as they are)
+    for out_path in [modified_tag_path, text_path]:
+        dir_path = shard_archive_dir(out_path)
+        if not os.path.isdir(dir_path):
+            continue
+        parts = {}
+        for file_name in os.listdir(dir_path):
+            match = shard_archive_regex.match(file_name)
+            if match and int(match.group(2)) < merge_shards:
+                parts.setdefault(match.group(1), []).append((int(match.group(2)), os.path.join(dir_path, file_name)))
+        for decade, decade_parts in sorted(parts.items()):
+            # the archive replaces the one of a previous merge once it's complete
+            temporary_path = os.path.splitext(archive_path(out_path, decade))[0] + ".tmp"
+            with zipfile.ZipFile(temporary_path, 'w') as archive:
+                for index, shard_archive in sorted(decade_parts):
+                    with zipfile.ZipFile(shard_archive, 'r') as part:
+                        for info in part.infolist():
+                            archive.writestr(info, part.read(info.filename))
+            os.rename(temporary_path, archive_path(out_path, decade))
+            logger.info("assembled {} shards into {}".format(len(decade_parts), archive_path(out_path, decade)))
+    
+    # the manifest of the run lists the files of all the shards
+    with open(manifest_path, 'w') as manifest_file:
+        for index in shards:
+            for entry in load_manifest(shard_path(manifest_path, index)).values():
+                write_manifest_entry(manifest_file, entry)
+    
+    # the stats of the run are the sums of the stats of the shards (its wall time is the time of the slowest shard)
+    summary = {"wall_seconds": 0.0, "processes": 0, "text_files": 0, "failed": 0, "lemma_cache": {"hits": 0, "misses": 0},
+               "line_cache": {"hits": 0, "misses": 0}, "total": {"stages": {}, "counters": {}}, "main": {"stages": {}, "counters": {}},
+               "workers": {}, "decades": {}, "shards": {}}
+    for index in shards:
+        with open(shard_path(stats_path, index), 'r') as stats_file:
+            stats = json.load(stats_file)
+        summary["wall_seconds"] = max(summary["wall_seconds"], stats["wall_seconds"])
+        for key in ["processes", "text_files", "failed"]:
+            summary[key] += stats[key]
+        for cache in ["lemma_cache", "line_cache"]:
+            for key in ["hits", "misses"]:
+                summary[cache][key] += stats[cache][key]
+        merge_stats(summary["total"], stats["total"])
+        merge_stats(summary["main"], stats["main"])
+        for worker, worker_stats in stats["workers"].items():
+            summary["workers"]["{0}:{1}".format(index, worker)] = worker_stats
+        for decade, decade_stats in stats["decades"].items():
+            merge_stats(summary["decades"].setdefault(decade, {"stages": {}, "counters": {}}), decade_stats)
+        summary["shards"][str(index)] = {"wall_seconds": stats["wall_seconds"], "text_files": stats["text_files"], "failed": stats["failed"]}
+    for cache in ["lemma_cache", "line_cache"]:
+        lookups = summary[cache]["hits"] + summary[cache]["misses"]
+        summary[cache]["hit_rate"] = 100.0 * summary[cache]["hits"] / lookups if lookups else 0.0
+    with open(stats_path, 'w') as stats_file:
+        json.dump(summary, stats_file, indent=2, sort_keys=True)
+    logger.info("Saved the stats of {} shards to {} ({} text files, {} failed)".format(merge_shards, stats_path, summary["text_files"], summary["failed"]))
+    
+    # merge the lemma caches of the shards
+    if lemma_cache_path:
+        for index in shards:
+            if os.path.isfile(shard_path(lemma_cache_path, index)):
+                cleaner.lemma_cache.load(shard_path(lemma_cache_path, index))
+        cleaner.lemma_cache.save(lemma_cache_path)
+        logger.info("Saved {} cached lemmas to {}".format(len(cleaner.lemma_cache), lemma_cache_path))
+    
+    # merge the indexes of the shards and write the index tables
+    index_paths = list(shard_path(os.path.join(index_path, "clean_index.pickle"), index) for index in shards)
+    if any(os.path.isfile(path) for path in index_paths):
+        merged_index = CorpusIndex()
+        for path in index_paths:
+            merged_index.load(path)
+        merged_index.write_tables(index_path)
+        logger.info("Indexed {} documents ({} lemmas) under {}".format(len(merged_index), len(merged_index.postings), index_path))
+    if summary["failed"]:
+        failed_shards = list(index for index in shards if summary["shards"][str(index)]["failed"])
+        logger.error("ERROR | {0} text files failed in shards {1}: rerun each of these shards with --shard=i/{2} --resume "
+                     "to clean them again, then --merge-shards={2} again".format(summary["failed"], ", ".join(str(index) for index in failed_shards), merge_shards))
+    logger.info("done")
+    return summary["failed"]
+
 def main():
-    number_of_processes = 10
     
     # create multiprocessing logger
     my_format = "%(asctime)s - %(process)s - %(message)s"
-    logging.basicConfig(filename="clean_log.txt", format=my_format, level=logging.INFO, mode='w')
+    logging.basicConfig(filename="clean_log.txt", format=my_format, level=log_level, filemode='w')
+    # worker processes send their records to the main process in batches
     install_mp_handler()
     logger = logging.getLogger()
+    run_start = time.time()
+    
+    # assemble the outputs of a sharded run (doesn't need nltk)
+    if merge_shards:
+        if merge_shard_outputs():
+            sys.exit(1)
+        return
+    if shard and not 0 <= shard_index < number_of_shards:
+        message = "ERROR | invalid shard {} (the shard i/n must be between 0/n and n-1/n)".format(shard)
+        logger.error(message)
+        sys.exit(message)
+    
+    # make sure that the nltk libraries are available before doing any work
+    missing_resources = check_nltk_resources()
+    if missing_resources and not dry_run:
+        message = ("ERROR | nltk resources not found: {0}\nSearched in: {1}\n"
+                   "Download them on a machine with internet access (python -m nltk.downloader wordnet averaged_perceptron_tagger punkt) "
+                   "and copy them to one of the searched directories or set the NLTK_DATA environment variable.").format(
+                   ", ".join(missing_resources), ", ".join(nltk.data.path))
+        logger.error(message)
+        sys.exit(message)
+    # the files that are up to date aren't cleaned again, so they wouldn't be indexed
+    if build_index and resume:
+        message = "ERROR | --index can't be used with --resume (the files that are up to date wouldn't be indexed)"
+        logger.error(message)
+        sys.exit(message)
     
     # get list of zip files in directory
     logger.info("Getting names of zip files in directory: %s" %zip_file_path)
     dir_file_names = os.listdir(zip_file_path)
     zip_file_names = list(x for x in dir_file_names if ".zip" in x)
     
-    logger.info("Creating pool and mapping processes")
-    # create a pool of processes to process zip files simultaneously
+    # with zip output, the manifest of a run is written to a temporary manifest (along with the part archives)
+    # and replaces the manifest of the previous run once the decade archives are assembled
+    run_manifest_path = node_path(manifest_path) + (".tmp" if zip_output else "")
+    # read the manifest of the previous run (and that of a killed zip output run)
+    manifest = load_manifest(node_path(manifest_path)) if resume else {}
+    if resume and zip_output:
+        manifest.update(load_manifest(run_manifest_path))
+    # text files of this node (sharded run)
+    if shard:
+        node_files = select_shard(zip_file_names)
+        logger.info("Shard {}: {} text files".format(shard, len(node_files)))
+    # manifest entries of the files that are up to date and of the files to process
+    done_entries = []
+    entries = {}
+    # output paths of the clean tagged files and the text files
+    output_paths = [modified_tag_path, text_path] if text_output else [modified_tag_path]
+    # zip output: archive of each clean file written by the previous runs (see index_written_files), keyed by (output path, decade)
+    written = {}
+    
+    # create one task per text file in the zip files
+    tasks = []
+    for zip_file_name in zip_file_names:
+        # 2nd column in zip archive is the decade it covers
+        decade = zip_file_name.split("_")[1]
+        for out_path in output_paths:
+            # make a directory with decade in order to save txt files there
+            dir_path = "{0}{1}{2}".format(COHA_path, out_path,decade)
+            if zip_output:
+                if shard and not os.path.isdir(shard_archive_dir(out_path)) and not dry_run:
+                    os.makedirs(shard_archive_dir(out_path))
+                if resume and (out_path, decade) not in written:
+                    written[(out_path, decade)] = index_written_files(out_path, decade)
+            elif not os.path.isdir(dir_path) and not dry_run:
+                os.mkdir(dir_path)
+        with zipfile.ZipFile("{0}{1}".format(zip_file_path,zip_file_name), 'r') as current_zip:
+            for info in current_zip.infolist():
+                if shard and (zip_file_name, info.filename) not in node_files:
+                    continue
+                entry = manifest_entry(zip_file_name, info, "done")
+                # check if the file was written to all outputs
+                is_written = True
+                for out_path in output_paths:
+                    if zip_output:
+                        is_written = is_written and info.filename in written.get((out_path, decade), {})
+                    else:
+                        is_written = is_written and os.path.isfile("{0}{1}{2}/{3}".format(COHA_path, out_path, decade, info.filename))
+                # skip text files that were cleaned with the same input and parameters
+                if manifest.get((zip_file_name, info.filename)) == entry and is_written:
+                    done_entries.append(entry)
+                    continue
+                entries[(zip_file_name, info.filename)] = entry
+                tasks.append((zip_file_name, info.filename, info.file_size))
+    # start with the largest files so that workers don't wait for a few large files at the end
+    tasks.sort(key=lambda task: task[2], reverse=True)
+    tasks = list((zip_file_name, text_file_name) for zip_file_name, text_file_name, file_size in tasks)
+    logger.info("Found {} text files to clean in {} zip files ({} up to date)".format(len(tasks), len(zip_file_names), len(done_entries)))
+    
+    if dry_run:
+        # list the text files to clean and exit
+        for zip_file_name, text_file_name in tasks:
+            print("{0}\t{1}".format(zip_file_name, text_file_name))
+        return
+    
+    # zip output: the clean files of this run are written to part archives, which are closed at each checkpoint
+    # (keyed by (output path, decade)), the part archives of a killed run are kept to resume from them
+    parts = {}
+    part_number = 0
+    if zip_output:
+        for zip_file_name in zip_file_names:
+            decade = zip_file_name.split("_")[1]
+            for out_path in output_paths:
+                for number, path in list_parts(out_path, decade):
+                    if resume:
+                        part_number = max(part_number, number + 1)
+                    else:
+                        os.remove(path)
+        for out_path in output_paths:
+            # temporary files of the documents that an interrupted run was writing in parts
+            out_dir = "{0}{1}".format(COHA_path, out_path)
+            for file_name in os.listdir(out_dir):
+                if file_name.startswith(partial_prefix) and file_name.endswith(".tmp"):
+                    os.remove(os.path.join(out_dir, file_name))
+    
+    # warm-start the lemma cache (inherited by the worker processes)
+    if lemma_cache_path and os.path.isfile(lemma_cache_path):
+        cleaner.lemma_cache.load(lemma_cache_path)
+        logger.info("Loaded {} cached lemmas from {}".format(len(cleaner.lemma_cache), lemma_cache_path))
+    
+    if profile_path and not os.path.isdir(profile_path):
+        os.makedirs(profile_path)
+    # the stats of a previous run of this shard would mark it as done before it is
+    if shard and os.path.isfile(node_path(stats_path)):
+        os.remove(node_path(stats_path))
+    if build_index:
+        if not os.path.isdir(index_path):
+            os.makedirs(index_path)
+        # remove the indexes of the worker processes of an interrupted run
+        for file_name in os.listdir(index_path):
+            if worker_index_regex.match(file_name):
+                os.remove(os.path.join(index_path, file_name))
+    
+    logger.info("Creating pool of {} processes and mapping tasks".format(number_of_processes))
+    # create a pool of processes to process text files simultaneously
     pool = multiprocessing.Pool(number_of_processes)
-    # fire up the processes for our zip files
-    result = pool.map(process_text, zip_file_names)
+    # fire up the processes for our text files (in chunks, in order of completion)
+    # and record each processed file in the manifest as soon as it is done
+    # lemma cache statistics of the worker processes
+    hits = 0
+    misses = 0
+    failed = 0
+    # stage stats of all text files, of each worker process and of each decade
+    totals = {"stages": {}, "counters": {}}
+    worker_totals = {}
+    decade_totals = {}
+    # zip output: entries of the files written to the open part archives, they are written to the manifest at the next checkpoint
+    # (once the part archives are closed), so that the manifest of a killed run only lists the files that can be resumed from
+    part_entries = []
+    last_checkpoint = time.time()
+    # the manifest of a zip output run lists the files cleaned since the last complete run (the up to date files are already listed)
+    with open(run_manifest_path, 'a' if resume and zip_output else 'w') as manifest_file:
+        if not zip_output:
+            for entry in done_entries:
+                write_manifest_entry(manifest_file, entry)
+        for task, succeeded, stats, documents, (worker, worker_stats) in pool.imap_unordered(clean_text, tasks, chunk_size):
+            entry = entries[task]
+            decade = task[0].split("_")[1]
+            if not succeeded:
+                entry["status"] = "failed"
+                failed += 1
+                write_manifest_entry(manifest_file, entry)
+            elif zip_output:
+                # write the clean file (and its text version) into the part archives of its decade
+                # (in streaming mode, the worker wrote them to temporary files)
+                start = time.time()
+                for out_path, document in zip(output_paths, documents):
+                    if (out_path, decade) not in parts:
+                        parts[(out_path, decade)] = zipfile.ZipFile(part_path(out_path, decade, part_number), 'w')
+                    if stream:
+                        parts[(out_path, decade)].write(document, task[1])
+                        os.remove(document)
+                    else:
+                        parts[(out_path, decade)].writestr(task[1], document)
+                part_entries.append(entry)
+                if time.time() - last_checkpoint >= checkpoint_seconds:
+                    save_parts(parts, part_entries, manifest_file)
+                    part_number += 1
+                    last_checkpoint = time.time()
+                cleaner.stage_stats.add("write_archive", start)
+            else:
+                write_manifest_entry(manifest_file, entry)
+            hits += stats[0]
+            misses += stats[1]
+            # merge the lemmas computed by the worker into the cache that is saved at the end of the run
+            if lemma_cache_path:
+                cleaner.lemma_cache.update(stats[2])
+            merge_stats(totals, worker_stats)
+            merge_stats(worker_totals.setdefault(str(worker), {"stages": {}, "counters": {}}), worker_stats)
+            merge_stats(decade_totals.setdefault(decade, {"stages": {}, "counters": {}}), worker_stats)
+        if zip_output:
+            save_parts(parts, part_entries, manifest_file)
     # close pool after all requests are submitted
     pool.close()
     # wait for the last worker to finish, not needed when using map but I'd rather be safe than sorry 
     pool.join() 
     
+    if zip_output:
+        # assemble the up to date files of the previous runs and the files of this run into the decade archives,
+        # then replace the manifest of the previous run and remove the part archives and the temporary manifest
+        start = time.time()
+        done_entries.extend(entry for entry in entries.values() if entry["status"] == "done")
+        for zip_file_name in zip_file_names:
+            decade = zip_file_name.split("_")[1]
+            text_file_names = list(entry["file"] for entry in done_entries if entry["zip"] == zip_file_name)
+            for out_path in output_paths:
+                assemble_archive(out_path, decade, text_file_names, index_written_files(out_path, decade, False))
+        with open(run_manifest_path + ".new", 'w') as manifest_file:
+            for entry in done_entries + list(entry for entry in entries.values() if entry["status"] != "done"):
+                write_manifest_entry(manifest_file, entry)
+        os.rename(run_manifest_path + ".new", node_path(manifest_path))
+        os.remove(run_manifest_path)
+        for zip_file_name in zip_file_names:
+            decade = zip_file_name.split("_")[1]
+            for out_path in output_paths:
+                for number, path in list_parts(out_path, decade):
+                    os.remove(path)
+        cleaner.stage_stats.add("write_archive", start)
+    
+    # merge the indexes of the worker processes (saved when they exited) and write the index tables
+    # (the index of a shard is saved for --merge-shards)
+    if build_index:
+        start = time.time()
+        merged_index = CorpusIndex()
+        for file_name in sorted(os.listdir(index_path)):
+            if worker_index_regex.match(file_name):
+                merged_index.load(os.path.join(index_path, file_name))
+                os.remove(os.path.join(index_path, file_name))
+        if shard:
+            merged_index.save(node_path(os.path.join(index_path, "clean_index.pickle")))
+        else:
+            merged_index.write_tables(index_path)
+        cleaner.stage_stats.add("write_index", start)
+        logger.info("Indexed {} documents ({} lemmas) under {}".format(len(merged_index), len(merged_index.postings), index_path))
+    
+    # report lemma cache statistics and save the cache for the next run
+    hit_rate = 100.0 * hits / (hits + misses) if hits + misses else 0.0
+    logger.info("lemma cache | hits: {} | misses: {} | hit rate: {:.2f}%".format(hits, misses, hit_rate))
+    line_hits = totals["counters"].get("line_cache_hits", 0)
+    line_misses = totals["counters"].get("line_cache_misses", 0)
+    line_hit_rate = 100.0 * line_hits / (line_hits + line_misses) if line_hits + line_misses else 0.0
+    logger.info("line cache | hits: {} | misses: {} | hit rate: {:.2f}%".format(line_hits, line_misses, line_hit_rate))
+    if lemma_cache_path:
+        cleaner.lemma_cache.save(node_path(lemma_cache_path))
+        logger.info("Saved {} cached lemmas to {}".format(len(cleaner.lemma_cache), node_path(lemma_cache_path)))
+    
+    # report the time spent in each stage (summed over the worker processes) and save the summary of the run
+    main_stats = cleaner.stage_stats.pop()
+    merge_stats(totals, main_stats)
+    stages_seconds = sum(values["seconds"] for values in totals["stages"].values())
+    for stage, values in sorted(totals["stages"].items(), key=lambda item: -item[1]["seconds"]):
+        logger.info("stage | {}: {:.2f}s ({:.1f}%) | calls: {}".format(stage, values["seconds"],
+                    100.0 * values["seconds"] / stages_seconds if stages_seconds else 0.0, values["calls"]))
+    summary = {"wall_seconds": time.time() - run_start, "processes": number_of_processes, "text_files": len(tasks),
+               "failed": failed, "lemma_cache": {"hits": hits, "misses": misses, "hit_rate": hit_rate},
+               "line_cache": {"hits": line_hits, "misses": line_misses, "hit_rate": line_hit_rate},
+               "total": totals, "main": main_stats, "workers": worker_totals, "decades": decade_totals, "shard": shard}
+    # the stats of a shard are saved last: --merge-shards takes them as the sign that the shard is done
+    with open(node_path(stats_path), 'w') as stats_file:
+        json.dump(summary, stats_file, indent=2, sort_keys=True)
+    logger.info("Saved the stats of the run to {}".format(node_path(stats_path)))
+    
+    if failed:
+        logger.error("ERROR | {} text files failed, rerun with --resume to clean them again".format(failed))
     #done writing results to files
     logger.info("done")
+    # let the caller (e.g. a batch job) see that text files failed
+    if failed:
+        sys.exit(1)
                                                     
 
 if __name__ == "__main__":
    main()
+
@@ -7,6 +7,15 @@ This script compresses the folders created by the script "clean-copy-coha.py".
 when running the script, if the paramter <del_folder>  is set to true, 
 then folders are deleted after they've all been compressed.
 
+Folders are compressed in parallel. Large folders are split into parts that are compressed
+in parallel and then assembled into one archive (compressed data is copied, not compressed again).
+
+With --shard-size or --shard-tokens, the files of each folder are packed into shards of about the same size
+(cleaned_[decade]-[n].zip) instead of one archive, and a json manifest lists the decade, genres, number of documents
+and number of tokens of each shard.
+The archives of a folder left by an earlier run (e.g. shards beyond the new number of shards, or the decade archive
+of an unsharded run) are deleted, so that readers don't find its documents twice.
+
 '''
 
 '''
@@ -18,33 +27,72 @@ import sys
 import zipfile
 import os
 import shutil
+import struct
 from docopt import docopt
 import logging
+import multiprocessing
+import json
 
 '''
 ******* ********* *********
 ******* variables *********
 ******* ********* *********
 '''
-# Get the arguments as global variables
+# Get the arguments as global variables (the help text is indented with spaces: docopt ignores options indented with tabs)
 args = docopt("""Extract contexts from COHA.
 
 Usage:
-	compress_del_folders.py <coha_dir> <del_folder> <output_dir>					
-	
+    compress_del_folders.py <coha_dir> <del_folder> <output_dir> [options]
+    
 Arguments:       
-	<coha_dir> = path to COHA directory
-	<del_folder> = Remove folders after compression? Takes boolean values: T for True or  F for False.  
-	<output_dir> = path to zipped output directory
+    <coha_dir> = path to COHA directory
+    <del_folder> = Remove folders after compression? Takes boolean values: T for True or  F for False.  
+    <output_dir> = path to zipped output directory
+
+Options:
+    --compression=<method>  compression method: deflate, stored, bzip2 or lzma (bzip2 and lzma need python 3) [default: deflate]
+    --level=<n>  compression level, needs python 3.7 (default: the default level of the compression method)
+    --processes=<n>  number of worker processes (default: number of CPUs)
+    --part-size=<mb>  folders larger than this size (in MB) are compressed in parallel parts [default: 256]
+    --shard-size=<mb>  pack the files of each folder into shards of about this size (in MB) instead of one archive
+    --shard-tokens=<n>  pack the files of each folder into shards of about this number of tokens instead of one archive
+    --shard-manifest=<file>  path to the json manifest of the shards (default: shards.json in the output directory)
 
 """)
 
 COHA_path = args['<coha_dir>']
 del_folder = True if str(args['<del_folder>']).lower() == 't' else False 
 output_path = args['<output_dir>']
+compression = args['--compression']
+compression_level = int(args['--level']) if args['--level'] is not None else None
+number_of_processes = int(args['--processes'] or multiprocessing.cpu_count())
+part_size = int(args['--part-size']) * 1024 * 1024
+shard_size = int(float(args['--shard-size']) * 1024 * 1024) if args['--shard-size'] is not None else None
+shard_tokens = int(args['--shard-tokens']) if args['--shard-tokens'] is not None else None
+shard_manifest_path = args['--shard-manifest']
+# line of an end-of-sentence token in a clean tagged file (not counted as a token)
+eos_line = b"<eos>\t"
 # append an / to the end of given paths if it's missing
 os.path.join(COHA_path, '')
 os.path.join(output_path, '')
+# zipfile internals used to copy compressed data from one archive to another (tested with python 2.7 and 3.6 to 3.13).
+# Without them, the files of the parts of a folder are decompressed and compressed again when the parts are assembled
+copy_compressed_supported = hasattr(zipfile.ZipInfo, "FileHeader") and all(hasattr(zipfile, name) for name in
+	["sizeFileHeader", "structFileHeader", "_FH_FILENAME_LENGTH", "_FH_EXTRA_FIELD_LENGTH"])
+# zipfile constants of the compression methods
+compression_types = {"stored": "ZIP_STORED", "deflate": "ZIP_DEFLATED", "bzip2": "ZIP_BZIP2", "lzma": "ZIP_LZMA"}
+
+# reject the options that can't be used before doing any work
+if compression not in compression_types:
+	sys.exit("ERROR | unknown compression method: {} (choose from: deflate, stored, bzip2, lzma)".format(compression))
+# bzip2 and lzma are only supported by python 3, compression levels by python 3.7+
+if not hasattr(zipfile, compression_types[compression]):
+	sys.exit("ERROR | --compression={} needs python 3 (this is python {})".format(compression, sys.version.split()[0]))
+if compression_level is not None and sys.version_info < (3, 7):
+	sys.exit("ERROR | --level needs python 3.7 or later (this is python {})".format(sys.version.split()[0]))
+if shard_size is not None and shard_tokens is not None:
+	sys.exit("ERROR | choose either --shard-size or --shard-tokens")
+compression_type = getattr(zipfile, compression_types[compression])
 
 '''
 ******* ********* *********
@@ -59,17 +107,47 @@ def main():
 	logging.basicConfig(filename="compress_log.txt", format=my_format, level=logging.INFO)
 	logger = logging.getLogger()
 	
+	sharded = shard_size is not None or shard_tokens is not None
+	
 	# ~ # get path to directories of clean tagged files
 	# ~ mod_tagged_path = os.path.join(COHA_path, modified_tag_path)
 	dir_file_names = os.listdir(COHA_path)
-	# remove any zip files from the list
-	dir_names = list(x for x in dir_file_names if ".zip" not in x)
-	# start compressing folders
-	logger.info("compressing folders in {}".format(COHA_path))
+	# remove any zip files (and other files, e.g. a shard manifest) from the list
+	dir_names = list(x for x in dir_file_names if ".zip" not in x and os.path.isdir(os.path.join(COHA_path, x)))
+	pool = multiprocessing.Pool(number_of_processes)
+	# split folders into parts (or shards) to compress
+	tasks = []
+	folder_parts = {}
+	shards = []
 	for folder_name in dir_names:
 		folder_path = os.path.join(COHA_path, folder_name)
+		if sharded:
+			folder_shards = split_shards(folder_path, folder_name, pool)
+			logger.info("packing {} into {} shards".format(folder_path, len(folder_shards)))
+			remove_stale_archives(folder_path, folder_name, list(shard[0][2] for shard in folder_shards), logger)
+			shards.extend(folder_shards)
+			tasks.extend(shard[0] for shard in folder_shards)
+			continue
 		archive_name = "cleaned_{}.zip".format(folder_name)
-		compress_files(folder_path, archive_name)
+		parts = split_folder(folder_path, archive_name)
+		remove_stale_archives(folder_path, folder_name, [get_archive_path(folder_path, archive_name)], logger)
+		folder_parts[get_archive_path(folder_path, archive_name)] = parts
+		tasks.extend(parts)
+	# start with the largest parts so that processes don't wait for a large part at the end
+	tasks.sort(key=lambda task: task[3], reverse=True)
+	# start compressing folders
+	logger.info("compressing folders in {} ({} parts, {} compression)".format(COHA_path, len(tasks), compression))
+	result = pool.map(compress_files, tasks, 1)
+	pool.close()
+	pool.join()
+	# assemble the parts of large folders into one archive
+	for zip_path, parts in folder_parts.items():
+		if len(parts) > 1:
+			logger.info("assembling {} parts into {}".format(len(parts), zip_path))
+			merge_archives(list(part[2] for part in parts), zip_path)
+	if sharded:
+		manifest_path = write_shard_manifest(shards)
+		logger.info("wrote the manifest of {} shards to {}".format(len(shards), manifest_path))
 	# delete folder after compression
 	if del_folder:
 		# once all zip folders have been created, delete the uncompressed folders
@@ -79,25 +157,179 @@ def main():
 			shutil.rmtree(folder_path)		
 	logger.info("done")		
 
-def compress_files(folder_path, archive_name):
-	'''Compress text files in given folder into 1 zip archive with the given name'''
+def open_archive(zip_path):
+	'''creates a zip archive using the chosen compression method and level'''
+	if compression_level is None:
+		return zipfile.ZipFile(zip_path, 'w', compression_type)
+	# the compression level is supported by python 3.7+
+	return zipfile.ZipFile(zip_path, 'w', compression_type, compresslevel=compression_level)
 
+def get_archive_path(folder_path, archive_name):
+	'''returns the path to the output archive of a folder'''
+	# get destination (default to parent directory of folder if not output path is given)
+	destination_path = output_path
+	if not os.path.isdir(output_path):
+		destination_path = os.path.split(folder_path)[0]
+	# create path to output archive
+	return os.path.join(destination_path,archive_name)
+
+def split_folder(folder_path, archive_name):
+	'''Splits the text files in given folder into parts of about --part-size bytes.
+	Returns a list of (folder path, text file names, archive path, size) parts. A folder with only 1 part is compressed directly into its archive'''
+	parts = []
 	# check if given directory path exists
 	if os.path.isdir(folder_path):
 		# get list of files in directory
 		txt_file_names = os.listdir(folder_path)
-		# get destination (default to parent directory of folder if not output path is given)
-		destination_path = output_path
-		if not os.path.isdir(output_path):
-			destination_path = os.path.split(folder_path)[0]
-		# create path to output archive
-		zip_path = os.path.join(destination_path,archive_name)
-		# create archive
-		with zipfile.ZipFile(zip_path, 'w') as myzip:
-			for txt_file in txt_file_names:
-				txt_file_path = os.path.join(folder_path,txt_file)
-				# write file to archive without perserving the directory structure (arcname param)
-				myzip.write(txt_file_path,arcname=txt_file)		
+		zip_path = get_archive_path(folder_path, archive_name)
+		current_part = []
+		current_size = 0
+		for txt_file in txt_file_names:
+			current_part.append(txt_file)
+			current_size += os.path.getsize(os.path.join(folder_path,txt_file))
+			if current_size >= part_size:
+				parts.append([folder_path, current_part, None, current_size])
+				current_part = []
+				current_size = 0
+		if current_part or not parts:
+			parts.append([folder_path, current_part, None, current_size])
+		# name the archives of the parts
+		for idx, part in enumerate(parts):
+			part[2] = zip_path if len(parts) == 1 else "{0}.part{1}".format(zip_path, idx)
+	return list(tuple(part) for part in parts)
+
+def remove_stale_archives(folder_path, folder_name, zip_paths, logger):
+	'''deletes the archives of a folder (cleaned_[decade].zip and its shards cleaned_[decade]-[n].zip) that an earlier
+	run left in the destination and that this run doesn't write, e.g. the last shards of a folder packed into fewer shards'''
+	destination_path = os.path.dirname(get_archive_path(folder_path, "cleaned_{}.zip".format(folder_name)))
+	shard_prefix = "cleaned_{}-".format(folder_name)
+	for name in os.listdir(destination_path):
+		if name != "cleaned_{}.zip".format(folder_name) and not (name.startswith(shard_prefix) and
+				name.endswith(".zip") and name[len(shard_prefix):-len(".zip")].isdigit()):
+			continue
+		zip_path = os.path.join(destination_path, name)
+		if zip_path not in zip_paths:
+			logger.info("deleting {} (left by an earlier run)".format(zip_path))
+			os.remove(zip_path)
+
+def count_tokens(txt_file_path):
+	'''returns the number of tokens of a clean file (without its header): the lines of a tagged file,
+	except for the <eos> lines, or the words of a text file'''
+	tokens = 0
+	with open(txt_file_path, 'rb') as txt_file:
+		# skip the header
+		txt_file.readline()
+		for line in txt_file:
+			if b"\t" in line:
+				if not line.startswith(eos_line):
+					tokens += 1
+			else:
+				tokens += len(line.split())
+	return tokens
+
+def split_shards(folder_path, folder_name, pool):
+	'''Splits the text files in given folder (in the order of their names) into shards of about --shard-size bytes or
+	--shard-tokens tokens. The number of shards is rounded to the nearest multiple of the target, so that all shards
+	have about the same size. Returns a list of ((folder path, text file names, archive path, size), manifest entry) shards'''
+	txt_file_names = sorted(os.listdir(folder_path))
+	txt_file_paths = list(os.path.join(folder_path, txt_file) for txt_file in txt_file_names)
+	sizes = list(os.path.getsize(txt_file_path) for txt_file_path in txt_file_paths)
+	# tokens are counted in parallel, the manifest needs them in both modes
+	tokens = pool.map(count_tokens, txt_file_paths, 64)
+	weights = sizes if shard_tokens is None else tokens
+	target = shard_size if shard_tokens is None else shard_tokens
+	total = sum(weights)
+	number_of_shards = max(int(round(float(total) / max(target, 1))), 1)
+	# a file goes to the next shard if more than half of it is past the share of the current shard
+	shard_files = [[] for _ in range(number_of_shards)]
+	done = 0
+	idx = 0
+	for position, weight in enumerate(weights):
+		while idx < number_of_shards - 1 and (done + weight / 2.0) * number_of_shards > total * (idx + 1):
+			idx += 1
+		shard_files[idx].append(position)
+		done += weight
+	shards = []
+	for idx, positions in enumerate(p for p in shard_files if p):
+		names = list(txt_file_names[position] for position in positions)
+		size = sum(sizes[position] for position in positions)
+		archive_name = "cleaned_{0}-{1:04d}.zip".format(folder_name, idx)
+		zip_path = get_archive_path(folder_path, archive_name)
+		entry = {
+			"archive": archive_name,
+			"decade": folder_name,
+			"genres": sorted(set(name.split("_")[0] for name in names)),
+			"documents": len(names),
+			"tokens": sum(tokens[position] for position in positions),
+			"bytes": size,
+		}
+		shards.append(((folder_path, names, zip_path, size), entry))
+	return shards
+
+def write_shard_manifest(shards):
+	'''writes the json manifest of the shards (in the order of their folders and archives) and returns its path'''
+	manifest_path = shard_manifest_path
+	if manifest_path is None:
+		destination_path = output_path if os.path.isdir(output_path) else COHA_path
+		manifest_path = os.path.join(destination_path, "shards.json")
+	manifest = {
+		"shard_size": shard_size,
+		"shard_tokens": shard_tokens,
+		"shards": list(shard[1] for shard in shards),
+	}
+	with open(manifest_path, 'w') as manifest_file:
+		json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+	return manifest_path
+
+def compress_files(task):
+	'''Compress text files in given folder into 1 zip archive. The task is a (folder path, text file names, archive path, size) tuple'''
+	folder_path, txt_file_names, zip_path, size = task
+	# create archive
+	with open_archive(zip_path) as myzip:
+		for txt_file in txt_file_names:
+			txt_file_path = os.path.join(folder_path,txt_file)
+			# write file to archive without perserving the directory structure (arcname param)
+			myzip.write(txt_file_path,arcname=txt_file)		
+	return zip_path
+
+def merge_archives(part_paths, zip_path):
+	'''Assembles the archives of the parts of a folder into one archive and deletes them.
+	The compressed data of each file is copied as is, without decompressing it and compressing it again.
+	The CRC of every file of the archive is checked before the parts are deleted'''
+	with zipfile.ZipFile(zip_path, 'w') as myzip:
+		for part_path in part_paths:
+			with zipfile.ZipFile(part_path, 'r') as part_zip:
+				for zinfo in part_zip.infolist():
+					if copy_compressed_supported:
+						copy_compressed(part_zip, myzip, zinfo)
+					else:
+						myzip.writestr(zinfo, part_zip.read(zinfo.filename))
+	with zipfile.ZipFile(zip_path, 'r') as myzip:
+		bad_file = myzip.testzip()
+	if bad_file is not None:
+		raise zipfile.BadZipfile("{} is corrupt after assembling its parts (first bad file: {})".format(zip_path, bad_file))
+	for part_path in part_paths:
+		os.remove(part_path)
+
+def copy_compressed(source_zip, target_zip, zinfo):
+	'''copies the compressed data of a file from one archive to the end of another (uses zipfile internals, see copy_compressed_supported)'''
+	# skip the local file header of the file in the source archive
+	source_zip.fp.seek(zinfo.header_offset)
+	header = source_zip.fp.read(zipfile.sizeFileHeader)
+	fields = struct.unpack(zipfile.structFileHeader, header)
+	source_zip.fp.seek(fields[zipfile._FH_FILENAME_LENGTH] + fields[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+	data = source_zip.fp.read(zinfo.compress_size)
+	# the sizes and the CRC are known, so the local file header doesn't need a data descriptor
+	zinfo.flag_bits &= ~0x08
+	zinfo.header_offset = target_zip.fp.tell()
+	target_zip.fp.write(zinfo.FileHeader())
+	target_zip.fp.write(data)
+	target_zip.filelist.append(zinfo)
+	target_zip.NameToInfo[zinfo.filename] = zinfo
+	# python 3 writes the central directory at start_dir when the archive is closed
+	if hasattr(target_zip, "start_dir"):
+		target_zip.start_dir = target_zip.fp.tell()
+		target_zip._didModify = True
 
 if __name__ == "__main__":
-   main()			
+   main()
@@ -0,0 +1,231 @@
+'''
+@author: Reem Alatrash
+@version: 1.0
+=======================
+
+This script exports the clean tagged files of CCOHA (the output of clean-copy-coha.py) into a columnar binary format:
+dictionary-encoded integer arrays that can be opened with numpy.memmap (e.g. with ccoha_reader.ColumnarCorpus),
+so that a decade can be loaded without parsing text and sliced without copying it.
+
+The export has one vocabulary per column (forms.txt, lemmas.txt and pos.txt, one utf-8 string per line, the line number
+is the id) shared by all decades, so ids can be compared across decades, and one folder per decade with the following
+arrays of little-endian 32-bit integers (.i32 files):
+- forms, lemmas, pos: the ids of the tokens (without the <eos> tokens)
+- sentences: the token offsets of the sentences (number of sentences + 1), sentence i is tokens[sentences[i]:sentences[i+1]].
+  Each <eos> token ends a sentence (which can be empty), the tokens after the last <eos> token of a document are a sentence.
+- documents: the token offsets of the documents (number of documents + 1)
+- document_sentences: the sentence offsets of the documents (number of documents + 1)
+- genres, years: the genre (id in genres.txt) and year (-1 if unknown) of each document
+and documents.txt, the file names of the documents (one per line, in the order of the arrays).
+metadata.json lists the decades with their number of tokens, sentences and documents (and of skipped lines: lines
+with fewer than 3 columns, which are logged and left out so that the columns of the tokens stay aligned).
+
+Decades are exported in parallel. Each worker encodes its decade with its own vocabularies, then the vocabularies are merged
+(in the order of the decades) and the ids of each decade are translated to the shared ids in parallel.
+
+'''
+
+'''
+******* ********* *********
+*******  imports  *********
+******* ********* *********
+'''
+import sys
+import os
+import array
+import json
+import logging
+import multiprocessing
+from docopt import docopt
+from ccoha_reader import CcohaReader
+
+'''
+******* ********* *********
+******* variables *********
+******* ********* *********
+'''
+# Get the arguments as global variables
+args = docopt("""Export the clean tagged files of CCOHA into memory-mappable integer arrays.
+
+Usage:
+    export_columnar.py <clean_dir> <output_dir> [options]
+
+Arguments:
+    <clean_dir> = clean tagged directory (decade folders, cleaned_<decade>.zip archives or shards)
+    <output_dir> = path to the output directory of the columnar export
+
+Options:
+    --processes=<n>  number of worker processes (default: number of CPUs)
+
+""")
+
+clean_path = args['<clean_dir>']
+output_path = args['<output_dir>']
+number_of_processes = int(args['--processes'] or multiprocessing.cpu_count())
+# columns of the tokens and the vocabulary of each column
+columns = ["forms", "lemmas", "pos"]
+# end-of-sentence form of a clean tagged file
+eos = b"<eos>"
+# number of ids translated and written at once
+ids_per_write = 1000000
+
+'''
+******* ********* *********
+******* functions *********
+******* ********* *********
+'''
+
+def array_path(decade, name):
+    '''returns the path to an array of a decade'''
+    return os.path.join(output_path, decade, "{}.i32".format(name))
+
+def write_array(values, array_file):
+    '''writes an array of ints to a file as little-endian 32-bit integers'''
+    if sys.byteorder == "big":
+        values = array.array('i', values)
+        values.byteswap()
+    values.tofile(array_file)
+
+def read_array(array_file, count=-1):
+    '''reads (at most count) little-endian 32-bit integers from a file into an array'''
+    values = array.array('i', array_file.read(count * 4 if count >= 0 else -1))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+def encode_decade(decade):
+    '''Writes the arrays of a decade using the decade's own vocabularies (the token ids are translated later, see translate_decade).
+    Returns the decade, its vocabularies (lists of utf-8 strings), its genres and its number of tokens, sentences, documents and skipped lines'''
+    logger = logging.getLogger()
+    logger.info("encoding {}".format(decade))
+    if not os.path.isdir(os.path.join(output_path, decade)):
+        os.mkdir(os.path.join(output_path, decade))
+    vocabularies = list({} for column in columns)
+    genres = {}
+    # token and sentence offsets, starting with the first token (sentence) of the decade
+    sentences = array.array('i', [0])
+    documents = array.array('i', [0])
+    document_sentences = array.array('i', [0])
+    document_genres = array.array('i')
+    document_years = array.array('i')
+    number_of_tokens = 0
+    skipped_lines = 0
+    token_files = list(open(array_path(decade, column) + ".tmp", 'wb') for column in columns)
+    with CcohaReader(clean_path) as reader, open(os.path.join(output_path, decade, "documents.txt"), 'wb') as names_file:
+        for info in reader.select(decades=[decade]):
+            ids = list(array.array('i') for column in columns)
+            sentence_start = number_of_tokens
+            with reader.open(info) as lines:
+                # skip the header
+                lines.readline()
+                for line_number, line in enumerate(lines, 2):
+                    token = line.rstrip(b"\r\n").split(b"\t")
+                    if token[0] == eos:
+                        sentences.append(number_of_tokens)
+                        sentence_start = number_of_tokens
+                        continue
+                    # a token needs a value in every column, otherwise the columns wouldn't be aligned
+                    if len(token) < len(columns):
+                        logger.warning("WARNING | skipped line {0} of {1}: {2} columns instead of {3}".format(
+                            line_number, info.file_name, len(token), len(columns)))
+                        skipped_lines += 1
+                        continue
+                    for column_ids, vocabulary, value in zip(ids, vocabularies, token):
+                        column_ids.append(vocabulary.setdefault(value, len(vocabulary)))
+                    number_of_tokens += 1
+            # tokens after the last <eos> token
+            if number_of_tokens > sentence_start:
+                sentences.append(number_of_tokens)
+            for column_ids, token_file in zip(ids, token_files):
+                write_array(column_ids, token_file)
+            documents.append(number_of_tokens)
+            document_sentences.append(len(sentences) - 1)
+            document_genres.append(genres.setdefault(info.genre or "", len(genres)))
+            document_years.append(info.year if info.year is not None else -1)
+            names_file.write(info.file_name.encode('utf8') + b"\n")
+    for token_file in token_files:
+        token_file.close()
+    for name, values in (("sentences", sentences), ("documents", documents),
+                         ("document_sentences", document_sentences), ("years", document_years)):
+        with open(array_path(decade, name), 'wb') as array_file:
+            write_array(values, array_file)
+    # the genre ids are translated along with the token ids
+    with open(array_path(decade, "genres") + ".tmp", 'wb') as array_file:
+        write_array(document_genres, array_file)
+    # strings in the order of their ids
+    vocabularies = list(sorted(vocabulary, key=vocabulary.get) for vocabulary in vocabularies)
+    genres = sorted(genres, key=genres.get)
+    counts = {"tokens": number_of_tokens, "sentences": len(sentences) - 1, "documents": len(documents) - 1, "skipped_lines": skipped_lines}
+    logger.info("encoded {0}: {1}".format(decade, counts))
+    return decade, vocabularies, genres, counts
+
+def translate_decade(task):
+    '''Translates the ids of the arrays of a decade to the shared ids. The task is a (decade, {array name: id translation}) tuple'''
+    decade, translations = task
+    for name, translation in translations.items():
+        with open(array_path(decade, name) + ".tmp", 'rb') as local_file, open(array_path(decade, name), 'wb') as array_file:
+            while True:
+                local_ids = read_array(local_file, ids_per_write)
+                if not local_ids:
+                    break
+                write_array(array.array('i', (translation[local_id] for local_id in local_ids)), array_file)
+        os.remove(array_path(decade, name) + ".tmp")
+    return decade
+
+def merge_vocabularies(decade_vocabularies):
+    '''Merges the vocabularies of the decades (in the given order) into one vocabulary.
+    Returns the strings of the merged vocabulary and the translation of the ids of each decade'''
+    ids = {}
+    translations = []
+    for vocabulary in decade_vocabularies:
+        translations.append(array.array('i', (ids.setdefault(string, len(ids)) for string in vocabulary)))
+    return sorted(ids, key=ids.get), translations
+
+def write_vocabulary(strings, name):
+    '''writes the (utf-8) strings of a vocabulary, one per line'''
+    with open(os.path.join(output_path, "{}.txt".format(name)), 'wb') as vocabulary_file:
+        for string in strings:
+            vocabulary_file.write(string + b"\n")
+
+def main():
+
+    # logging details
+    my_format = "%(asctime)s - %(process)s - %(message)s"
+    logging.basicConfig(filename="export_columnar_log.txt", format=my_format, level=logging.INFO)
+    logger = logging.getLogger()
+
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+    with CcohaReader(clean_path) as reader:
+        decades = sorted(reader.by_decade)
+        # start with the largest decades so that workers don't wait for a large decade at the end
+        tasks = sorted(decades, key=lambda decade: len(reader.by_decade[decade]), reverse=True)
+    logger.info("exporting {} decades from {} to {}".format(len(decades), clean_path, output_path))
+    pool = multiprocessing.Pool(number_of_processes)
+    results = dict((result[0], result[1:]) for result in pool.map(encode_decade, tasks, 1))
+    # shared vocabularies, in the order of the decades
+    translations = dict((decade, {}) for decade in decades)
+    for idx, column in enumerate(columns + ["genres"]):
+        if column == "genres":
+            decade_vocabularies = list(list(genre.encode('utf8') for genre in results[decade][1]) for decade in decades)
+        else:
+            decade_vocabularies = list(results[decade][0][idx] for decade in decades)
+        strings, column_translations = merge_vocabularies(decade_vocabularies)
+        write_vocabulary(strings, column)
+        for decade, translation in zip(decades, column_translations):
+            translations[decade][column] = translation
+        logger.info("{0}: {1} strings".format(column, len(strings)))
+    pool.map(translate_decade, list((decade, translations[decade]) for decade in tasks), 1)
+    pool.close()
+    pool.join()
+    metadata = {
+        "dtype": "<i4",
+        "columns": columns,
+        "decades": dict((decade, results[decade][2]) for decade in decades),
+    }
+    with open(os.path.join(output_path, "metadata.json"), 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=1, sort_keys=True)
+    logger.info("done")
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,7 @@ import multiprocessing
 import logging
 import time
 import codecs
+import itertools
 from multiprocessing_logging import install_mp_handler
 
 '''
@@ -43,18 +44,36 @@ text_path = "clean/text/"
 args = docopt("""Extract contexts from COHA.
 
 Usage:
-    generate_text_files.py <coha_dir>                
+    generate_text_files.py <coha_dir> [options]
     
 Arguments:       
     <coha_dir> = path to zipped COHA directory
 
+Options:
+    --processes=<n>  number of worker processes (default: number of CPUs)
+    --chunk-size=<n>  number of text files sent to a worker process at once [default: 8]
+    --log-level=<level>  level of the log: DEBUG, INFO, WARNING or ERROR [default: INFO]
+    --log-every=<n>  log the processing of every n-th text file of each worker process (0: none) [default: 1]
+
 """)
 
 COHA_path = args['<coha_dir>']
+number_of_processes = int(args['--processes'] or multiprocessing.cpu_count())
+chunk_size = int(args['--chunk-size'])
+log_level = args['--log-level'].upper()
+if log_level not in ["DEBUG", "INFO", "WARNING", "ERROR"]:
+    sys.exit("ERROR | invalid --log-level: {} (choose from: DEBUG, INFO, WARNING, ERROR)".format(args['--log-level']))
+log_every = int(args['--log-every'])
 # append an / to the end of given paths if it's missing
 os.path.join(COHA_path, '')
 # create zip file path
 zip_file_path = "{0}{1}".format(COHA_path,tagged_dir)
+# number of tokens joined and written at once
+tokens_per_write = 10000
+# zip files opened by this process
+open_zips = {}
+# number of text files processed by this process (--log-every)
+processed_files = 0
 
 '''
 ******* ********* *********
@@ -62,66 +81,67 @@ zip_file_path = "{0}{1}".format(COHA_path,tagged_dir)
 ******* ********* *********
 '''
 
-def process_text(zip_file_name):
-    ''' Processes all text files within a zip file'''
-    #read this archive/zip file
-    current_path = "{0}{1}".format(zip_file_path,zip_file_name) 
+def open_zip(zip_file_name):
+    '''returns the opened zip file with the given name. Zip files are opened once per process and kept open'''
+    if zip_file_name not in open_zips:
+        current_path = "{0}{1}".format(zip_file_path,zip_file_name)
+        open_zips[zip_file_name] = zipfile.ZipFile(current_path, 'r')
+    return open_zips[zip_file_name]
+
+def process_text(task):
+    ''' Processes a text file within a zip file. The task is a tuple of (zip file name, text file name)'''
+    global processed_files
+    zip_file_name, text_file_name = task
     
     logger = logging.getLogger()
     # 2nd column in zip archive is the decade it covers
     decade = zip_file_name.split("_")[1].replace(".zip", "")
-    # make a directory with decade in order to save txt files there
-    dir_path = "{0}{1}{2}".format(COHA_path, text_path,decade)
-    if not os.path.isdir(dir_path):
-        os.mkdir(dir_path)
-
-    with zipfile.ZipFile(current_path, 'r') as current_zip:
-        #get list of files inside this archive
-        text_files_list = current_zip.namelist()    
-        for text_file_name in text_files_list:
-            logger.info("processing {}".format(text_file_name))         
-            # extract genre and year from file name (e.g. fic_1817_8554.txt)
-            # genre = file_details[0]
-            # year = file_details[1]
-            file_details = text_file_name.split("_")
-            #read text file into memory and clean it
-            first_line = ""
-            is_first = True  
-            #read text file into memory
-            tokens = []
-            lemmas = []
-            pos = []   
-            with current_zip.open(text_file_name, 'r') as lines:                
-                # save each column into a list 
-                tokens, lemmas, pos = zip(*list(line.decode('utf-8').split("\t") for line in lines))
-                # first line special handling
-                first_line = tokens[0]
+    #read this archive/zip file
+    current_zip = open_zip(zip_file_name)
 
+    # log the processing of every --log-every-th text file
+    processed_files += 1
+    if log_every and processed_files % log_every == 0:
+        logger.info("processing {}".format(text_file_name))         
+    # extract genre and year from file name (e.g. fic_1817_8554.txt)
+    # genre = file_details[0]
+    # year = file_details[1]
+    file_details = text_file_name.split("_")
+    out_file_name = "{0}{1}{2}/{3}".format(COHA_path, text_path,decade,text_file_name) 
+    try:
+        # read the text file line by line and write the result (free text) to a new text file
+        # under clean/text/[decade]/ as it is read (the file isn't read into memory)
+        # the clean files are encoded in utf-8, so the tokens are split and joined without decoding them
+        with current_zip.open(text_file_name, 'r') as lines, codecs.open(out_file_name, 'w+') as out_file:
+            # first line special handling
+            first_line = lines.readline().split("\t")[0]
+            line1 = "{0}\n\n".format(first_line)
+            out_file.write(line1)
             # skip tokens that contain < since they are either html tags or end-of-sentence markers
             # skip "q!" tokens 
-            clean_tokens = list(token for token in tokens[1:] if token!= "q!" and "<" not in token)
-            # rebuild the sentences from the tokens list
-            text = " ".join(clean_tokens)                                                               
-            try:
-                # write result (free text) to a new text file
-                # under clean/text/[decade]/
-                out_file_name = "{0}{1}{2}/{3}".format(COHA_path, text_path,decade,text_file_name) 
-                with codecs.open(out_file_name, 'w+') as out_file:
-                    line1 = "{0}\n\n".format(first_line)
-                    out_file.write(line1.encode('utf-8'))
-                    out_file.write(text.encode('utf-8'))                        
-            except:
-                logger.info("ERROR | failed to write results to file: {}".format(text_file_name)) 
-                raise           
+            tokens = (line.split("\t", 1)[0] for line in lines)
+            clean_tokens = (token for token in tokens if token!= "q!" and "<" not in token)
+            # rebuild the sentences from the tokens, a few thousand tokens at a time
+            separator = ""
+            while True:
+                batch = list(itertools.islice(clean_tokens, tokens_per_write))
+                if not batch:
+                    break
+                out_file.write(separator)
+                out_file.write(" ".join(batch))
+                separator = " "
+    except:
+        logger.error("ERROR | failed to write results to file: {}".format(text_file_name)) 
+        raise           
                         
     return True
                         
 def main():
-    number_of_processes = 10
     
     # create multiprocessing logger
     my_format = "%(asctime)s - %(process)s - %(message)s"
-    logging.basicConfig(filename="generate_text_log.txt", format=my_format, level=logging.INFO, mode='w')
+    logging.basicConfig(filename="generate_text_log.txt", format=my_format, level=log_level, filemode='w')
+    # worker processes send their records to the main process in batches
     install_mp_handler()
     logger = logging.getLogger()
     
@@ -130,11 +150,27 @@ def main():
     dir_file_names = os.listdir(zip_file_path)
     zip_file_names = list(x for x in dir_file_names if ".zip" in x)
     
-    logger.info("Creating pool and mapping processes")
-    # create a pool of processes to process zip files simultaneously
+    # create one task per text file in the zip files
+    tasks = []
+    for zip_file_name in zip_file_names:
+        # 2nd column in zip archive is the decade it covers
+        decade = zip_file_name.split("_")[1].replace(".zip", "")
+        # make a directory with decade in order to save txt files there
+        dir_path = "{0}{1}{2}".format(COHA_path, text_path,decade)
+        if not os.path.isdir(dir_path):
+            os.mkdir(dir_path)
+        with zipfile.ZipFile("{0}{1}".format(zip_file_path,zip_file_name), 'r') as current_zip:
+            tasks.extend((zip_file_name, info.filename, info.file_size) for info in current_zip.infolist())
+    # start with the largest files so that workers don't wait for a few large files at the end
+    tasks.sort(key=lambda task: task[2], reverse=True)
+    tasks = list((zip_file_name, text_file_name) for zip_file_name, text_file_name, file_size in tasks)
+    logger.info("Found {} text files in {} zip files".format(len(tasks), len(zip_file_names)))
+    
+    logger.info("Creating pool of {} processes and mapping tasks".format(number_of_processes))
+    # create a pool of processes to process text files simultaneously
     pool = multiprocessing.Pool(number_of_processes)
-    # fire up the processes for our zip files
-    result = pool.map(process_text, zip_file_names)
+    # fire up the processes for our text files (in chunks, in order of completion)
+    result = list(pool.imap_unordered(process_text, tasks, chunk_size))
     # close pool after all requests are submitted
     pool.close()
     # wait for the last worker to finish, not needed when using map but I'd rather be safe than sorry 
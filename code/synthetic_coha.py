@@ -0,0 +1,161 @@
+'''
+@author: Reem Alatrash
+@version: 1.0
+=======================
+
+This script generates a synthetic corpus with the same layout as the compressed tagged files of COHA.
+It is used to benchmark the scripts of this repository without a copy of COHA.
+
+The corpus is written under <output_dir>/tagged/ as one zip file per decade (e.g. wlp_1930s_syn.zip).
+Each zip file contains text files named [genre]_[year]_[id].txt which are encoded in cp1252 and contain
+a header line followed by one "form \t lemma \t pos" line per token.
+The rates of the noise found in COHA (malformed tokens, html entities, null pos tags, NUL characters and q! lines)
+can be set using the options below.
+
+Example:
+---------
+
+python synthetic_coha.py "/tmp/synthetic_coha/" --decades=1810s,2000s --docs=100 --malformed-rate=0.05
+
+'''
+
+'''
+******* ********* *********
+*******  imports  *********
+******* ********* *********
+'''
+import os
+import random
+import zipfile
+from docopt import docopt
+
+'''
+******* ********* *********
+******* variables *********
+******* ********* *********
+'''
+usage = """Generate a synthetic COHA-style corpus.
+
+Usage:
+    synthetic_coha.py <output_dir> [options]
+
+Arguments:
+    <output_dir> = path to the synthetic COHA directory
+
+Options:
+    --decades=<list>  comma separated decades [default: 1810s,1900s,2000s]
+    --docs=<n>  number of text files per decade [default: 50]
+    --tokens=<n>  average number of tokens per text file [default: 2000]
+    --malformed-rate=<r>  rate of malformed tokens [default: 0.02]
+    --html-rate=<r>  rate of tokens with html entities [default: 0.005]
+    --null-rate=<r>  rate of lines with a null pos tag [default: 0.01]
+    --nul-rate=<r>  rate of lines with NUL characters [default: 0.002]
+    --q-rate=<r>  rate of q! lines [default: 0.002]
+    --seed=<n>  seed of the random generator [default: 0]
+
+"""
+
+genres = ['fic', 'mag', 'news', 'nf']
+# (form, lemma, pos) of common tokens, tagged using CLAWS7 like COHA
+vocabulary = [('the', 'the', 'at'), ('of', 'of', 'io'), ('and', 'and', 'cc'), ('to', 'to', 'to'), ('a', 'a', 'at1'),
+              ('in', 'in', 'ii'), ('he', 'he', 'pphs1'), ('was', 'be', 'vbdz'), ('it', 'it', 'pph1'), ('his', 'his', 'appge'),
+              ('had', 'have', 'vhd'), ('not', 'not', 'xx'), ('said', 'say', 'vvd'), ('man', 'man', 'nn1'), ('men', 'man', 'nn2'),
+              ('house', 'house', 'nn1'), ('walked', 'walk', 'vvd'), ('walking', 'walk', 'vvg'), ('old', 'old', 'jj'),
+              ('quickly', 'quickly', 'rr'), ('city', 'city', 'nn1'), ('years', 'year', 'nnt2'), ('government', 'government', 'nn1'),
+              ('Washington', 'washington', 'np1'), ('Mr.', 'mr.', 'nnb'), ('Smith', 'smith', 'np1'), ("n't", 'not', 'xx'),
+              ("'s", "'s", 'ge'), ('caf\xe9', 'caf\xe9', 'nn1'), ('\x93', '\x93', 'y'), ('\x94', '\x94', 'y'), (',', ',', 'y'),
+              ('sauteed', 'saute', 'vvn'), ('-', '-', 'y'), ('--', '--', 'y')]
+# end of sentence tokens
+sentence_ends = [('.', '.', 'y'), ('.', '.', 'y'), ('.', '.', 'y'), ('?', '?', 'y'), ('!', '!', 'y')]
+# characters that COHA's malformed tokens contain between words
+malformed_chars = ['.', "'", '--', ':', ';', '*', '?', '!']
+html_entities = ['&amp;', '&#233;', '&eacute;', '&quot;', '&#8212;']
+null_forms = ['<P>', '<p>', '&nbsp;', '&#10;', '<>']
+
+'''
+******* ********* *********
+******* functions *********
+******* ********* *********
+'''
+
+def generate_token(rates):
+    '''returns a random token line (without line break) given the rates of the different kinds of noise'''
+    form, lemma, pos = random.choice(vocabulary)
+    r = random.random()
+    if r < rates['q']:
+        return "q!\tq!\tq!"
+    r -= rates['q']
+    if r < rates['null']:
+        null_form = random.choice(null_forms)
+        return "{0}\t{0}\tnull".format(null_form)
+    r -= rates['null']
+    if r < rates['nul']:
+        # NUL characters in the form and in the lemma and pos columns
+        return "{0}\x00\t\x00\t\x00".format(form)
+    r -= rates['nul']
+    if r < rates['malformed']:
+        # two words joined by a malformed character
+        other = random.choice(vocabulary)[0]
+        malformed = "{0}{1}{2}".format(form, random.choice(malformed_chars), other)
+        return "{0}\t{1}\t{2}".format(malformed, malformed.lower(), pos)
+    r -= rates['malformed']
+    if r < rates['html']:
+        html = "{0}{1}".format(form, random.choice(html_entities))
+        return "{0}\t{1}\t{2}".format(html, html.lower(), pos)
+    return "{0}\t{1}\t{2}".format(form, lemma, pos)
+
+def generate_text_file(text_id, number_of_tokens, rates):
+    '''returns the content of a synthetic tagged text file encoded in cp1252'''
+    lines = ["##{0}\t##{0}\tfo".format(text_id)]
+    tokens = 0
+    while tokens < number_of_tokens:
+        # sentences of 3 to 30 tokens
+        for idx in range(random.randint(3, 30)):
+            lines.append(generate_token(rates))
+        lines.append("\t".join(random.choice(sentence_ends)))
+        tokens = len(lines) - 1
+    content = "\r\n".join(lines) + "\r\n"
+    # the characters of the vocabulary are cp1252 bytes (python 2) or their latin-1 code points (python 3)
+    if not isinstance(content, bytes):
+        content = content.encode('latin-1')
+    return content
+
+def generate_corpus(output_dir, decades, docs, tokens, rates, seed=0):
+    '''Generates the synthetic corpus under output_dir/tagged/. Returns the number of text files and tokens'''
+    random.seed(seed)
+    tagged_path = os.path.join(output_dir, "tagged")
+    # create the directory structure expected by the scripts
+    for path in [tagged_path, os.path.join(output_dir, "clean", "tagged"), os.path.join(output_dir, "clean", "text")]:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    total_docs = 0
+    total_tokens = 0
+    text_id = 1000000
+    for decade in decades:
+        zip_path = os.path.join(tagged_path, "wlp_{0}_syn.zip".format(decade))
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as decade_zip:
+            for idx in range(docs):
+                text_id += 1
+                year = "{0}{1}".format(decade[:3], random.randint(0, 9))
+                # text file lengths vary a lot in COHA
+                number_of_tokens = int(random.expovariate(1.0 / tokens)) + 1
+                content = generate_text_file(text_id, number_of_tokens, rates)
+                decade_zip.writestr("{0}_{1}_{2}.txt".format(random.choice(genres), year, text_id), content)
+                total_docs += 1
+                total_tokens += content.count(b"\n") - 1
+    return total_docs, total_tokens
+
+def get_rates(args):
+    '''returns the rates of the different kinds of noise given the parsed arguments'''
+    return {'malformed': float(args['--malformed-rate']), 'html': float(args['--html-rate']), 'null': float(args['--null-rate']),
+            'nul': float(args['--nul-rate']), 'q': float(args['--q-rate'])}
+
+def main():
+    args = docopt(usage)
+    decades = args['--decades'].split(",")
+    docs, tokens = generate_corpus(args['<output_dir>'], decades, int(args['--docs']), int(args['--tokens']),
+                                   get_rates(args), int(args['--seed']))
+    print("generated {0} text files with {1} tokens in {2}".format(docs, tokens, args['<output_dir>']))
+
+if __name__ == "__main__":
+   main()
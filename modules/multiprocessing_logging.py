@@ -4,39 +4,50 @@ from __future__ import absolute_import, division, unicode_literals
 
 import logging
 import multiprocessing
+import os
 import sys
 import threading
+import time
 import traceback
-
-
-try:
-    import queue
-except ImportError:
-    import Queue as queue  # Python 2.
+from multiprocessing.util import Finalize
 
 
 __version__ = '0.2.7'
 
 
-def install_mp_handler(logger=None):
+def install_mp_handler(logger=None, batch_size=100, flush_interval=1.0):
     """Wraps the handlers in the given Logger with an MultiProcessingHandler.
 
     :param logger: whose handlers to wrap. By default, the root logger.
+    :param batch_size: number of records a child process sends at once.
+    :param flush_interval: seconds after which a child process sends its
+        records, even if the batch isn't full.
     """
     if logger is None:
         logger = logging.getLogger()
 
     for i, orig_handler in enumerate(list(logger.handlers)):
         handler = MultiProcessingHandler(
-            'mp-handler-{0}'.format(i), sub_handler=orig_handler)
+            'mp-handler-{0}'.format(i), sub_handler=orig_handler,
+            batch_size=batch_size, flush_interval=flush_interval)
 
         logger.removeHandler(orig_handler)
         logger.addHandler(handler)
 
 
 class MultiProcessingHandler(logging.Handler):
+    """Sends the records of all processes to the sub handler of the process
+    that created it, through a queue read by a thread of that process.
+
+    Child processes send their records in batches: when the batch is full,
+    when flush_interval seconds have passed since the batch was started (a
+    timer thread of the child process sends it, even if no other record is
+    emitted), when a record of level flush_level or above is emitted and
+    when the process exits.
+    """
 
-    def __init__(self, name, sub_handler=None):
+    def __init__(self, name, sub_handler=None, batch_size=100,
+                 flush_interval=1.0, flush_level=logging.WARNING):
         super(MultiProcessingHandler, self).__init__()
 
         if sub_handler is None:
@@ -46,28 +57,45 @@ class MultiProcessingHandler(logging.Handler):
         self.setLevel(self.sub_handler.level)
         self.setFormatter(self.sub_handler.formatter)
 
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
         self.queue = multiprocessing.Queue(-1)
         self._is_closed = False
+        # The records of a child process waiting to be sent, the process
+        # they belong to (child processes inherit the handler) and the time
+        # of the first one, and the timer that sends the batch when it is
+        # flush_interval seconds old.
+        self._batch = []
+        self._batch_pid = os.getpid()
+        self._batch_start = 0.0
+        self._batch_timer = None
+        self._pid = os.getpid()
         # The thread handles receiving records asynchronously.
         self._receive_thread = threading.Thread(target=self._receive, name=name)
         self._receive_thread.daemon = True
         self._receive_thread.start()
+        # Receives the remaining records when this process exits, before
+        # multiprocessing closes the queue (its finalizer has exitpriority 10).
+        Finalize(self, self.close, exitpriority=20)
 
     def setFormatter(self, fmt):
         super(MultiProcessingHandler, self).setFormatter(fmt)
         self.sub_handler.setFormatter(fmt)
 
     def _receive(self):
-        while not (self._is_closed and self.queue.empty()):
+        while True:
             try:
-                record = self.queue.get(timeout=0.2)
-                self.sub_handler.emit(record)
+                # A batch of records, or None when the handler is closed.
+                records = self.queue.get()
+                if records is None:
+                    break
+                for record in records:
+                    self.sub_handler.emit(record)
             except (KeyboardInterrupt, SystemExit):
                 raise
             except EOFError:
                 break
-            except queue.Empty:
-                pass  # This periodically checks if the logger is closed.
             except:
                 traceback.print_exc(file=sys.stderr)
 
@@ -75,7 +103,43 @@ class MultiProcessingHandler(logging.Handler):
         self.queue.join_thread()
 
     def _send(self, s):
-        self.queue.put_nowait(s)
+        if os.getpid() == self._pid:
+            # The process that writes the records doesn't batch them.
+            self.queue.put_nowait([s])
+            return
+        if self._batch_pid != os.getpid():
+            # First record of a child process: drop the batch inherited
+            # from its parent and send the last batch when it exits, before
+            # the queue is closed.
+            self._batch = []
+            self._batch_pid = os.getpid()
+            self._batch_timer = None
+            Finalize(self, self.flush, exitpriority=20)
+        if not self._batch:
+            self._batch_start = time.time()
+            self._batch_timer = threading.Timer(self.flush_interval, self.flush)
+            self._batch_timer.daemon = True
+            self._batch_timer.start()
+        self._batch.append(s)
+        if (len(self._batch) >= self.batch_size or
+                s.levelno >= self.flush_level or
+                time.time() - self._batch_start >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Sends the records of this process that are waiting in its batch."""
+        # The timer thread calls this too, hence the (reentrant) lock that
+        # logging holds while a record is emitted.
+        self.acquire()
+        try:
+            if self._batch and self._batch_pid == os.getpid():
+                batch, self._batch = self._batch, []
+                if self._batch_timer is not None:
+                    self._batch_timer.cancel()
+                    self._batch_timer = None
+                self.queue.put_nowait(batch)
+        finally:
+            self.release()
 
     def _format_record(self, record):
         # ensure that exc_info and args
@@ -103,7 +167,10 @@ class MultiProcessingHandler(logging.Handler):
     def close(self):
         if not self._is_closed:
             self._is_closed = True
-            self._receive_thread.join(5.0)  # Waits for receive queue to empty.
+            self.flush()
+            if os.getpid() == self._pid and self._receive_thread.is_alive():
+                self.queue.put_nowait(None)  # Stops the receive thread.
+                self._receive_thread.join(5.0)  # Waits for receive queue to empty.
 
             self.sub_handler.close()
             super(MultiProcessingHandler, self).close()